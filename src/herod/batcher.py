@@ -0,0 +1,147 @@
+import asyncio
+import time
+import typing
+from collections import deque
+
+import numpy as np
+
+from herod.store import SearchHits
+
+
+class BatchStats:
+    """记录最近若干个批次的大小与耗时"""
+
+    def __init__(self, window: int = 1000):
+        self.batches = 0
+        self.requests = 0
+        self.vectors = 0
+        self.recent: deque[tuple[int, int, float]] = deque(maxlen=window)
+
+    def update(self, requests: int, vectors: int, latency: float):
+        self.batches += 1
+        self.requests += requests
+        self.vectors += vectors
+        self.recent.append((requests, vectors, latency))
+
+    def summary(self) -> dict:
+        result = {
+            "batches": self.batches,
+            "requests": self.requests,
+            "vectors": self.vectors,
+        }
+        if self.recent:
+            requests, vectors, latency = np.array(self.recent).T
+            result["recent"] = {
+                "batches": len(self.recent),
+                "requests_per_batch": float(requests.mean()),
+                "vectors_per_batch": float(vectors.mean()),
+                "max_vectors_per_batch": int(vectors.max()),
+                "latency_mean": float(latency.mean()),
+                "latency_p50": float(np.percentile(latency, 50)),
+                "latency_p99": float(np.percentile(latency, 99)),
+            }
+        return result
+
+
+class _Batch:
+    def __init__(self):
+        self.items: list[tuple[np.ndarray, asyncio.Future]] = []
+        self.size = 0
+        self.timer: asyncio.TimerHandle | None = None
+
+
+class SearchBatcher:
+    """
+    合并多个并发请求的向量搜索
+
+    在 window 秒内或累积到 max_vectors 个向量后，将相同搜索参数的请求合并为一次搜索，
+    再按请求拆分搜索结果。
+    """
+
+    def __init__(
+        self,
+        search: typing.Callable[..., SearchHits],
+        run: typing.Callable[..., typing.Awaitable],
+        window: float,
+        max_vectors: int,
+    ):
+        """
+        :param search: 执行搜索的函数，参数为 (向量, search_list, limit, partitions)
+        :param run: 用于在线程池中执行阻塞函数的协程函数
+        :param window: 最长等待时间（秒），为 0 时不合并请求
+        :param max_vectors: 单次搜索的最大向量数
+        """
+        self.search_fn = search
+        self.run = run
+        self.window = window
+        self.max_vectors = max_vectors
+        self.pending: dict[tuple, _Batch] = {}
+        # 正在执行的搜索任务，事件循环只保留弱引用，需要在这里保留直到完成
+        self.tasks: set[asyncio.Task] = set()
+        self.stats = BatchStats()
+
+    async def search(
+        self,
+        des: np.ndarray,
+        search_list: int,
+        limit: int,
+        partitions: tuple[str, ...] | None = None,
+    ) -> SearchHits:
+        """
+        搜索一组向量
+        :param partitions: 搜索的分区，只有搜索相同分区的请求会被合并
+        :return: 搜索结果
+        """
+        if des is None or len(des) == 0:
+            return SearchHits.empty()
+        loop = asyncio.get_running_loop()
+        key = (search_list, limit, partitions)
+        batch = self.pending.get(key)
+        if batch is not None and batch.size + len(des) > self.max_vectors:
+            self._flush(key)
+            batch = None
+        if batch is None:
+            batch = self.pending[key] = _Batch()
+            batch.timer = loop.call_later(self.window, self._flush, key)
+
+        future = loop.create_future()
+        batch.items.append((des, future))
+        batch.size += len(des)
+        if self.window <= 0 or batch.size >= self.max_vectors:
+            self._flush(key)
+        return await future
+
+    def _flush(self, key: tuple):
+        batch = self.pending.pop(key, None)
+        if batch is None:
+            return
+        batch.timer.cancel()
+        task = asyncio.get_running_loop().create_task(self._execute(key, batch))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _execute(self, key: tuple, batch: _Batch):
+        try:
+            if len(batch.items) == 1:
+                data = batch.items[0][0]
+            else:
+                data = np.concatenate([des for des, _ in batch.items])
+            start = time.monotonic()
+            results = await self.run(self.search_fn, data, *key)
+            self.stats.update(len(batch.items), len(data), time.monotonic() - start)
+        except asyncio.CancelledError:
+            for _, future in batch.items:
+                future.cancel()
+            raise
+        except Exception as e:
+            # 错误交给等待结果的请求，任务本身不会带着未处理的异常结束
+            for _, future in batch.items:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        offset = 0
+        for des, future in batch.items:
+            if not future.done():
+                future.set_result(results[offset : offset + len(des)])
+            offset += len(des)
@@ -0,0 +1,385 @@
+import os
+import time
+import typing
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from herod import quantize
+from herod.database import DescriptorStore, Lmdb, get_image_hash
+from herod.enums import Backend, Extractor, Filter, Precision
+from herod.feature import FeatureExtractor
+from herod.indexer import Indexer
+from herod.metrics import Spans
+from herod.pipeline import IngestPipeline, IngestStats
+from herod.store import SearchHits, store_class
+
+
+def synthetic_descriptors(rows: int, dim: int = 64, clusters: int = 256, seed: int = 0):
+    """
+    生成与 SURF 特征向量分布相近的归一化向量
+    :param rows: 向量数量
+    :param dim: 向量维度
+    :param clusters: 聚类数量
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim)).astype(np.float32)
+    data = centers[rng.integers(0, clusters, rows)]
+    data += rng.normal(scale=0.5, size=(rows, dim)).astype(np.float32)
+    data /= np.linalg.norm(data, axis=1, keepdims=True)
+    return data
+
+
+def exact_search(data: np.ndarray, queries: np.ndarray, limit: int) -> np.ndarray:
+    """暴力搜索，返回每个查询向量最近的 limit 个向量的下标"""
+    norms = np.einsum("ij,ij->i", data, data)
+    distances = norms[None, :] - 2 * queries @ data.T
+    top = np.argpartition(distances, limit - 1, axis=1)[:, :limit]
+    return top
+
+
+def recall(hits: SearchHits, truth: np.ndarray) -> float:
+    """每个查询向量的结果中真实近邻所占的平均比例"""
+    total = 0.0
+    for i, expected in enumerate(truth):
+        found = hits.images[hits.offsets[i] : hits.offsets[i + 1]]
+        total += len(np.intersect1d(found, expected)) / len(expected)
+    return total / len(truth)
+
+
+def bench_store(
+    backend: Backend,
+    rows: int = 100000,
+    queries: int = 1000,
+    batch: int = 100,
+    search_list: int = 32,
+    limit: int = 50,
+    index_type: str | None = None,
+    precision: Precision = Precision.FLOAT32,
+    seed: int = 0,
+) -> dict:
+    """
+    使用合成数据测试向量存储后端的召回率与延迟
+
+    每个向量的图片 ID 即为其下标，因此可以直接与暴力搜索的结果比较
+    :param backend: 向量存储后端
+    :param rows: 向量数量
+    :param queries: 查询向量数量
+    :param batch: 每次搜索的查询向量数量，对应一次图片搜索
+    :param search_list: 搜索列表大小
+    :param limit: 每个向量的匹配数量
+    :param index_type: 索引类型，默认使用后端的默认索引
+    :param precision: 向量的存储精度，召回率总是与 float32 的精确结果比较
+    """
+    data = synthetic_descriptors(rows, seed=seed)
+    rng = np.random.default_rng(seed + 1)
+    query_data = data[rng.integers(0, rows, queries)]
+    query_data = query_data + rng.normal(scale=0.05, size=query_data.shape).astype(
+        np.float32
+    )
+    truth = np.concatenate(
+        [
+            exact_search(data, query_data[i : i + batch], limit)
+            for i in range(0, queries, batch)
+        ]
+    )
+
+    cls = store_class(backend)
+    name = f"herod_bench_{os.getpid()}"
+    cls.create(name, "herod benchmark", precision=precision)
+    try:
+        store = cls(name)
+        start = time.perf_counter()
+        for i in range(0, rows, 20000):
+            store.insert(np.arange(i, min(i + 20000, rows)), data[i : i + 20000])
+        store.flush()
+        insert_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        store.create_index(index_type)
+        index_time = time.perf_counter() - start
+
+        store.load()
+        latencies = []
+        results = []
+        for i in range(0, queries, batch):
+            start = time.perf_counter()
+            results.append(store.search(query_data[i : i + batch], search_list, limit))
+            latencies.append(time.perf_counter() - start)
+        store.release()
+    finally:
+        cls.drop(name)
+
+    latencies = np.array(latencies)
+    return {
+        "backend": backend.value,
+        "precision": Precision(precision).value,
+        "index_type": index_type or store.default_index_type,
+        "rows": rows,
+        "queries": queries,
+        "batch": batch,
+        "search_list": search_list,
+        "limit": limit,
+        # 每个向量占用的字节数（不含图片 ID）与所有向量的总大小
+        "vector_bytes": quantize.vector_bytes(precision, data.shape[1]),
+        "footprint_bytes": quantize.vector_bytes(precision, data.shape[1]) * rows,
+        "insert_seconds": insert_time,
+        "index_seconds": index_time,
+        "recall": float(
+            np.mean(
+                [
+                    recall(hits, truth[i * batch : (i + 1) * batch])
+                    for i, hits in enumerate(results)
+                ]
+            )
+        ),
+        "latency_mean": float(latencies.mean()),
+        "latency_p50": float(np.percentile(latencies, 50)),
+        "latency_p99": float(np.percentile(latencies, 99)),
+    }
+
+
+# 搜索流程的各个阶段
+STAGES = (
+    "decode",
+    "resize",
+    "detect",
+    "filter",
+    "compute",
+    "ann",
+    "aggregate",
+    "lmdb",
+    "rerank",
+    "signature",
+)
+
+
+def _encode_png(img: cv2.typing.MatLike) -> bytes:
+    return cv2.imencode(".png", img)[1].tobytes()
+
+
+def _crop(img: cv2.typing.MatLike) -> bytes:
+    """保留中间 80% 的区域"""
+    h, w = img.shape[:2]
+    dy, dx = h // 10, w // 10
+    return _encode_png(img[dy : h - dy, dx : w - dx])
+
+
+def _rescale(img: cv2.typing.MatLike) -> bytes:
+    img = cv2.resize(img, (0, 0), fx=0.5, fy=0.5, interpolation=cv2.INTER_AREA)
+    return _encode_png(img)
+
+
+def _jpeg(img: cv2.typing.MatLike) -> bytes:
+    return cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, 50])[1].tobytes()
+
+
+def _rotate90(img: cv2.typing.MatLike) -> bytes:
+    return _encode_png(cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE))
+
+
+def _rotate15(img: cv2.typing.MatLike) -> bytes:
+    h, w = img.shape[:2]
+    matrix = cv2.getRotationMatrix2D((w / 2, h / 2), 15, 1.0)
+    return _encode_png(cv2.warpAffine(img, matrix, (w, h)))
+
+
+# 查询图片的变换，模拟用户搜索时经过裁剪、缩放、压缩或旋转的图片
+VARIANTS: dict[str, typing.Callable[[cv2.typing.MatLike], bytes]] = {
+    "original": _encode_png,
+    "crop": _crop,
+    "rescale": _rescale,
+    "jpeg": _jpeg,
+    "rotate90": _rotate90,
+    "rotate15": _rotate15,
+}
+
+
+def timed_search(
+    indexer: Indexer,
+    data: bytes,
+    search_list: int,
+    search_limit: int,
+    limit: int,
+    top_k: int,
+    rerank: int = 0,
+    prefilter: bool = False,
+) -> tuple[dict[str, float], list[tuple[str, int, float]]]:
+    """
+    使用 Indexer.search_image 搜索，并记录每个阶段的耗时
+    :return: 各阶段的耗时（秒）与搜索结果
+    """
+    spans = Spans()
+    _, result = indexer.search_image(
+        data,
+        search_list,
+        search_limit,
+        limit,
+        top_k,
+        spans=spans,
+        rerank=rerank,
+        prefilter=prefilter,
+    )
+    return spans.timings, result
+
+
+def _latency(values: list[float]) -> dict:
+    """以毫秒为单位的延迟统计"""
+    values = np.array(values) * 1000
+    if len(values) == 0:
+        return {"mean": 0.0, "p50": 0.0, "p99": 0.0}
+    return {
+        "mean": float(values.mean()),
+        "p50": float(np.percentile(values, 50)),
+        "p99": float(np.percentile(values, 99)),
+    }
+
+
+def bench_pipeline(
+    folder: Path,
+    backend: Backend = Backend.LOCAL,
+    extractor: Extractor = Extractor.SURF,
+    filter: Filter = Filter.FUFP,
+    limit: int = 500,
+    search_list: int = 16,
+    search_limit: int = 100,
+    match_limit: int = 50,
+    top_k: int = 20,
+    queries: int = 100,
+    variants: typing.Iterable[str] = VARIANTS,
+    precision: Precision = Precision.FLOAT32,
+    workers: int | None = None,
+    glob: str = "**/*.*",
+    rerank: int = 0,
+    prefilter: bool = False,
+) -> dict:
+    """
+    使用文件夹中的图片测试整个导入与搜索流程
+
+    所有图片导入临时集合后，从中选取 queries 张图片，经过各种变换后搜索，
+    以原图是否出现在结果中计算召回率。测试结束后删除临时集合。
+    :param folder: 图片文件夹
+    :param backend: 向量存储后端，local 后端无需外部服务
+    :param extractor: 特征点提取算法
+    :param filter: 特征点均匀化算法
+    :param limit: 导入时的特征点数量
+    :param search_list: 搜索列表大小
+    :param search_limit: 被搜索图片的采样点数量
+    :param match_limit: 每个向量的匹配数量
+    :param top_k: 返回结果数量，计算 top-k 召回率
+    :param queries: 用于搜索的原图数量
+    :param variants: 查询图片的变换，取值为 VARIANTS 的键
+    :param precision: 向量的存储精度
+    :param workers: 特征提取进程数
+    :param rerank: 使用几何验证重排的候选图片数量，为 0 时不重排
+    :param prefilter: 是否先用感知哈希查找重复的图片
+    """
+    variants = list(variants)
+    for variant in variants:
+        if variant not in VARIANTS:
+            raise ValueError(f"未知的变换 {variant}，可选：{', '.join(VARIANTS)}")
+    files = sorted(file for file in Path(folder).rglob(glob) if file.is_file())
+
+    cls = store_class(backend)
+    name = f"herod_bench_{os.getpid()}"
+    dim = FeatureExtractor(extractor, filter).dim
+    cls.create(name, "herod benchmark", dim=dim, precision=precision)
+    try:
+        with Indexer(
+            name,
+            extractor=extractor,
+            filter=filter,
+            batch_size=20000,
+            descriptors=rerank > 0,
+            backend=backend,
+        ) as indexer:
+            indexer.descriptor_limit = limit
+            pipeline = IngestPipeline(indexer, extractor, filter, limit, workers)
+            stats = IngestStats()
+            added = []
+            for result in pipeline.run(files):
+                stats.update(result)
+                if result.status == "added":
+                    added.append(result.filename)
+            indexer.close()
+            ingest_seconds = stats.elapsed
+            indexer.store.flush()
+
+            start = time.perf_counter()
+            indexer.store.create_index()
+            index_seconds = time.perf_counter() - start
+            indexer.store.load()
+
+            rng = np.random.default_rng(0)
+            chosen = sorted(rng.choice(added, min(queries, len(added)), replace=False))
+            timings: dict[str, list[float]] = {stage: [] for stage in STAGES}
+            totals = []
+            found = {variant: [0, 0, 0] for variant in variants}
+            for filename in chosen:
+                image_id = get_image_hash(filename)
+                img = cv2.imread(filename, cv2.IMREAD_GRAYSCALE)
+                for variant in variants:
+                    data = VARIANTS[variant](img)
+                    stage, result = timed_search(
+                        indexer,
+                        data,
+                        search_list,
+                        search_limit,
+                        match_limit,
+                        top_k,
+                        rerank,
+                        prefilter,
+                    )
+                    for key in STAGES:
+                        timings[key].append(stage.get(key, 0.0))
+                    totals.append(sum(stage.values()))
+                    ids = [item[1] for item in result]
+                    found[variant][0] += 1
+                    found[variant][1] += bool(ids) and ids[0] == image_id
+                    found[variant][2] += image_id in ids
+            indexer.store.release()
+    finally:
+        cls.drop(name)
+        Lmdb(name).delete()
+        if DescriptorStore.exists(name):
+            DescriptorStore(name).delete()
+
+    queried = sum(count for count, _, _ in found.values())
+    return {
+        "backend": backend.value,
+        "extractor": Extractor(extractor).value,
+        "filter": Filter(filter).value,
+        "precision": Precision(precision).value,
+        "limit": limit,
+        "search_list": search_list,
+        "search_limit": search_limit,
+        "match_limit": match_limit,
+        "top_k": top_k,
+        "rerank": rerank,
+        "prefilter": prefilter,
+        "ingest": {
+            "images": stats.total,
+            "added": stats.count.get("added", 0),
+            "seconds": ingest_seconds,
+            "images_per_second": stats.total / max(ingest_seconds, 1e-9),
+            "index_seconds": index_seconds,
+        },
+        "latency_ms": {
+            "total": _latency(totals),
+            **{stage: _latency(values) for stage, values in timings.items()},
+        },
+        "recall": {
+            "queries": queried,
+            "top1": sum(top1 for _, top1, _ in found.values()) / max(queried, 1),
+            "topk": sum(topk for _, _, topk in found.values()) / max(queried, 1),
+            "variants": {
+                variant: {
+                    "queries": count,
+                    "top1": top1 / max(count, 1),
+                    "topk": topk / max(count, 1),
+                }
+                for variant, (count, top1, topk) in found.items()
+            },
+        },
+    }
@@ -0,0 +1,86 @@
+import collections
+import contextlib
+import mmap
+import os
+import typing
+
+# 可以直接哈希与解码的图片数据，不需要先复制为 bytes
+Buffer = bytes | bytearray | memoryview | mmap.mmap
+
+
+@contextlib.contextmanager
+def map_file(filename: str) -> typing.Iterator[Buffer]:
+    """
+    以只读方式映射文件，哈希与解码直接使用映射的内存，文件只从页缓存读取一次
+    :param filename: 文件名
+    :return: 文件内容，空文件无法映射，返回空的 bytes
+    """
+    with open(filename, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b""
+            return
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        yield mapped
+    finally:
+        try:
+            mapped.close()
+        except BufferError:
+            # 仍有数组引用映射的内存，由垃圾回收关闭
+            pass
+
+
+def read_into(file: typing.BinaryIO, view: memoryview):
+    """从文件中读取数据直到填满 view"""
+    filled = 0
+    while filled < len(view):
+        size = file.readinto(view[filled:])
+        if not size:
+            raise EOFError(f"文件只有 {filled} 字节，少于预期的 {len(view)} 字节")
+        filled += size
+
+
+class BufferPool:
+    """
+    可重复使用的读取缓冲区
+
+    上传的图片读入缓冲区后，哈希与解码都直接使用缓冲区中的数据，
+    用完的缓冲区放回池中，避免每个请求重新分配内存。可以在多个线程中使用。
+    """
+
+    def __init__(self, count: int, max_size: int):
+        """
+        :param count: 池中最多保留的缓冲区数量
+        :param max_size: 超过这一大小的缓冲区用完后直接释放，不放回池中
+        """
+        self.count = count
+        self.max_size = max_size
+        self.free: collections.deque[bytearray] = collections.deque()
+
+    def acquire(self, size: int) -> bytearray:
+        """取出一个不小于 size 的缓冲区，池中的缓冲区太小时重新分配"""
+        try:
+            buf = self.free.pop()
+        except IndexError:
+            return bytearray(size)
+        if len(buf) < size:
+            return bytearray(size)
+        return buf
+
+    def release(self, buf: bytearray):
+        if len(buf) <= self.max_size and len(self.free) < self.count:
+            self.free.append(buf)
+
+    @contextlib.contextmanager
+    def buffer(self, size: int) -> typing.Iterator[memoryview]:
+        """取出缓冲区，返回其中前 size 字节的视图，退出时放回池中"""
+        buf = self.acquire(size)
+        try:
+            yield memoryview(buf)[:size]
+        finally:
+            self.release(buf)
+
+    @property
+    def size(self) -> int:
+        """池中缓冲区占用的字节数"""
+        return sum(len(buf) for buf in list(self.free))
@@ -0,0 +1,107 @@
+import threading
+import time
+import typing
+from collections import OrderedDict
+
+
+def _sizeof(result: list[tuple[str, int, float]]) -> int:
+    """估算搜索结果占用的内存"""
+    return 64 + sum(120 + len(item[0]) for item in result)
+
+
+class ResultCache:
+    """
+    搜索结果的 LRU 缓存
+
+    以 (集合, 图片内容哈希, 搜索参数) 为键，总大小超过 max_bytes 时淘汰最久未使用的结果。
+    集合有新的图片写入后，该集合的所有缓存都会失效。
+    """
+
+    def __init__(self, max_bytes: int, ttl: float = 0):
+        """
+        :param max_bytes: 缓存占用内存的上限
+        :param ttl: 缓存的有效期（秒），为 0 时不过期
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.entries: OrderedDict[tuple, tuple[typing.Any, int, float, int]] = (
+            OrderedDict()
+        )
+        # 每个集合的版本号，写入新图片后加一
+        self.generations: dict[str, int] = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, collection: str, digest: int, params: tuple):
+        """返回缓存的搜索结果，不存在或已失效时返回 None"""
+        key = (collection, digest, params)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                value, size, expires, generation = entry
+                if generation == self.generations.get(collection, 0) and (
+                    self.ttl <= 0 or expires > time.monotonic()
+                ):
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.entries[key]
+                self.size -= size
+            self.misses += 1
+            return None
+
+    def generation(self, collection: str) -> int:
+        """返回集合当前的版本号，应在搜索开始前获取并传给 put"""
+        with self.lock:
+            return self.generations.get(collection, 0)
+
+    def put(
+        self,
+        collection: str,
+        digest: int,
+        params: tuple,
+        value: list,
+        generation: int,
+    ):
+        """
+        缓存搜索结果
+        :param generation: 搜索开始时集合的版本号，搜索期间集合有新的写入时不缓存
+        """
+        size = _sizeof(value)
+        if size > self.max_bytes:
+            return
+        key = (collection, digest, params)
+        with self.lock:
+            if generation != self.generations.get(collection, 0):
+                return
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            expires = time.monotonic() + self.ttl
+            self.entries[key] = (value, size, expires, generation)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted, _, _) = self.entries.popitem(last=False)
+                self.size -= evicted
+                self.evictions += 1
+
+    def invalidate(self, collection: str):
+        """使一个集合的所有缓存失效，失效的缓存会在下次访问或被淘汰时删除"""
+        with self.lock:
+            self.generations[collection] = self.generations.get(collection, 0) + 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
@@ -1,24 +1,35 @@
+import json
 import typer
-import cv2
 from typing_extensions import Annotated
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from herod.database import Lmdb
-from herod.feature import FeatureExtractor, Filter, Extractor
-from herod.indexer import Indexer
-from herod.config import config
-from herod import server
-from pymilvus import (
-    connections,
-    utility,
-    FieldSchema,
-    DataType,
-    CollectionSchema,
-    Collection,
-)
+from herod.enums import Backend, Extractor, Filter, PartitionKey, Precision
 
+# 为了让 --help 等命令快速启动，cv2、numpy、pymilvus、fastapi 等较重的模块
+# 只在具体的命令中导入，Milvus 也只在第一次使用时连接
 app = typer.Typer()
-connections.connect(host=config.milvus.host, port=config.milvus.port)
+
+
+def version_callback(value: bool):
+    if value:
+        from importlib.metadata import PackageNotFoundError, version
+
+        try:
+            typer.echo(f"herod {version('herod')}")
+        except PackageNotFoundError:
+            typer.echo("herod (未安装)")
+        raise typer.Exit()
+
+
+@app.callback()
+def callback(
+    version: Annotated[
+        bool,
+        typer.Option(
+            "--version", callback=version_callback, is_eager=True, help="显示版本号"
+        ),
+    ] = False,
+):
+    """who is the real hero?"""
 
 
 @app.command()
@@ -30,6 +41,9 @@ def show_feature(
     filter: Annotated[Filter, typer.Option(help="特征点均匀化算法")] = Filter.FUFP,
 ):
     """展示图片的特征点提取结果"""
+    import cv2
+    from herod.feature import FeatureExtractor
+
     extractor = FeatureExtractor(extractor, filter)
 
     img = cv2.imread(filename, cv2.IMREAD_GRAYSCALE)
@@ -51,52 +65,101 @@ def show_feature(
 def create_collection(
     name: Annotated[str, typer.Argument(help="集合名称")],
     description: Annotated[str, typer.Option(help="集合描述")] = "",
+    precision: Annotated[
+        Precision, typer.Option(help="特征向量的存储精度，Milvus 只支持 float32 与 binary")
+    ] = Precision.FLOAT32,
+    partition_key: Annotated[
+        PartitionKey | None,
+        typer.Option(help="分区键，date 按导入的月份分区，source 按导入时指定的来源分区，默认不分区"),
+    ] = None,
 ):
     """建立一个集合"""
-    if utility.has_collection(name):
+    from herod.partition import PartitionedStore
+    from herod.store import collection_exists, store_class
+
+    if collection_exists(name):
         typer.echo(f"集合 {name} 已存在")
         raise typer.Exit(1)
-
-    fields = [
-        FieldSchema(name="id", dtype=DataType.INT64, is_primary=True, auto_id=True),
-        FieldSchema(name="image", dtype=DataType.INT64, description="图片 ID"),
-        FieldSchema(
-            name="embedding", dtype=DataType.FLOAT_VECTOR, dim=64, description="图片特征向量"
-        ),
-    ]
-    schema = CollectionSchema(fields=fields, description=description)
-    Collection(name=name, schema=schema)
+    if partition_key is not None:
+        PartitionedStore.create(name, description, precision=precision, key=partition_key)
+    else:
+        store_class().create(name, description, precision=precision)
 
 
 @app.command()
-def drop_collection(name: str):
+def drop_collection(
+    name: str,
+    purge_descriptors: Annotated[bool, typer.Option(help="同时删除保存的特征向量")] = False,
+):
     """删除一个集合"""
-    utility.drop_collection(name)
+    from herod.database import DescriptorStore, Lmdb
+    from herod.store import drop_collection
+
+    drop_collection(name)
     Lmdb(name).delete()
+    if purge_descriptors and DescriptorStore.exists(name):
+        DescriptorStore(name).delete()
+
+
+def open_partitions(name: str, partitions: list[str]):
+    """打开集合，指定了分区时检查集合是否为分区集合"""
+    from herod.partition import PartitionedStore
+    from herod.store import open_store
+
+    store = open_store(name)
+    if partitions and not isinstance(store, PartitionedStore):
+        typer.echo(f"集合 {name} 没有分区")
+        raise typer.Exit(1)
+    return store
 
 
 @app.command()
-def release_collection(name: str):
+def release_collection(
+    name: str,
+    partition: Annotated[list[str], typer.Option(help="只释放指定的分区")] = [],
+):
     """释放一个集合的资源"""
-    Collection(name=name).release()
+    store = open_partitions(name, partition)
+    if partition:
+        store.release(partition)
+    else:
+        store.release()
 
 
 @app.command()
-def create_index(collection: str, index_type: str = "DISKANN"):
-    """为集合建立索引"""
-    collection = Collection(name=collection)
-    index_params = {
-        "metric_type": "L2",
-        "index_type": index_type,
-    }
-    collection.create_index(field_name="embedding", index_params=index_params)
+def list_partitions(name: str):
+    """列出分区集合中的所有分区"""
+    from herod.partition import PartitionedStore
+
+    if not PartitionedStore.exists(name):
+        typer.echo(f"集合 {name} 没有分区")
+        raise typer.Exit(1)
+    for partition in PartitionedStore(name).partitions:
+        typer.echo(partition)
+
+
+@app.command()
+def create_index(
+    collection: str,
+    index_type: Annotated[
+        str, typer.Option(help="索引类型，默认为 Milvus 的 DISKANN 或本地存储的 IVF_FLAT")
+    ] = "",
+    partition: Annotated[list[str], typer.Option(help="只为指定的分区建立索引")] = [],
+):
+    """为集合建立索引，分区集合会依次为每个分区建立索引"""
+    store = open_partitions(collection, partition)
+    if partition:
+        store.create_index(index_type or None, partition)
+    else:
+        store.create_index(index_type or None)
 
 
 @app.command()
 def drop_index(collection: str):
     """删除集合的索引"""
-    collection = Collection(name=collection)
-    collection.drop_index()
+    from herod.store import open_store
+
+    open_store(collection).drop_index()
 
 
 @app.command()
@@ -107,27 +170,262 @@ def add_image(
     extractor: Annotated[Extractor, typer.Option(help="特征点提取算法")] = Extractor.SURF,
     filter: Annotated[Filter, typer.Option(help="特征点均匀化算法")] = Filter.FUFP,
     glob: str = "**/*.*",
-    threads: int = 2,
+    workers: Annotated[int, typer.Option(help="特征提取进程数，为 0 时使用 CPU 核心数")] = 0,
+    batch_size: Annotated[int, typer.Option(help="批量插入的向量行数，为 0 时每张图片单独插入")] = 20000,
+    flush_interval: Annotated[float, typer.Option(help="批量插入的最长等待时间（秒）")] = 5.0,
+    save_descriptors: Annotated[
+        bool | None, typer.Option(help="保存特征向量用于重建集合，默认使用配置文件中的设置")
+    ] = None,
+    partition: Annotated[
+        str | None, typer.Option(help="写入的分区，按来源分区的集合必须指定，默认按日期选择分区")
+    ] = None,
 ):
     """往集合中增加一张图片或递归添加一个文件夹中的图片"""
+    from herod.indexer import Indexer
+    from herod.pipeline import IngestPipeline, IngestStats
+
     path = Path(path)
-    indexer = Indexer(collection, extractor=extractor, filter=filter)
-    if path.is_dir():
-        with ThreadPoolExecutor(max_workers=threads) as executor:
-            futures = {
-                executor.submit(indexer.add_image, str(file), limit): file
-                for file in path.rglob(glob)
-            }
-            for future in as_completed(futures):
-                file = futures[future]
-                try:
-                    future.result()
-                    typer.echo(f"处理 {file} 完成")
-                except Exception as e:
-                    typer.echo(f"处理 {file} 时出现错误：{e}")
-    else:
-        indexer.add_image(str(path), limit)
-        typer.echo(f"处理 {path} 完成")
+    with Indexer(
+        collection,
+        extractor=extractor,
+        filter=filter,
+        batch_size=batch_size,
+        flush_interval=flush_interval,
+        descriptors=save_descriptors,
+        partition=partition,
+    ) as indexer:
+        if path.is_dir():
+            pipeline = IngestPipeline(indexer, extractor, filter, limit, workers or None)
+            stats = IngestStats()
+            files = (file for file in path.rglob(glob) if file.is_file())
+            for result in pipeline.run(files):
+                stats.update(result)
+                match result.status:
+                    case "error":
+                        typer.echo(f"处理 {result.filename} 时出现错误：{result.error}")
+                    case "empty":
+                        typer.echo(f"图片 {result.filename} 没有特征点")
+                    case "unchanged":
+                        typer.echo(f"文件 {result.filename} 未修改，跳过")
+                    case _:
+                        typer.echo(f"处理 {result.filename} 完成")
+            indexer.close()
+            typer.echo(
+                f"共处理 {stats.total} 张图片，新增 {stats.count.get('added', 0)} 张，"
+                f"耗时 {stats.elapsed:.2f} 秒，{stats.rate:.2f} 张/秒"
+            )
+        else:
+            written = indexer.add_image(str(path), limit)
+            indexer.flush()
+            if written is not None:
+                written.result()
+            typer.echo(f"处理 {path} 完成")
+
+
+@app.command()
+def rebuild_collection(
+    collection: Annotated[str, typer.Argument(help="要建立的集合名称")],
+    source: Annotated[str, typer.Option(help="特征向量来源的集合，默认与要建立的集合相同")] = "",
+    limit: Annotated[int, typer.Option(help="导入时使用的特征点数量")] = 500,
+    extractor: Annotated[Extractor, typer.Option(help="导入时使用的特征点提取算法")] = Extractor.SURF,
+    filter: Annotated[Filter, typer.Option(help="导入时使用的特征点均匀化算法")] = Filter.FUFP,
+    batch_size: Annotated[int, typer.Option(help="批量插入的向量行数")] = 20000,
+    precision: Annotated[Precision, typer.Option(help="新集合中特征向量的存储精度")] = Precision.FLOAT32,
+    index: Annotated[bool, typer.Option(help="导入完成后建立索引")] = True,
+    index_type: Annotated[str, typer.Option(help="索引类型，默认使用后端的默认索引")] = "",
+):
+    """使用保存的特征向量重建集合，不需要重新解码图片与提取特征"""
+    import itertools
+    import time
+    from herod.database import DescriptorStore, descriptor_variant
+    from herod.indexer import Indexer
+    from herod.store import collection_exists, store_class
+
+    source = source or collection
+    if not DescriptorStore.exists(source):
+        typer.echo(f"集合 {source} 没有保存特征向量")
+        raise typer.Exit(1)
+    store = store_class()
+    if collection_exists(collection):
+        typer.echo(f"集合 {collection} 已存在，请先删除")
+        raise typer.Exit(1)
+
+    items = DescriptorStore(source).iter(descriptor_variant(extractor, filter, limit))
+    first = next(items, None)
+    if first is None:
+        typer.echo(f"集合 {source} 中没有使用 {extractor.value}/{filter.value}/{limit} 提取的特征向量")
+        raise typer.Exit(1)
+    store.create(collection, dim=first[2].shape[1], precision=precision)
+
+    start = time.perf_counter()
+    count = 0
+    # 每一批写入完成的 Future，导入结束后检查是否有写入失败的批次
+    batches = set()
+    with Indexer(
+        collection,
+        extractor=extractor,
+        filter=filter,
+        batch_size=batch_size,
+        descriptors=False,
+    ) as indexer:
+        for image_id, filename, des in itertools.chain([first], items):
+            batches.add(indexer.insert(image_id, filename, des))
+            count += 1
+    batches.discard(None)
+    for written in batches:
+        written.result()
+    indexer.store.flush()
+    elapsed = time.perf_counter() - start
+    typer.echo(f"共导入 {count} 张图片，耗时 {elapsed:.2f} 秒，{count / elapsed:.2f} 张/秒")
+
+    if index:
+        typer.echo("正在建立索引")
+        indexer.store.create_index(index_type or None)
+
+
+@app.command()
+def dedup(
+    collection: Annotated[str, typer.Argument(help="集合名称")],
+    limit: Annotated[int, typer.Option(help="导入时使用的特征点数量")] = 500,
+    extractor: Annotated[Extractor, typer.Option(help="导入时使用的特征点提取算法")] = Extractor.SURF,
+    filter: Annotated[Filter, typer.Option(help="导入时使用的特征点均匀化算法")] = Filter.FUFP,
+    sample: Annotated[int, typer.Option(help="每张图片参与搜索的特征向量数量")] = 50,
+    search_list: Annotated[int, typer.Option(help="搜索列表大小，越大越准确，但是速度越慢")] = 16,
+    match_limit: Annotated[int, typer.Option(help="每个特征向量的匹配数量，包括图片自身")] = 5,
+    min_ratio: Annotated[float, typer.Option(help="判定为近似重复的最低匹配比例")] = 0.3,
+    batch: Annotated[int, typer.Option(help="每次合并搜索的图片数")] = 256,
+    workers: Annotated[int, typer.Option(help="process 模式下的工作进程数，为 0 时使用 CPU 核心数")] = 0,
+    parallel: Annotated[
+        str, typer.Option(help="并行方式：process 每个进程搜索整个集合，partition 每个进程搜索一个分区")
+    ] = "process",
+    partition: Annotated[list[str], typer.Option(help="只在指定的分区中查找重复的图片")] = [],
+    reset: Annotated[bool, typer.Option(help="删除已有的分组，重新处理所有图片")] = False,
+):
+    """
+    查找集合中近似重复的图片并分组
+
+    使用导入时保存的特征向量（--save-descriptors）批量自连接搜索，分组保存在集合的 LMDB 中。
+    再次运行时只处理新导入或上次中断时尚未处理的图片。
+    """
+    from herod.dedup import DedupJob, DedupStats
+
+    try:
+        job = DedupJob(
+            collection,
+            extractor,
+            filter,
+            limit,
+            sample,
+            search_list,
+            match_limit,
+            min_ratio,
+            batch,
+            workers or None,
+            parallel,
+            partition or None,
+        )
+    except ValueError as e:
+        typer.echo(str(e))
+        raise typer.Exit(1)
+    if reset:
+        job.mdb.reset_clusters()
+    stats = DedupStats()
+    for result in job.run():
+        stats.update(result)
+        typer.echo(
+            f"已处理 {stats.images} 张图片，找到 {stats.pairs} 对近似重复的图片，"
+            f"{stats.rate:.2f} 张/秒"
+        )
+    if stats.missing:
+        typer.echo(f"{stats.missing} 张图片没有使用 {extractor.value}/{filter.value}/{limit} 保存的特征向量")
+    groups = sum(1 for _ in job.mdb.iter_clusters())
+    typer.echo(f"共处理 {stats.images} 张图片，耗时 {stats.elapsed:.2f} 秒，共有 {groups} 组近似重复的图片")
+
+
+@app.command()
+def duplicates(
+    collection: Annotated[str, typer.Argument(help="集合名称")],
+    min_size: Annotated[int, typer.Option(help="只输出图片数量不少于该值的分组")] = 2,
+):
+    """
+    输出 dedup 找到的近似重复图片分组
+
+    输出格式为 分组 ID<TAB>图片 ID<TAB>文件名。
+    """
+    from herod.database import Lmdb
+
+    mdb = Lmdb(collection)
+    for cluster, members in mdb.iter_clusters(min_size):
+        for image_id, filename in zip(members, mdb.get_images_by_ids(members)):
+            typer.echo(f"{cluster}\t{image_id}\t{(filename or b'').decode()}")
+
+
+@app.command()
+def remove_image(
+    collection: Annotated[str, typer.Argument(help="集合名称")],
+    images: Annotated[
+        list[str] | None, typer.Argument(help="导入时的文件名或图片 ID")
+    ] = None,
+    from_file: Annotated[
+        str | None, typer.Option(help="从文件中读取要删除的图片，每行一个，- 表示标准输入")
+    ] = None,
+    batch: Annotated[int, typer.Option(help="每批删除的图片数量")] = 1000,
+):
+    """
+    删除图片的所有向量与记录
+
+    删除后的空间在运行 compact 后回收。服务器正在运行时请使用服务器的 /remove_images 接口。
+    """
+    import sys
+
+    from herod.indexer import Indexer
+
+    def names():
+        yield from images or []
+        if from_file is not None:
+            f = sys.stdin if from_file == "-" else open(from_file)
+            with f:
+                for line in f:
+                    if line := line.strip():
+                        yield line
+
+    removed = missing = 0
+
+    def remove(chunk: list[str]):
+        nonlocal removed, missing
+        found = indexer.find_images(chunk)
+        for name, image_id in zip(chunk, found):
+            if image_id is None:
+                typer.echo(f"图片 {name} 不存在")
+        count = len(indexer.remove_images(i for i in found if i is not None))
+        removed += count
+        missing += len(chunk) - count
+        typer.echo(f"已删除 {removed} 张图片")
+
+    with Indexer(collection) as indexer:
+        chunk = []
+        for name in names():
+            chunk.append(name)
+            if len(chunk) == batch:
+                remove(chunk)
+                chunk = []
+        if chunk:
+            remove(chunk)
+    typer.echo(f"共删除 {removed} 张图片，{missing} 张不存在")
+
+
+@app.command()
+def compact(collection: Annotated[str, typer.Argument(help="集合名称")]):
+    """
+    回收已删除图片占用的空间
+
+    压缩向量存储并重写 LMDB 数据文件，期间可以继续搜索。服务器正在运行时请使用服务器的 /compact 接口。
+    """
+    from herod.indexer import Indexer
+
+    with Indexer(collection) as indexer:
+        before, after = indexer.compact()
+    typer.echo(f"压缩完成，LMDB 数据文件从 {before / (1 << 20):.1f} MiB 减小到 {after / (1 << 20):.1f} MiB")
 
 
 @app.command()
@@ -137,18 +435,252 @@ def search_image(
     search_list: Annotated[int, typer.Option(help="搜索列表大小，越大越准确，但是速度越慢")] = 32,
     search_limit: Annotated[int, typer.Option(help="被搜索图片的采样点数量")] = 100,
     limit: Annotated[int, typer.Option(help="每个向量的匹配数量")] = 50,
+    top_k: Annotated[int, typer.Option(help="返回结果数量")] = 20,
+    rerank: Annotated[
+        int, typer.Option(help="使用几何验证重排的候选图片数量，为 0 时不重排，需要导入时保存了特征向量")
+    ] = 0,
+    extractor: Annotated[Extractor, typer.Option(help="特征点提取算法")] = Extractor.SURF,
+    filter: Annotated[Filter, typer.Option(help="特征点均匀化算法")] = Filter.FUFP,
+    partition: Annotated[list[str], typer.Option(help="只搜索指定的分区")] = [],
+    prefilter: Annotated[
+        bool | None, typer.Option(help="搜索前先用感知哈希查找重复的图片，默认使用配置文件中的设置")
+    ] = None,
 ):
     """在集合中搜索一张图片"""
-    indexer = Indexer(collection, search=True)
-    elapsed, result = indexer.search_image(filename, search_list, search_limit, limit)
+    from herod.indexer import Indexer
+
+    indexer = Indexer(collection, search=True, extractor=extractor, filter=filter)
+    elapsed, result = indexer.search_image(
+        filename,
+        search_list,
+        search_limit,
+        limit,
+        top_k,
+        rerank=rerank,
+        partitions=partition or None,
+        prefilter=prefilter,
+    )
     typer.echo(f"搜索耗时：{elapsed} 秒")
-    for filename, image_id, distance in result[:20]:
-        typer.echo(f"{filename}\t{image_id}\t{distance}")
+    for filename, image_id, score in result:
+        typer.echo(f"{filename}\t{image_id}\t{score}")
+
+
+@app.command()
+def search_images(
+    collection: Annotated[str, typer.Argument(help="集合名称")],
+    paths: Annotated[list[Path], typer.Argument(help="图片路径或文件夹")],
+    search_list: Annotated[int, typer.Option(help="搜索列表大小，越大越准确，但是速度越慢")] = 32,
+    search_limit: Annotated[int, typer.Option(help="被搜索图片的采样点数量")] = 100,
+    limit: Annotated[int, typer.Option(help="每个向量的匹配数量")] = 50,
+    top_k: Annotated[int, typer.Option(help="每张图片的返回结果数量")] = 20,
+    extractor: Annotated[Extractor, typer.Option(help="特征点提取算法")] = Extractor.SURF,
+    filter: Annotated[Filter, typer.Option(help="特征点均匀化算法")] = Filter.FUFP,
+    glob: Annotated[str, typer.Option(help="在文件夹中查找图片的模式")] = "**/*.*",
+    batch: Annotated[int, typer.Option(help="每次合并搜索的图片数")] = 64,
+    workers: Annotated[int, typer.Option(help="特征提取线程数，为 0 时使用 CPU 核心数")] = 0,
+    partition: Annotated[list[str], typer.Option(help="只搜索指定的分区")] = [],
+    prefilter: Annotated[
+        bool | None, typer.Option(help="搜索前先用感知哈希查找重复的图片，默认使用配置文件中的设置")
+    ] = None,
+):
+    """
+    在集合中批量搜索多张图片
+
+    集合只加载一次，每批图片并行提取特征后合并为少数几次向量搜索。
+    输出格式为 查询图片<TAB>文件名<TAB>图片 ID<TAB>分数。
+    """
+    import itertools
+    import os
+    from concurrent.futures import ThreadPoolExecutor
+    from herod.indexer import Indexer
+
+    def files():
+        for path in paths:
+            if path.is_dir():
+                yield from (str(file) for file in sorted(path.glob(glob)) if file.is_file())
+            else:
+                yield str(path)
+
+    indexer = Indexer(collection, search=True, extractor=extractor, filter=filter)
+    total = 0.0
+    with ThreadPoolExecutor(workers or os.cpu_count()) as executor:
+        iterator = files()
+        while chunk := list(itertools.islice(iterator, batch)):
+            elapsed, results = indexer.search_images(
+                chunk,
+                search_list,
+                search_limit,
+                limit,
+                top_k,
+                map=executor.map,
+                partitions=partition or None,
+                prefilter=prefilter,
+            )
+            total += elapsed
+            for query, item in zip(chunk, results):
+                if item.error is not None:
+                    typer.echo(f"搜索 {query} 时出现错误：{item.error}", err=True)
+                    continue
+                for filename, image_id, score in item.result:
+                    typer.echo(f"{query}\t{filename}\t{image_id}\t{score}")
+    typer.echo(f"搜索耗时：{total} 秒", err=True)
+
+
+@app.command()
+def bench_store(
+    backend: Annotated[list[Backend], typer.Option(help="参与测试的向量存储后端")] = [
+        Backend.LOCAL,
+        Backend.MILVUS,
+    ],
+    rows: Annotated[int, typer.Option(help="向量数量")] = 100000,
+    queries: Annotated[int, typer.Option(help="查询向量数量")] = 1000,
+    batch: Annotated[int, typer.Option(help="每次搜索的查询向量数量")] = 100,
+    search_list: Annotated[int, typer.Option(help="搜索列表大小")] = 32,
+    limit: Annotated[int, typer.Option(help="每个向量的匹配数量")] = 50,
+    precision: Annotated[list[Precision], typer.Option(help="参与测试的存储精度")] = [
+        Precision.FLOAT32,
+        Precision.FLOAT16,
+        Precision.INT8,
+        Precision.BINARY,
+    ],
+):
+    """使用合成数据比较各个向量存储后端与存储精度的召回率、占用空间与延迟"""
+    from herod.bench import bench_store
+
+    for item in backend:
+        for value in precision:
+            try:
+                result = bench_store(
+                    item, rows, queries, batch, search_list, limit, precision=value
+                )
+            except ValueError as e:
+                typer.echo(f"跳过 {item.value}/{value.value}：{e}")
+                continue
+            typer.echo(json.dumps(result, ensure_ascii=False))
+
+
+@app.command()
+def bench(
+    folder: Annotated[Path, typer.Argument(help="图片文件夹")],
+    backend: Annotated[Backend, typer.Option(help="向量存储后端")] = Backend.LOCAL,
+    extractor: Annotated[Extractor, typer.Option(help="特征点提取算法")] = Extractor.SURF,
+    filter: Annotated[Filter, typer.Option(help="特征点均匀化算法")] = Filter.FUFP,
+    limit: Annotated[int, typer.Option(help="导入时的特征点数量")] = 500,
+    search_list: Annotated[int, typer.Option(help="搜索列表大小")] = 16,
+    search_limit: Annotated[int, typer.Option(help="被搜索图片的采样点数量")] = 100,
+    match_limit: Annotated[int, typer.Option(help="每个向量的匹配数量")] = 50,
+    top_k: Annotated[int, typer.Option(help="返回结果数量，用于计算 top-k 召回率")] = 20,
+    queries: Annotated[int, typer.Option(help="用于搜索的原图数量")] = 100,
+    variant: Annotated[
+        list[str],
+        typer.Option(help="查询图片的变换：original、crop、rescale、jpeg、rotate90、rotate15"),
+    ] = ["original", "crop", "rescale", "jpeg", "rotate90", "rotate15"],
+    precision: Annotated[Precision, typer.Option(help="特征向量的存储精度")] = Precision.FLOAT32,
+    workers: Annotated[int, typer.Option(help="特征提取进程数，为 0 时使用 CPU 核心数")] = 0,
+    glob: str = "**/*.*",
+    rerank: Annotated[int, typer.Option(help="使用几何验证重排的候选图片数量，为 0 时不重排")] = 0,
+    prefilter: Annotated[bool, typer.Option(help="搜索前先用感知哈希查找重复的图片")] = False,
+    output: Annotated[Path | None, typer.Option(help="将结果以 JSON 格式写入文件")] = None,
+):
+    """使用文件夹中的图片测试导入速度、各阶段的搜索延迟与召回率"""
+    from herod.bench import bench_pipeline
+
+    result = bench_pipeline(
+        folder,
+        backend,
+        extractor,
+        filter,
+        limit,
+        search_list,
+        search_limit,
+        match_limit,
+        top_k,
+        queries,
+        variant,
+        precision,
+        workers or None,
+        glob,
+        rerank,
+        prefilter,
+    )
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if output is not None:
+        output.write_text(text)
+    typer.echo(text)
+
+
+def tar_stream(files, root: Path):
+    """将文件逐个打包为 tar 流，不需要在内存或磁盘中保存整个压缩包"""
+    import io
+    import tarfile
+
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w|") as tar:
+        for file in files:
+            tar.add(file, arcname=str(file.relative_to(root)))
+            # 空的分块会被当作 chunked 编码的结束标记
+            if buf.tell():
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+    yield buf.getvalue()
+
+
+@app.command()
+def push(
+    collection: Annotated[str, typer.Argument(help="集合名称")],
+    path: Annotated[Path, typer.Argument(help="图片文件夹")],
+    url: Annotated[str, typer.Option(help="服务器地址")] = "http://127.0.0.1:8080",
+    limit: Annotated[int, typer.Option(help="限制特征点数量")] = 500,
+    extractor: Annotated[Extractor, typer.Option(help="特征点提取算法")] = Extractor.SURF,
+    filter: Annotated[Filter, typer.Option(help="特征点均匀化算法")] = Filter.FUFP,
+    glob: str = "**/*.*",
+):
+    """通过服务器的批量导入接口上传一个文件夹中的图片"""
+    import httpx
+
+    root = path.resolve()
+    files = (file for file in sorted(root.glob(glob)) if file.is_file())
+    params = {
+        "collection": collection,
+        "limit": limit,
+        "prefix": f"{root}/",
+        "extractor": extractor.value,
+        "filter": filter.value,
+    }
+    with httpx.stream(
+        "POST",
+        f"{url.rstrip('/')}/add_images",
+        params=params,
+        content=tar_stream(files, root),
+        headers={"Content-Type": "application/x-tar"},
+        timeout=None,
+    ) as response:
+        if response.status_code != 200:
+            response.read()
+            typer.echo(f"请求失败：{response.status_code} {response.text}")
+            raise typer.Exit(1)
+        for line in response.iter_lines():
+            if not line:
+                continue
+            result = json.loads(line)
+            if "summary" in result:
+                summary = "，".join(f"{k} {v}" for k, v in result["summary"].items())
+                typer.echo(f"共耗时 {result['elapsed']:.2f} 秒：{summary}")
+                if result["error"]:
+                    typer.echo(f"错误：{result['error']}")
+                    raise typer.Exit(1)
+            elif result["status"] == "error":
+                typer.echo(f"处理 {result['name']} 时出现错误：{result['error']}")
+            else:
+                typer.echo(f"{result['name']}：{result['status']}")
 
 
 @app.command()
 def start_server(host: str = "0.0.0.0", port: int = 8080):
     """启动服务器"""
+    from herod import server
+
     server.start_server(host, port)
 
 
@@ -2,6 +2,7 @@ import os
 import tomlkit
 from pydantic import BaseModel
 from pydantic_settings import BaseSettings
+from herod.enums import Backend, Extractor, Filter
 
 
 def xdg_data_home():
@@ -17,8 +18,108 @@ class MilvusConfig(BaseModel):
     port: int = 19530
 
 
+class LocalConfig(BaseModel):
+    # 向量文件的存放目录，为空时使用 $XDG_DATA_HOME/herod/vectors
+    path: str = ""
+    # 单个段文件的最大向量数
+    segment_rows: int = 1 << 22
+
+
+class DescriptorConfig(BaseModel):
+    # 是否在导入图片时保存特征向量，用于之后重建集合
+    enabled: bool = False
+    # 特征向量的存放目录，为空时使用 $XDG_DATA_HOME/herod/descriptors
+    path: str = ""
+    # 导入图片时使用的特征点数量，几何重排时按此读取保存的特征向量
+    limit: int = 500
+
+
+class LmdbConfig(BaseModel):
+    # 图片元数据的初始映射大小（字节），空间不足时自动翻倍
+    map_size: int = 1 << 30
+
+
+class SignatureConfig(BaseModel):
+    # 搜索时是否先用感知哈希查找重复的图片，找到时不再进行特征向量搜索
+    # 开启后找到重复图片时只返回重复的图片，结果与关闭时不同，因此默认关闭
+    prefilter: bool = False
+    # 判定为重复图片的最大汉明距离（64 位中不同的位数）
+    distance: int = 4
+
+
+class ExtractConfig(BaseModel):
+    # 是否对超长或超大的图片分块提取特征点，关闭时图片会被缩小到 1920x1080 以内
+    tiled: bool = False
+    # 分块模式下图片短边的最大长度
+    max_side: int = 1080
+    # 分块模式下缩放后图片的最大像素数，用于限制峰值内存
+    max_pixels: int = 1 << 25
+    # 每个分块沿长边方向的长度
+    tile_size: int = 1920
+    # 相邻分块的重叠长度
+    tile_overlap: int = 128
+    # 并行处理分块的线程数
+    tile_workers: int = 4
+
+
+class PreloadConfig(BaseModel):
+    # 集合名称
+    name: str
+    # 特征点提取算法
+    extractor: Extractor = Extractor.SURF
+    # 特征点均匀化算法
+    filter: Filter = Filter.FUFP
+
+
+class ServerConfig(BaseModel):
+    # 解码与特征提取等 CPU 密集任务的线程数
+    workers: int = os.cpu_count() or 4
+    # 等待 Milvus 与 LMDB 等 IO 任务的线程数
+    io_workers: int = 32
+    # 每个集合同时处理的请求数
+    concurrency: int = 8
+    # 每个集合排队等待的请求数，超过后返回 503
+    queue_size: int = 64
+    # 每个集合同时处理的批量导入、删除与压缩请求数，与搜索分开限制
+    bulk_concurrency: int = 1
+    # 每个集合排队等待的批量请求数，超过后返回 503
+    bulk_queue_size: int = 4
+    # 合并并发搜索请求的最长等待时间（毫秒），为 0 时不合并
+    batch_window_ms: float = 2.0
+    # 合并搜索时单次搜索的最大向量数
+    batch_max_vectors: int = 2048
+    # 搜索结果缓存占用内存的上限（字节），为 0 时不缓存
+    cache_bytes: int = 64 << 20
+    # 搜索结果缓存的有效期（秒），为 0 时只在集合写入新图片后失效
+    cache_ttl: float = 300.0
+    # 是否记录各阶段的耗时并通过 /metrics 导出
+    metrics: bool = True
+    # 批量插入的向量行数，为 0 时每张图片单独插入
+    insert_batch_size: int = 20000
+    # 批量插入时缓冲区的最长等待时间（秒）
+    flush_interval: float = 1.0
+    # 启动时在后台加载的集合
+    preload: list[PreloadConfig] = []
+    # 已加载集合的内存预算（字节），超过时释放最久未使用的空闲集合，为 0 时不限制
+    memory_budget: int = 0
+    # 搜索未加载的集合时等待加载的最长时间（秒），超时后返回 503，加载在后台继续进行
+    load_wait: float = 1.0
+    # 上传请求体的最大字节数，超过时返回 413；批量导入的 tar 流中为单个文件的最大字节数；为 0 时不限制
+    max_upload_size: int = 64 << 20
+    # 读取上传图片的缓冲区用完后放回池中重复使用，超过这一大小的缓冲区直接释放
+    upload_buffer_size: int = 16 << 20
+
+
 class Config(BaseSettings):
+    # 向量存储后端
+    backend: Backend = Backend.MILVUS
     milvus: MilvusConfig = MilvusConfig()
+    local: LocalConfig = LocalConfig()
+    lmdb: LmdbConfig = LmdbConfig()
+    descriptors: DescriptorConfig = DescriptorConfig()
+    extract: ExtractConfig = ExtractConfig()
+    signature: SignatureConfig = SignatureConfig()
+    server: ServerConfig = ServerConfig()
 
 
 def load_config():
@@ -1,47 +1,809 @@
+import contextlib
+import itertools
 import os
+import struct
+import threading
+import typing
 from pathlib import Path
-from herod.config import xdg_data_home
+from herod.buffer import Buffer
+from herod.config import config, xdg_data_home
+from herod.enums import Extractor, Filter
 import lmdb
 import blake3
+import numpy as np
+
+# 文件的大小与修改时间（纳秒）
+FileStat = tuple[int, int]
+
+T = typing.TypeVar("T")
+
+
+def file_stat(filename: str) -> FileStat:
+    st = os.stat(filename)
+    return st.st_size, st.st_mtime_ns
+
+
+class _ResizeLock:
+    """
+    LMDB 只能在本进程中没有活动事务时调整映射大小，
+    因此普通事务共享这个锁，调整映射大小时独占
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.active = 0
+        self.resizing = False
+
+    @contextlib.contextmanager
+    def shared(self):
+        with self.cond:
+            while self.resizing:
+                self.cond.wait()
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.active -= 1
+                if self.active == 0:
+                    self.cond.notify_all()
+
+    @contextlib.contextmanager
+    def exclusive(self):
+        with self.cond:
+            while self.resizing or self.active:
+                self.cond.wait()
+            self.resizing = True
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.resizing = False
+                self.cond.notify_all()
+
+
+class _SubDb:
+    """子数据库的句柄，压缩后重新打开数据文件时随之更新"""
+
+    def __init__(self, name: bytes):
+        self.name = name
+
+    def __get__(self, obj: "Lmdb", owner=None):
+        if obj is None:
+            return self
+        return Lmdb._dbs[(obj.collection, self.name)]
 
 
 class Lmdb:
+    """
+    集合的图片元数据
+
+    主数据库保存 图片 ID -> 文件名，file_stat 子数据库保存 文件路径 -> (大小, 修改时间, 图片 ID)，
+    filenames 子数据库保存 文件名 -> 图片 ID，用于按文件名查找、更新与删除图片。
+    signatures 子数据库保存 图片 ID -> 64 位感知哈希，signature_index 子数据库是其多索引哈希表，
+    用于在向量搜索前查找重复的图片。
+    clusters 子数据库保存 图片 ID -> (近似重复图片的分组 ID, 是否已去重)，
+    cluster_members 子数据库保存 分组 ID + 图片 ID，用于合并分组。
+    映射大小不足时自动翻倍。
+    """
+
     _env: dict[str, lmdb.Environment] = {}
+    _dbs: dict[tuple[str, bytes], typing.Any] = {}
+    _resize: dict[str, _ResizeLock] = {}
+    # 本进程中的写事务先获取这个锁，压缩时持有它阻塞写入
+    _writers: dict[str, threading.Lock] = {}
+    _lock = threading.Lock()
+
+    # 文件路径 -> (文件大小, 修改时间, 图片 ID)
+    files = _SubDb(b"file_stat")
+    # 文件名 -> 图片 ID
+    names = _SubDb(b"filenames")
+    # 图片 ID -> 感知哈希
+    signatures = _SubDb(b"signatures")
+    # 哈希的分段序号 + 分段的值 + 图片 ID -> 空
+    signature_index = _SubDb(b"signature_index")
+    # 图片 ID -> 分组 ID + 是否已去重（1 字节）
+    clusters = _SubDb(b"clusters")
+    # 分组 ID + 图片 ID -> 空
+    cluster_members = _SubDb(b"cluster_members")
 
     def __init__(self, collection: str):
         db_dir = Path(xdg_data_home()) / "herod" / "lmdb"
         if db_dir.exists() is False:
             db_dir.mkdir(parents=True)
-        if Lmdb._env.get(collection) is None:
-            Lmdb._env[collection] = lmdb.open(
-                str(db_dir / f"{collection}.mdb"), map_size=1024**3, subdir=False
-            )
+        with Lmdb._lock:
+            opened = Lmdb._env.get(collection) is None
+            if opened:
+                Lmdb._env[collection] = lmdb.open(
+                    str(db_dir / f"{collection}.mdb"),
+                    map_size=config.lmdb.map_size,
+                    subdir=False,
+                    max_dbs=16,
+                )
+                Lmdb._resize[collection] = _ResizeLock()
+                Lmdb._writers[collection] = threading.Lock()
         self.collection = collection
-        self.env = Lmdb._env[collection]
+        self.resize = Lmdb._resize[collection]
+        self.writer = Lmdb._writers[collection]
+        for db in (
+            Lmdb.files,
+            Lmdb.names,
+            Lmdb.signatures,
+            Lmdb.signature_index,
+            Lmdb.clusters,
+            Lmdb.cluster_members,
+        ):
+            self._open_db(db.name)
+        if opened:
+            self._build_names()
 
-    def record_image_id(self, image_id: int, filename: str):
-        """记录并返回图片的 ID，如果图片已经存在则返回 None"""
-        with self.env.begin(write=True) as txn:
-            digest = image_id.to_bytes(5, "big")
-            txn.put(digest[:5], filename.encode())
+    @property
+    def env(self) -> lmdb.Environment:
+        """集合的 LMDB 环境，压缩后会被替换，因此每次都从共享的字典中读取"""
+        return Lmdb._env[self.collection]
+
+    def _open_db(self, name: bytes):
+        """打开集合中的一个子数据库"""
+        key = (self.collection, name)
+        with Lmdb._lock:
+            if key not in Lmdb._dbs:
+                Lmdb._dbs[key] = self._run(
+                    lambda txn: self.env.open_db(name, txn=txn), write=True
+                )
+            return Lmdb._dbs[key]
+
+    def _run(self, func: typing.Callable[[lmdb.Transaction], T], write: bool = False) -> T:
+        """
+        在事务中执行 func，映射空间不足时扩大映射后重试
+        :param write: 是否为写事务
+        """
+        while True:
+            size = self.env.info()["map_size"]
+            try:
+                with (
+                    self.writer if write else contextlib.nullcontext(),
+                    self.resize.shared(),
+                    self.env.begin(write=write) as txn,
+                ):
+                    return func(txn)
+            except lmdb.MapFullError:
+                self._grow(size, size * 2)
+            except lmdb.MapResizedError:
+                # 其他进程扩大了映射，使用数据文件当前的大小
+                self._grow(size, 0)
+
+    def _grow(self, size: int, new_size: int):
+        """将映射大小从 size 调整为 new_size，其他线程已经调整过时跳过"""
+        with self.resize.exclusive():
+            if self.env.info()["map_size"] == size:
+                self.env.set_mapsize(new_size)
+
+    def _key(self, name: str) -> bytes:
+        key = name.encode()
+        # 超出 LMDB 键长度限制时使用其哈希值
+        if len(key) > self.env.max_key_size():
+            key = blake3.blake3(key).digest()
+        return key
+
+    def _file_key(self, filename: str) -> bytes:
+        return self._key(os.path.abspath(filename))
+
+    def _build_names(self):
+        """为旧版本建立的集合补充 文件名 -> 图片 ID 的索引"""
+
+        def build(txn: lmdb.Transaction):
+            if txn.stat(self.names)["entries"] > 0:
+                return
+            for key, value in txn.cursor():
+                # 主数据库中还保存了子数据库的名称，图片 ID 的键长度为 5
+                if len(key) == 5:
+                    txn.put(self._key(bytes(value).decode()), key, db=self.names)
+
+        self._run(build, write=True)
+
+    def _put_image(
+        self,
+        txn: lmdb.Transaction,
+        image_id: int,
+        filename: str,
+        stat: FileStat | None,
+        signature: int | None = None,
+    ):
+        digest = image_id.to_bytes(5, "big")
+        old = txn.get(digest)
+        if old is not None and old != filename.encode():
+            # 图片改名后删除旧文件名的索引，旧文件名已指向其他图片时保留
+            old_key = self._key(old.decode())
+            if txn.get(old_key, db=self.names) == digest:
+                txn.delete(old_key, db=self.names)
+        txn.put(digest, filename.encode())
+        txn.put(self._key(filename), digest, db=self.names)
+        if stat is not None:
+            value = struct.pack(">QQ", *stat) + digest
+            txn.put(self._file_key(filename), value, db=self.files)
+        if signature is not None:
+            self._put_signature(txn, digest, signature)
+
+    def _put_signature(self, txn: lmdb.Transaction, digest: bytes, signature: int):
+        self._delete_signature(txn, digest)
+        txn.put(digest, signature.to_bytes(8, "big"), db=self.signatures)
+        for key in signature_keys(signature, digest):
+            txn.put(key, b"", db=self.signature_index)
+
+    def _delete_signature(self, txn: lmdb.Transaction, digest: bytes):
+        old = txn.get(digest, db=self.signatures)
+        if old is not None:
+            for key in signature_keys(int.from_bytes(old, "big"), digest):
+                txn.delete(key, db=self.signature_index)
+            txn.delete(digest, db=self.signatures)
+
+    def record_image_id(
+        self,
+        image_id: int,
+        filename: str,
+        stat: FileStat | None = None,
+        signature: int | None = None,
+    ):
+        """
+        记录图片的 ID
+        :param image_id: 图片 ID
+        :param filename: 文件名
+        :param stat: 文件的大小与修改时间，用于下次跳过未修改的文件
+        :param signature: 图片的感知哈希，为 None 时保留原有的哈希
+        """
+        self.record_image_ids([(image_id, filename, stat, signature)])
+
+    def record_image_ids(
+        self, records: typing.Iterable[tuple[int, str, FileStat | None, int | None]]
+    ):
+        """在同一个事务中批量记录多张图片的 (ID, 文件名, 文件信息, 感知哈希)"""
+        # 映射空间不足时整个事务会重试，因此先取出所有记录
+        records = list(records)
+
+        def put(txn: lmdb.Transaction):
+            for image_id, filename, stat, signature in records:
+                self._put_image(txn, image_id, filename, stat, signature)
+
+        self._run(put, write=True)
 
     def get_image_by_id(self, image_id: int) -> bytes | None:
-        with self.env.begin() as txn:
-            return txn.get(image_id.to_bytes(5, "big"))
+        return self.get_images_by_ids([image_id])[0]
+
+    def get_images_by_ids(self, image_ids: typing.Iterable[int]) -> list[bytes | None]:
+        """在同一个事务中查找多张图片"""
+        keys = [image_id.to_bytes(5, "big") for image_id in image_ids]
+        return self._run(lambda txn: [txn.get(key) for key in keys])
+
+    def find_signatures(self, signature: int, distance: int) -> list[tuple[int, int]]:
+        """
+        查找感知哈希与 signature 的汉明距离不超过 distance 的图片
+
+        哈希被分为 4 段，两个哈希的距离不超过 distance 时至少有一段的距离不超过 distance // 4，
+        因此只需要在每一段中枚举这个范围内的值，再用完整的哈希验证候选图片。
+        :return: 按距离升序排列的 (图片 ID, 汉明距离)
+        """
+        radius = distance // SIGNATURE_SEGMENTS
+        prefixes = [
+            bytes([i]) + value.to_bytes(2, "big")
+            for i, segment in enumerate(signature_segments(signature))
+            for value in _neighbors(segment, radius)
+        ]
+
+        def find(txn: lmdb.Transaction):
+            candidates = set()
+            cursor = txn.cursor(db=self.signature_index)
+            for prefix in prefixes:
+                if not cursor.set_range(prefix):
+                    continue
+                for key in cursor.iternext(values=False):
+                    if key[:3] != prefix:
+                        break
+                    candidates.add(key[3:])
+            found = []
+            for digest in candidates:
+                value = txn.get(digest, db=self.signatures)
+                if value is None:
+                    continue
+                d = (int.from_bytes(value, "big") ^ signature).bit_count()
+                if d <= distance:
+                    found.append((int.from_bytes(digest, "big"), d))
+            return found
+
+        return sorted(self._run(find), key=lambda item: (item[1], item[0]))
+
+    def _cluster_of(self, txn: lmdb.Transaction, digest: bytes) -> bytes:
+        """图片所在的分组，没有分组时单独成为一组"""
+        value = txn.get(digest, db=self.clusters)
+        if value is not None:
+            return value[:5]
+        txn.put(digest, digest + b"\0", db=self.clusters)
+        txn.put(digest + digest, b"", db=self.cluster_members)
+        return digest
+
+    def _members(self, txn: lmdb.Transaction, cluster: bytes) -> list[bytes]:
+        cursor = txn.cursor(db=self.cluster_members)
+        if not cursor.set_range(cluster):
+            return []
+        members = []
+        for key in cursor.iternext(values=False):
+            if key[:5] != cluster:
+                break
+            members.append(key[5:])
+        return members
+
+    def record_clusters(
+        self, image_ids: typing.Iterable[int], pairs: typing.Iterable[tuple[int, int]]
+    ):
+        """
+        在同一个事务中将一批图片标记为已去重，并合并近似重复图片所在的分组
+        :param image_ids: 已去重的图片
+        :param pairs: 近似重复的图片对
+        """
+        image_ids = [image_id.to_bytes(5, "big") for image_id in image_ids]
+        pairs = [(a.to_bytes(5, "big"), b.to_bytes(5, "big")) for a, b in pairs]
+
+        def put(txn: lmdb.Transaction):
+            for digest in image_ids:
+                txn.put(digest, self._cluster_of(txn, digest) + b"\1", db=self.clusters)
+            for a, b in pairs:
+                ca, cb = self._cluster_of(txn, a), self._cluster_of(txn, b)
+                if ca == cb:
+                    continue
+                ma, mb = self._members(txn, ca), self._members(txn, cb)
+                # 将较小的分组合并到较大的分组中，分组 ID 不变
+                if (len(ma), cb) > (len(mb), ca):
+                    ca, cb, ma, mb = cb, ca, mb, ma
+                self._move_members(txn, ma, ca, cb)
+
+        self._run(put, write=True)
+
+    def _move_members(
+        self, txn: lmdb.Transaction, members: list[bytes], source: bytes, target: bytes
+    ):
+        """将分组 source 中的图片移动到分组 target 中，保留去重标记"""
+        for member in members:
+            flag = txn.get(member, db=self.clusters)[5:]
+            txn.put(member, target + flag, db=self.clusters)
+            txn.delete(source + member, db=self.cluster_members)
+            txn.put(target + member, b"", db=self.cluster_members)
+
+    def _delete_cluster(self, txn: lmdb.Transaction, digest: bytes):
+        """将图片从所在的分组中移除"""
+        value = txn.get(digest, db=self.clusters)
+        if value is None:
+            return
+        cluster = value[:5]
+        txn.delete(digest, db=self.clusters)
+        txn.delete(cluster + digest, db=self.cluster_members)
+        # 分组 ID 就是被删除的图片时，图片重新导入后会被当作这个分组的成员，
+        # 因此改用剩余图片中的一张作为分组 ID
+        members = self._members(txn, cluster) if cluster == digest else []
+        if members:
+            self._move_members(txn, members, cluster, members[0])
+
+    def get_deduplicated(self, image_ids: typing.Iterable[int]) -> list[bool]:
+        """图片是否已经去重"""
+        keys = [image_id.to_bytes(5, "big") for image_id in image_ids]
+        values = self._run(lambda txn: [txn.get(key, db=self.clusters) for key in keys])
+        return [value is not None and value[5:] == b"\1" for value in values]
+
+    def get_cluster(self, image_id: int) -> list[int]:
+        """与图片在同一分组中的所有图片，图片没有分组时只返回其本身"""
+        digest = image_id.to_bytes(5, "big")
+
+        def get(txn: lmdb.Transaction):
+            value = txn.get(digest, db=self.clusters)
+            if value is None:
+                return [digest]
+            return self._members(txn, value[:5])
+
+        return [int.from_bytes(member, "big") for member in self._run(get)]
+
+    def iter_clusters(self, min_size: int = 2) -> typing.Iterator[tuple[int, list[int]]]:
+        """遍历图片数量不少于 min_size 的分组，返回 (分组 ID, 图片 ID)"""
+
+        def scan(txn: lmdb.Transaction):
+            clusters = []
+            cluster, members = None, []
+            for key in txn.cursor(db=self.cluster_members).iternext(values=False):
+                if key[:5] != cluster:
+                    if len(members) >= min_size:
+                        clusters.append((cluster, members))
+                    cluster, members = key[:5], []
+                members.append(key[5:])
+            if len(members) >= min_size:
+                clusters.append((cluster, members))
+            return clusters
+
+        for cluster, members in self._run(scan):
+            yield int.from_bytes(cluster, "big"), [
+                int.from_bytes(member, "big") for member in members
+            ]
+
+    def reset_clusters(self):
+        """删除所有的分组，之后需要重新去重"""
+
+        def drop(txn: lmdb.Transaction):
+            txn.drop(self.clusters, delete=False)
+            txn.drop(self.cluster_members, delete=False)
+
+        self._run(drop, write=True)
+
+    def remove_images(self, image_ids: typing.Iterable[int]) -> list[int]:
+        """
+        在同一个事务中删除多张图片的所有记录：文件名、文件信息、感知哈希与分组
+        :return: 存在并被删除的图片 ID
+        """
+        digests = [image_id.to_bytes(5, "big") for image_id in image_ids]
+
+        def remove(txn: lmdb.Transaction):
+            removed = []
+            for digest in digests:
+                filename = txn.get(digest)
+                if filename is None:
+                    continue
+                txn.delete(digest)
+                filename = bytes(filename).decode()
+                # 文件名已指向其他图片时保留
+                key = self._key(filename)
+                if txn.get(key, db=self.names) == digest:
+                    txn.delete(key, db=self.names)
+                key = self._file_key(filename)
+                value = txn.get(key, db=self.files)
+                if value is not None and value[16:] == digest:
+                    txn.delete(key, db=self.files)
+                self._delete_signature(txn, digest)
+                self._delete_cluster(txn, digest)
+                removed.append(int.from_bytes(digest, "big"))
+            return removed
+
+        return self._run(remove, write=True)
+
+    def compact(self) -> tuple[int, int]:
+        """
+        压缩数据文件，回收删除图片后空闲的空间
+
+        复制数据文件期间只阻塞本进程的写入，搜索可以继续进行；替换文件时短暂阻塞读取。
+        其他进程也打开了这个集合时无法替换文件，会抛出 RuntimeError。
+        :return: 压缩前后数据文件的大小（字节）
+        """
+        path = self.env.path()
+        tmp = path + ".compact"
+        with self.writer:
+            self.env.reader_check()
+            pids = {
+                int(line.split()[0])
+                for line in self.env.readers().splitlines()[1:]
+                if line.strip()
+            }
+            if pids - {os.getpid()}:
+                raise RuntimeError(f"集合 {self.collection} 正在被其他进程使用，无法压缩")
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            self.env.copy(tmp, compact=True)
+            before, after = os.path.getsize(path), os.path.getsize(tmp)
+            with self.resize.exclusive():
+                map_size = self.env.info()["map_size"]
+                self.env.close()
+                os.replace(tmp, path)
+                env = lmdb.open(path, map_size=map_size, subdir=False, max_dbs=16)
+                Lmdb._env[self.collection] = env
+                for key in [key for key in Lmdb._dbs if key[0] == self.collection]:
+                    Lmdb._dbs[key] = env.open_db(key[1])
+        return before, after
+
+    def get_image_by_name(self, filename: str) -> int | None:
+        """
+        根据记录的文件名查找图片，不检查文件是否被修改
+        :param filename: 导入时的文件名，本地文件也可以使用其绝对路径
+        """
+
+        def get(txn: lmdb.Transaction):
+            value = txn.get(self._key(filename), db=self.names)
+            if value is not None:
+                return int.from_bytes(value, "big")
+            value = txn.get(self._file_key(filename), db=self.files)
+            # 图片被删除后，旧文件名的文件信息可能仍然保留
+            if value is not None and txn.get(value[16:]) is not None:
+                return int.from_bytes(value[16:], "big")
+            return None
+
+        return self._run(get)
+
+    def get_image_by_file(self, filename: str, stat: FileStat) -> int | None:
+        """
+        根据文件路径、大小与修改时间查找已经索引过的图片
+        :return: 文件未被修改时返回图片 ID，否则返回 None
+        """
+        return self.get_images_by_files([(filename, stat)])[0]
+
+    def get_images_by_files(
+        self, files: typing.Iterable[tuple[str, FileStat]]
+    ) -> list[int | None]:
+        """在同一个事务中查找多个未被修改的文件，返回值与 get_image_by_file 相同"""
+        files = [(self._file_key(filename), stat) for filename, stat in files]
+
+        def get(txn: lmdb.Transaction):
+            values = [txn.get(key, db=self.files) for key, _ in files]
+            # 图片被删除后，旧文件名的文件信息可能仍然保留，需要重新导入
+            return [
+                value if value is not None and txn.get(value[16:]) is not None else None
+                for value in values
+            ]
+
+        values = self._run(get)
+        return [
+            int.from_bytes(value[16:], "big")
+            if value is not None and struct.unpack(">QQ", value[:16]) == stat
+            else None
+            for value, (_, stat) in zip(values, files)
+        ]
 
     def delete(self):
         """删除集合"""
         os.remove(self.env.path())
         os.remove(self.env.path() + "-lock")
         del Lmdb._env[self.collection]
+        del Lmdb._resize[self.collection]
+        del Lmdb._writers[self.collection]
+        for key in [key for key in Lmdb._dbs if key[0] == self.collection]:
+            del Lmdb._dbs[key]
+
+
+class IndexedImages:
+    """
+    只读地查询集合中已索引的图片，用于导入图片的工作进程在解码前跳过已索引的图片
+
+    不打开子数据库，也不进行任何写入；集合被压缩后仍然读取旧的数据文件，只会少跳过一些图片。
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: 集合的 LMDB 数据文件，即 Lmdb.env.path()
+        """
+        self.env = lmdb.open(path, subdir=False, readonly=True, max_dbs=16)
+
+    def contains(self, image_id: int) -> bool:
+        while True:
+            try:
+                with self.env.begin() as txn:
+                    return txn.get(image_id.to_bytes(5, "big")) is not None
+            except lmdb.MapResizedError:
+                # 写入的进程扩大了映射，使用数据文件当前的大小
+                self.env.set_mapsize(0)
+
+
+# 感知哈希在多索引哈希表中的分段数，每段 16 位
+SIGNATURE_SEGMENTS = 4
+
+
+def signature_segments(signature: int) -> list[int]:
+    """将 64 位感知哈希从高位到低位分为 4 段"""
+    return [(signature >> (48 - 16 * i)) & 0xFFFF for i in range(SIGNATURE_SEGMENTS)]
+
+
+def signature_keys(signature: int, digest: bytes) -> list[bytes]:
+    """图片在多索引哈希表中的键"""
+    return [
+        bytes([i]) + segment.to_bytes(2, "big") + digest
+        for i, segment in enumerate(signature_segments(signature))
+    ]
+
+
+def _neighbors(value: int, radius: int) -> list[int]:
+    """与 16 位整数 value 的汉明距离不超过 radius 的所有值"""
+    result = [value]
+    for bits in range(1, radius + 1):
+        for flips in itertools.combinations(range(16), bits):
+            result.append(value ^ sum(1 << bit for bit in flips))
+    return result
+
+
+def descriptor_dir() -> Path:
+    if config.descriptors.path:
+        return Path(config.descriptors.path)
+    return Path(xdg_data_home()) / "herod" / "descriptors"
+
+
+def descriptor_variant(extractor: Extractor, filter: Filter, limit: int) -> bytes:
+    """特征向量的提取参数，不同参数提取的特征向量分开保存"""
+    return f"{Extractor(extractor).value}:{Filter(filter).value}:{limit}:".encode()
+
+
+class DescriptorStore:
+    """
+    特征向量存储
+
+    以 float16 保存每张图片提取出的特征向量与文件名，键为 提取参数 + 图片 ID，
+    重建集合时可以直接读取，不需要重新解码图片与提取特征。
+    特征点坐标以 float32 保存在 keypoints 子数据库中，用于搜索结果的几何重排。
+    与集合的 LMDB 分开存放，删除集合时默认保留。
+    """
+
+    _env: dict[str, lmdb.Environment] = {}
+    _keypoints: dict[str, typing.Any] = {}
+    _lock = threading.Lock()
+
+    def __init__(self, collection: str):
+        db_dir = descriptor_dir()
+        if db_dir.exists() is False:
+            db_dir.mkdir(parents=True)
+        with DescriptorStore._lock:
+            if DescriptorStore._env.get(collection) is None:
+                # 特征向量可以重新提取，因此不在每次提交时同步到磁盘
+                DescriptorStore._env[collection] = lmdb.open(
+                    str(db_dir / f"{collection}.mdb"),
+                    map_size=1 << 40,
+                    subdir=False,
+                    sync=False,
+                    max_dbs=2,
+                )
+                DescriptorStore._keypoints[collection] = DescriptorStore._env[
+                    collection
+                ].open_db(b"keypoints")
+        self.collection = collection
+        self.env = DescriptorStore._env[collection]
+        self.keypoints = DescriptorStore._keypoints[collection]
 
+    @staticmethod
+    def exists(collection: str) -> bool:
+        return (descriptor_dir() / f"{collection}.mdb").exists()
+
+    def put(
+        self,
+        variant: bytes,
+        image_id: int,
+        filename: str,
+        des: np.ndarray,
+        points: np.ndarray | None = None,
+    ):
+        """
+        保存一张图片的特征向量
+        :param variant: 提取参数，由 descriptor_variant 生成
+        :param image_id: 图片 ID
+        :param filename: 文件名
+        :param des: 特征向量，形状为 (n, dim)
+        :param points: 特征点坐标，形状为 (n, 2)
+        """
+        name = filename.encode()
+        key = variant + image_id.to_bytes(5, "big")
+        value = (
+            struct.pack(">HI", des.shape[1], len(name))
+            + name
+            + np.ascontiguousarray(des, dtype=np.float16).tobytes()
+        )
+        with self.env.begin(write=True) as txn:
+            txn.put(key, value)
+            if points is not None:
+                points = np.ascontiguousarray(points, dtype=np.float32)
+                txn.put(key, points.tobytes(), db=self.keypoints)
+
+    @staticmethod
+    def _unpack(value: bytes) -> tuple[str, np.ndarray]:
+        dim, length = struct.unpack(">HI", value[:6])
+        name = bytes(value[6 : 6 + length]).decode()
+        des = np.frombuffer(value, dtype=np.float16, offset=6 + length)
+        return name, des.reshape(-1, dim).astype(np.float32)
+
+    def get(self, variant: bytes, image_id: int) -> tuple[str, np.ndarray] | None:
+        """读取一张图片的文件名与特征向量"""
+        with self.env.begin() as txn:
+            value = txn.get(variant + image_id.to_bytes(5, "big"))
+        if value is None:
+            return None
+        return self._unpack(value)
+
+    def get_descriptors(
+        self, variant: bytes, image_ids: typing.Iterable[int]
+    ) -> list[np.ndarray | None]:
+        """在同一个事务中读取多张图片的特征向量，不存在时为 None"""
+        with self.env.begin() as txn:
+            values = [txn.get(variant + image_id.to_bytes(5, "big")) for image_id in image_ids]
+        return [None if value is None else self._unpack(value)[1] for value in values]
+
+    def iter_ids(self, variant: bytes) -> typing.Iterator[int]:
+        """按顺序遍历某一提取参数下的所有图片 ID，不读取特征向量"""
+        with self.env.begin() as txn:
+            cursor = txn.cursor()
+            if not cursor.set_range(variant):
+                return
+            for key in cursor.iternext(values=False):
+                if key[: len(variant)] != variant:
+                    break
+                yield int.from_bytes(key[len(variant) :], "big")
 
-def get_image_hash(file: str | bytes) -> int:
+    def get_many(
+        self, variant: bytes, image_ids: typing.Iterable[int]
+    ) -> list[tuple[np.ndarray, np.ndarray] | None]:
+        """
+        在同一个事务中读取多张图片的特征点坐标与特征向量
+        :return: 与 image_ids 一一对应的 (特征点坐标, 特征向量)，没有保存特征点时为 None
+        """
+        result = []
+        with self.env.begin() as txn:
+            for image_id in image_ids:
+                key = variant + image_id.to_bytes(5, "big")
+                points = txn.get(key, db=self.keypoints)
+                value = txn.get(key) if points is not None else None
+                if value is None:
+                    result.append(None)
+                    continue
+                _, des = self._unpack(value)
+                points = np.frombuffer(points, dtype=np.float32).reshape(-1, 2)
+                result.append((points, des))
+        return result
+
+    def iter(self, variant: bytes) -> typing.Iterator[tuple[int, str, np.ndarray]]:
+        """按图片 ID 顺序遍历某一提取参数下的所有 (图片 ID, 文件名, 特征向量)"""
+        with self.env.begin(buffers=True) as txn:
+            cursor = txn.cursor()
+            if not cursor.set_range(variant):
+                return
+            for key, value in cursor:
+                if bytes(key[: len(variant)]) != variant:
+                    break
+                image_id = int.from_bytes(key[len(variant) :], "big")
+                yield image_id, *self._unpack(value)
+
+    def variants(self) -> list[bytes]:
+        """所有保存过特征向量的提取参数"""
+        variants = []
+        with self.env.begin() as txn:
+            cursor = txn.cursor()
+            found = cursor.first()
+            while found:
+                # 键为 提取参数 + 5 字节的图片 ID，提取参数的格式固定，不会互为前缀
+                variant = cursor.key()[:-5]
+                if not variant.endswith(b":"):
+                    # 主数据库中还保存着子数据库的名称，例如 keypoints
+                    found = cursor.next()
+                    continue
+                variants.append(variant)
+                found = cursor.set_range(variant + b"\xff" * 6)
+        return variants
+
+    def remove(self, image_ids: typing.Iterable[int]):
+        """在同一个事务中删除多张图片在所有提取参数下的特征向量与特征点"""
+        digests = [image_id.to_bytes(5, "big") for image_id in image_ids]
+        variants = self.variants()
+        with self.env.begin(write=True) as txn:
+            for variant in variants:
+                for digest in digests:
+                    txn.delete(variant + digest)
+                    txn.delete(variant + digest, db=self.keypoints)
+
+    def close(self):
+        """将数据同步到磁盘"""
+        self.env.sync(True)
+
+    def delete(self):
+        """删除集合的特征向量"""
+        with DescriptorStore._lock:
+            env = DescriptorStore._env.pop(self.collection, None)
+            DescriptorStore._keypoints.pop(self.collection, None)
+        if env is not None:
+            env.close()
+        path = descriptor_dir() / f"{self.collection}.mdb"
+        os.remove(path)
+        os.remove(str(path) + "-lock")
+
+
+# 超过这个大小（字节）的数据使用多线程计算哈希，更小的数据启动线程的开销大于收益
+PARALLEL_HASH_SIZE = 1 << 20
+
+
+def get_image_hash(file: str | Buffer) -> int:
+    """
+    计算图片的 ID，即 BLAKE3 哈希的前 5 字节，较大的图片使用多线程计算
+    :param file: 图片路径或图片数据，图片数据直接计算，不会被复制
+    """
     if isinstance(file, str):
-        with open(file, "rb") as f:
-            data = f.read()
-            digest = blake3.blake3(data).digest()
-            return int.from_bytes(digest[:5], "big")
+        # 由 blake3 映射文件，不经过 Python 读取
+        hasher = blake3.blake3(max_threads=blake3.blake3.AUTO)
+        digest = hasher.update_mmap(file).digest()
+        return int.from_bytes(digest[:5], "big")
     else:
-        digest = blake3.blake3(file).digest()
+        # 导入与搜索时的文件都已映射到内存中，以 Buffer 的形式传入
+        threads = blake3.blake3.AUTO if memoryview(file).nbytes >= PARALLEL_HASH_SIZE else 1
+        digest = blake3.blake3(file, max_threads=threads).digest()
         return int.from_bytes(digest[:5], "big")
@@ -0,0 +1,270 @@
+import multiprocessing
+import time
+import typing
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import numpy as np
+
+from herod.database import DescriptorStore, Lmdb, descriptor_variant
+from herod.enums import Extractor, Filter
+from herod.indexer import MAX_SEARCH_VECTORS
+from herod.partition import PartitionedStore
+from herod.store import SearchHits, VectorStore, open_store
+
+# 每个工作进程中打开的向量存储与搜索的分区
+_store: VectorStore | None = None
+_partitions: list[str] | None = None
+
+
+def _init_worker(collection: str, partitions: list[str] | None):
+    global _store, _partitions
+    _store = open_store(collection)
+    _partitions = partitions
+    if partitions and isinstance(_store, PartitionedStore):
+        _store.load(partitions)
+    else:
+        _store.load()
+
+
+def _search(vectors: np.ndarray, search_list: int, limit: int) -> SearchHits:
+    """在工作进程中搜索，超过单次搜索向量数上限时分多次搜索"""
+    parts = []
+    for i in range(0, len(vectors), MAX_SEARCH_VECTORS):
+        chunk = vectors[i : i + MAX_SEARCH_VECTORS]
+        if _partitions:
+            parts.append(_store.search(chunk, search_list, limit, _partitions))
+        else:
+            parts.append(_store.search(chunk, search_list, limit))
+    return SearchHits.concat(parts)
+
+
+def sample_rows(des: np.ndarray, count: int) -> np.ndarray:
+    """从图片的特征向量中均匀地选取 count 个"""
+    if len(des) <= count:
+        return des
+    return des[np.linspace(0, len(des) - 1, count).astype(np.intp)]
+
+
+def find_pairs(
+    image_ids: np.ndarray, sizes: np.ndarray, hits: SearchHits, min_ratio: float
+) -> list[tuple[int, int, float]]:
+    """
+    根据自连接的搜索结果找出近似重复的图片对
+
+    对每张查询图片的每个特征向量，取除图片自身以外距离最近的匹配，
+    统计最近匹配属于另一张图片的比例，比例不低于 min_ratio 时认为两张图片近似重复。
+    :param image_ids: 查询图片的 ID
+    :param sizes: 每张查询图片的特征向量数量
+    :param hits: 所有查询向量的搜索结果，按图片顺序排列
+    :param min_ratio: 判定为近似重复的最低比例
+    :return: (查询图片 ID, 近似重复的图片 ID, 比例)
+    """
+    if len(hits.images) == 0:
+        return []
+    owners = np.repeat(np.arange(len(image_ids)), sizes)
+    vectors = np.repeat(np.arange(len(owners)), np.diff(hits.offsets))
+    # 排除匹配到图片自身的结果，每个查询向量的匹配已按距离升序排列
+    keep = np.flatnonzero(hits.images != image_ids[owners[vectors]])
+    if len(keep) == 0:
+        return []
+    _, first = np.unique(vectors[keep], return_index=True)
+    nearest = keep[first]
+    votes = np.stack([owners[vectors[nearest]], hits.images[nearest]], axis=1)
+    votes, counts = np.unique(votes, axis=0, return_counts=True)
+    ratios = counts / sizes[votes[:, 0]]
+    found = np.flatnonzero(ratios >= min_ratio)
+    return [
+        (int(image_ids[votes[i, 0]]), int(votes[i, 1]), float(ratios[i])) for i in found
+    ]
+
+
+class DedupResult:
+    def __init__(self, images: int, pairs: list[tuple[int, int, float]], missing: int):
+        """
+        一批图片的去重结果
+        :param images: 本批次去重的图片数量
+        :param pairs: 找到的近似重复图片对
+        :param missing: 没有保存特征向量而跳过的图片数量
+        """
+        self.images = images
+        self.pairs = pairs
+        self.missing = missing
+
+
+class DedupJob:
+    """
+    在整个集合中查找近似重复的图片并分组
+
+    读取导入时保存的特征向量，每批图片各选取 sample 个特征向量合并为一次搜索（自连接），
+    再按匹配比例找出近似重复的图片对，使用并查集合并为分组，分组保存在集合的 LMDB 中。
+    每批图片的分组与去重标记在同一个事务中提交，中断后重新运行只会处理尚未去重的图片，
+    之后新导入的图片也只需要增量处理。
+
+    搜索在进程池中并行进行：
+    - process：每个工作进程加载整个集合，不同批次由不同的进程搜索
+    - partition：每个工作进程只加载分区集合中的一个分区，同一批次在所有分区中搜索后合并结果，
+      每个进程的内存占用只与单个分区有关
+    """
+
+    def __init__(
+        self,
+        collection: str,
+        extractor: Extractor = Extractor.SURF,
+        filter: Filter = Filter.FUFP,
+        limit: int = 500,
+        sample: int = 50,
+        search_list: int = 16,
+        match_limit: int = 5,
+        min_ratio: float = 0.3,
+        batch: int = 256,
+        workers: int | None = None,
+        parallel: str = "process",
+        partitions: list[str] | None = None,
+    ):
+        """
+        :param collection: 集合名称
+        :param extractor: 导入时使用的特征点提取算法
+        :param filter: 导入时使用的特征点均匀化算法
+        :param limit: 导入时使用的特征点数量
+        :param sample: 每张图片参与搜索的特征向量数量
+        :param search_list: 搜索列表大小
+        :param match_limit: 每个特征向量的匹配数量，包括图片自身，只使用其中除自身以外最近的匹配
+        :param min_ratio: 判定为近似重复的最低匹配比例
+        :param batch: 每次合并搜索的图片数量
+        :param workers: process 模式下的工作进程数，默认为 CPU 核心数
+        :param parallel: 并行方式，process 或 partition
+        :param partitions: 只在指定的分区中搜索，默认为所有分区
+        """
+        if parallel not in ("process", "partition"):
+            raise ValueError(f"未知的并行方式 {parallel}，可选：process、partition")
+        if not DescriptorStore.exists(collection):
+            raise ValueError(f"集合 {collection} 没有保存特征向量")
+        self.collection = collection
+        self.variant = descriptor_variant(extractor, filter, limit)
+        self.sample = sample
+        self.search_list = search_list
+        self.match_limit = match_limit
+        self.min_ratio = min_ratio
+        self.batch = batch
+        self.workers = workers or multiprocessing.cpu_count()
+        self.parallel = parallel
+        self.descriptors = DescriptorStore(collection)
+        self.mdb = Lmdb(collection)
+
+        store = open_store(collection)
+        if isinstance(store, PartitionedStore):
+            self.partitions = partitions or store.partitions
+        elif partitions or parallel == "partition":
+            raise ValueError(f"集合 {collection} 没有分区")
+        else:
+            self.partitions = None
+
+    def pending(self) -> typing.Iterator[list[int]]:
+        """按批次返回保存了特征向量但尚未去重的图片"""
+        chunk = []
+        for image_id in self.descriptors.iter_ids(self.variant):
+            chunk.append(image_id)
+            if len(chunk) == self.batch * 4:
+                yield from self._filter(chunk)
+                chunk = []
+        if chunk:
+            yield from self._filter(chunk)
+
+    def _filter(self, image_ids: list[int]) -> typing.Iterator[list[int]]:
+        done = self.mdb.get_deduplicated(image_ids)
+        image_ids = [image_id for image_id, d in zip(image_ids, done) if not d]
+        for i in range(0, len(image_ids), self.batch):
+            yield image_ids[i : i + self.batch]
+
+    def _queries(self, image_ids: list[int]):
+        """读取一批图片的特征向量并采样"""
+        des_list = self.descriptors.get_descriptors(self.variant, image_ids)
+        found = [(i, des) for i, des in zip(image_ids, des_list) if des is not None]
+        ids = np.array([i for i, _ in found], dtype=np.int64)
+        samples = [sample_rows(des, self.sample) for _, des in found]
+        sizes = np.array([len(des) for des in samples], dtype=np.int64)
+        vectors = np.concatenate(samples) if samples else None
+        return ids, sizes, vectors, len(image_ids) - len(found)
+
+    def _executors(self) -> list[ProcessPoolExecutor]:
+        # 使用 spawn 启动工作进程，避免 fork 时继承 gRPC 连接
+        context = multiprocessing.get_context("spawn")
+        if self.parallel == "partition":
+            return [
+                ProcessPoolExecutor(
+                    max_workers=1,
+                    mp_context=context,
+                    initializer=_init_worker,
+                    initargs=(self.collection, [partition]),
+                )
+                for partition in self.partitions
+            ]
+        return [
+            ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=context,
+                initializer=_init_worker,
+                initargs=(self.collection, self.partitions),
+            )
+        ]
+
+    def _submit(self, executors: list[ProcessPoolExecutor], vectors) -> list[Future]:
+        return [
+            executor.submit(_search, vectors, self.search_list, self.match_limit)
+            for executor in executors
+        ]
+
+    def run(self) -> typing.Iterator[DedupResult]:
+        """处理所有尚未去重的图片，每完成一批返回一次结果"""
+        executors = self._executors()
+        # 同时进行搜索的批次数，保证每个工作进程都有任务
+        depth = self.workers * 2 if self.parallel == "process" else 2
+        inflight: list[tuple[list[int], tuple, list[Future]]] = []
+        try:
+            for image_ids in self.pending():
+                ids, sizes, vectors, missing = self._queries(image_ids)
+                futures = (
+                    self._submit(executors, vectors) if vectors is not None else []
+                )
+                inflight.append((image_ids, (ids, sizes, missing), futures))
+                if len(inflight) >= depth:
+                    yield self._finish(*inflight.pop(0))
+            while inflight:
+                yield self._finish(*inflight.pop(0))
+        finally:
+            for executor in executors:
+                executor.shutdown(cancel_futures=True)
+
+    def _finish(self, image_ids: list[int], queries: tuple, futures: list[Future]):
+        ids, sizes, missing = queries
+        pairs = []
+        if futures:
+            hits = SearchHits.merge(
+                [future.result() for future in futures], self.match_limit
+            )
+            pairs = find_pairs(ids, sizes, hits, self.min_ratio)
+        # 没有特征向量的图片也标记为已去重，避免每次重新读取
+        self.mdb.record_clusters(image_ids, [(a, b) for a, b, _ in pairs])
+        return DedupResult(len(image_ids), pairs, missing)
+
+
+class DedupStats:
+    def __init__(self):
+        self.start = time.monotonic()
+        self.images = 0
+        self.pairs = 0
+        self.missing = 0
+
+    def update(self, result: DedupResult):
+        self.images += result.images
+        self.pairs += len(result.pairs)
+        self.missing += result.missing
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.start
+
+    @property
+    def rate(self) -> float:
+        """每秒处理的图片数"""
+        return self.images / max(self.elapsed, 1e-9)
@@ -0,0 +1,28 @@
+from enum import Enum
+
+
+class Extractor(str, Enum):
+    SURF = "SURF"
+    SIFT = "SIFT"
+
+
+class Filter(str, Enum):
+    FUFP = "FUFP"
+    QUAD = "QUAD"
+
+
+class Backend(str, Enum):
+    MILVUS = "milvus"
+    LOCAL = "local"
+
+
+class Precision(str, Enum):
+    FLOAT32 = "float32"
+    FLOAT16 = "float16"
+    INT8 = "int8"
+    BINARY = "binary"
+
+
+class PartitionKey(str, Enum):
+    DATE = "date"
+    SOURCE = "source"
@@ -1,21 +1,60 @@
 import math
+import struct
+import threading
 import typing
-from enum import Enum
+from concurrent.futures import ThreadPoolExecutor
 import cv2
+import numpy as np
+from herod.buffer import Buffer, map_file
+from herod.config import config
+from herod.enums import Extractor, Filter
+from herod.metrics import NULL_SPANS, Spans
 
+# 解码时缩小的倍数与对应的读取模式，JPEG 会直接在 DCT 阶段缩小，不需要解码完整的像素
+REDUCED_FLAGS = {
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+}
+# JPEG 中记录图片尺寸的 SOF 段
+_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
 
-class Extractor(str, Enum):
-    SURF = "SURF"
-    SIFT = "SIFT"
+# 并行处理分块的线程池，每种线程数共用一个
+_tile_executors: dict[int, ThreadPoolExecutor] = {}
+_tile_lock = threading.Lock()
 
 
-class Filter(str, Enum):
-    FUFP = "FUFP"
-    QUAD = "QUAD"
+def _tile_map(func, items: list, workers: int) -> list:
+    """并行处理分块，workers 不大于 1 时在当前线程中依次处理"""
+    if workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    with _tile_lock:
+        executor = _tile_executors.get(workers)
+        if executor is None:
+            executor = _tile_executors[workers] = ThreadPoolExecutor(
+                workers, thread_name_prefix="herod-tile"
+            )
+    return list(executor.map(func, items))
 
 
 class FeatureExtractor:
-    def __init__(self, name: Extractor, filter: Filter):
+    def __init__(
+        self,
+        name: Extractor,
+        filter: Filter,
+        tiled: bool | None = None,
+        tile_workers: int | None = None,
+    ):
+        """
+        :param name: 特征点提取算法
+        :param filter: 特征点均匀化算法
+        :param tiled: 是否对超长或超大的图片分块提取特征点，默认使用配置文件中的设置
+        :param tile_workers: 并行处理分块的线程数，默认使用配置文件中的设置
+        """
+        self.tiled = config.extract.tiled if tiled is None else tiled
+        self.tile_workers = (
+            config.extract.tile_workers if tile_workers is None else tile_workers
+        )
         match name:
             case Extractor.SURF:
                 # TODO: upRight 设置为 True，忽略方向来获得更快的计算速度？
@@ -25,32 +64,257 @@ class FeatureExtractor:
 
         match filter:
             case Filter.FUFP:
-                self.filter = fufp_extract
+                self.filter = fufp_extract_indices
             case Filter.QUAD:
-                self.filter = quad_filter
+                self.filter = quad_filter_indices
+
+    @property
+    def dim(self) -> int:
+        """特征向量的维度"""
+        return self.extractor.descriptorSize()
+
+    def target_scale(self, width: int, height: int) -> float:
+        """提取特征点前图片的缩放比例"""
+        if not self.tiled:
+            return min(1.0, 1080 / height, 1920 / width)
+        return min(
+            1.0,
+            config.extract.max_side / min(width, height),
+            math.sqrt(config.extract.max_pixels / (width * height)),
+        )
+
+    def read(self, image: str | Buffer) -> cv2.typing.MatLike | None:
+        """
+        读取并解码灰度图
+
+        分块模式下 JPEG 图片会在提取特征点前被缩小时，根据文件头中的尺寸选择 IMREAD_REDUCED_* 模式，
+        在 DCT 阶段只解码需要的分辨率；其他格式会先完整解码再缩小，不能节省内存。
+        非分块模式保持完整解码，与已有集合提取的特征一致。
+        图片数据直接作为解码的输入，不会被复制。
+        :param image: 图片路径或图片数据，图片路径会被映射到内存中读取
+        :return: 灰度图，无法解码时返回 None
+        """
+        if isinstance(image, str):
+            with map_file(image) as mapped:
+                return self.read(mapped)
+        data = np.frombuffer(image, dtype=np.uint8)
+        flags = cv2.IMREAD_GRAYSCALE
+        size = jpeg_size(data) if self.tiled else None
+        if size is not None:
+            # 图片可能会按照 EXIF 旋转，取两个方向中较大的缩放比例
+            scale = max(self.target_scale(*size), self.target_scale(*size[::-1]))
+            for factor, reduced in REDUCED_FLAGS.items():
+                if factor * scale <= 1:
+                    flags = reduced
+                    break
+        return cv2.imdecode(data, flags)
+
+    def resize(self, img: cv2.typing.MatLike) -> cv2.typing.MatLike:
+        """按照 target_scale 缩小图片"""
+        if not self.tiled:
+            return adjust_image_size(img)
+        scale = self.target_scale(img.shape[1], img.shape[0])
+        if scale < 1:
+            img = cv2.resize(img, (0, 0), fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        return img
 
     def detect(
-        self, img: cv2.typing.MatLike, count: int | None = None
+        self,
+        img: cv2.typing.MatLike,
+        count: int | None = None,
+        spans: Spans = NULL_SPANS,
     ) -> typing.Sequence[cv2.KeyPoint]:
-        if count is None:
-            return self.extractor.detect(img)
-        else:
+        with spans.span("detect"):
             keys = self.extractor.detect(img)
-            return self.filter(keys, img.shape[0], img.shape[1], count)
+        if count is None:
+            return keys
+        with spans.span("filter"):
+            pts, responses = keypoint_arrays(keys)
+            index = self.filter(pts, responses, img.shape[0], img.shape[1], count)
+            return [keys[i] for i in index]
 
     def compute(
-        self, img: cv2.typing.MatLike, kp: typing.Sequence[cv2.KeyPoint]
+        self,
+        img: cv2.typing.MatLike,
+        kp: typing.Sequence[cv2.KeyPoint],
+        spans: Spans = NULL_SPANS,
     ) -> tuple[typing.Sequence[cv2.KeyPoint], cv2.typing.MatLike]:
-        return self.extractor.compute(img, kp)
+        with spans.span("compute"):
+            return self.extractor.compute(img, kp)
 
     def detect_and_compute(
-        self, img: cv2.typing.MatLike, count: int | None = None, resize: bool = True
+        self,
+        img: cv2.typing.MatLike,
+        count: int | None = None,
+        resize: bool = True,
+        spans: Spans = NULL_SPANS,
     ) -> tuple[typing.Sequence[cv2.KeyPoint], cv2.typing.MatLike]:
-        # TODO: 对于超长图片，缩放可能会严重影响分辨率
+        """
+        :param spans: 记录缩放、检测、均匀化与计算描述子各阶段的耗时
+        """
         if resize:
-            img = adjust_image_size(img)
-        keys = self.detect(img, count)
-        return self.compute(img, keys)
+            with spans.span("resize"):
+                img = self.resize(img)
+        if self.tiled and max(img.shape[:2]) > config.extract.tile_size:
+            return self.detect_and_compute_tiled(img, count, spans)
+        keys = self.detect(img, count, spans)
+        return self.compute(img, keys, spans)
+
+    def detect_and_compute_tiled(
+        self,
+        img: cv2.typing.MatLike,
+        count: int | None = None,
+        spans: Spans = NULL_SPANS,
+    ) -> tuple[typing.Sequence[cv2.KeyPoint], cv2.typing.MatLike | None]:
+        """
+        将图片沿长边切分为相互重叠的分块，并行检测特征点后在整张图片上均匀化，
+        再按分块计算描述子，每个分块的大小与未分块时的图片相近
+        :param img: 已缩放的灰度图
+        :param count: 特征点数量，为 None 时不限制
+        """
+        height, width = img.shape[:2]
+        vertical = height >= width
+        tiles = tile_ranges(
+            height if vertical else width,
+            config.extract.tile_size,
+            config.extract.tile_overlap,
+        )
+
+        def crop(start: int, stop: int) -> cv2.typing.MatLike:
+            if vertical:
+                return img[start:stop]
+            return np.ascontiguousarray(img[:, start:stop])
+
+        def detect(tile: tuple[int, int, int, int]):
+            start, stop, lo, hi = tile
+            keys = self.extractor.detect(crop(start, stop))
+            pts, responses = keypoint_arrays(keys)
+            # 重叠区域中的特征点只保留在距离较近的分块中
+            pos = pts[:, 1 if vertical else 0] + start
+            keep = np.flatnonzero((pos >= lo) & (pos < hi))
+            pts[:, 1 if vertical else 0] += start
+            return [keys[i] for i in keep], pts[keep], responses[keep]
+
+        with spans.span("detect"):
+            detected = _tile_map(detect, tiles, self.tile_workers)
+        keys = [key for tile_keys, _, _ in detected for key in tile_keys]
+        owner = np.repeat(np.arange(len(tiles)), [len(item[0]) for item in detected])
+        if count is not None and keys:
+            with spans.span("filter"):
+                pts = np.concatenate([item[1] for item in detected])
+                responses = np.concatenate([item[2] for item in detected])
+                index = self.filter(pts, responses, height, width, count)
+        else:
+            index = np.arange(len(keys))
+
+        def compute(tile: int):
+            start, stop = tiles[tile][:2]
+            selected = [keys[i] for i in index[owner[index] == tile]]
+            if not selected:
+                return [], None
+            tile_keys, des = self.extractor.compute(crop(start, stop), selected)
+            # 将坐标还原到整张图片中
+            for key in tile_keys:
+                x, y = key.pt
+                key.pt = (x, y + start) if vertical else (x + start, y)
+            return tile_keys, des
+
+        with spans.span("compute"):
+            computed = _tile_map(compute, list(range(len(tiles))), self.tile_workers)
+        result = [key for tile_keys, _ in computed for key in tile_keys]
+        descriptors = [des for _, des in computed if des is not None and len(des)]
+        if not descriptors:
+            return result, None
+        return result, np.concatenate(descriptors)
+
+
+def keypoint_arrays(
+    keys: typing.Sequence[cv2.KeyPoint],
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    将特征点转换为坐标与响应值数组
+    :param keys: 特征点
+    :return: 形状为 (n, 2) 的坐标与形状为 (n,) 的响应值
+    """
+    if not keys:
+        return np.empty((0, 2), dtype=np.float32), np.empty(0, dtype=np.float32)
+    pts = cv2.KeyPoint_convert(keys)
+    responses = np.fromiter(
+        (key.response for key in keys), dtype=np.float32, count=len(keys)
+    )
+    return pts, responses
+
+
+def _argmax_of_groups(
+    groups: np.ndarray, values: np.ndarray, tiebreak: np.ndarray, size: int
+) -> np.ndarray:
+    """
+    返回每个分组中值最大的元素下标，值相同时选取 tiebreak 最小的元素
+    :param groups: 每个元素所属的分组，取值范围为 [0, size)
+    :param values: 元素的值
+    :param tiebreak: 元素的次序，各不相同的非负整数
+    :param size: 分组数量
+    :return: 按分组顺序排列的下标，空分组会被跳过
+    """
+    maximum = np.full(size, -np.inf, dtype=values.dtype)
+    np.maximum.at(maximum, groups, values)
+    candidate = np.flatnonzero(values == maximum[groups])
+    best = np.full(size, np.iinfo(np.intp).max, dtype=np.intp)
+    np.minimum.at(best, groups[candidate], tiebreak[candidate])
+    winner = candidate[tiebreak[candidate] == best[groups[candidate]]]
+    return winner[np.argsort(groups[winner])]
+
+
+def fufp_extract_indices(
+    pts: np.ndarray, responses: np.ndarray, height: int, width: int, count: int
+) -> np.ndarray:
+    """
+    fufp_extract 的向量化实现，结果与之完全一致
+
+    :param pts: 候选特征点坐标，形状为 (n, 2)
+    :param responses: 候选特征点响应值，形状为 (n,)
+    :param height: 图像高度
+    :param width: 图像宽度
+    :param count: 需要提取的特征点个数
+    :return: 返回提取出的特征点下标
+    """
+    y_num = round(math.sqrt(height / width * count)) * 2
+    x_num = round(math.sqrt(width / height * count)) * 2
+    if len(pts) == 0:
+        return np.empty(0, dtype=np.intp)
+
+    pts = np.asarray(pts, dtype=np.float64)
+    responses = np.asarray(responses)
+    index = np.arange(len(pts))
+
+    # 将特征点放入网格中
+    x = np.floor(pts[:, 0] / (width / x_num)).astype(np.intp).clip(0, x_num - 1)
+    y = np.floor(pts[:, 1] / (height / y_num)).astype(np.intp).clip(0, y_num - 1)
+
+    # 每四个网格为一组，sub 为网格在组内的顺序
+    group = (y // 2) * (x_num // 2) + x // 2
+    sub = (y % 2) * 2 + x % 2
+    cell = group * 4 + sub
+
+    # 合并后为空的组会让下一组不进行合并，而被跳过合并的组不会影响再下一组
+    # 因此连续的空组中，只有位于偶数位置的空组会让下一组不进行合并
+    empty = np.bincount(group, minlength=(x_num // 2) * (y_num // 2)) == 0
+    starts = empty.copy()
+    starts[1:] &= ~empty[:-1]
+    run_start = np.maximum.accumulate(np.where(starts, np.arange(len(empty)), 0))
+    split = np.zeros(len(empty), dtype=bool)
+    split[1:] = empty[:-1] & ((np.arange(len(empty) - 1) - run_start[:-1]) % 2 == 0)
+
+    # 响应值相同时，选取合并顺序中靠前的特征点
+    merged = _argmax_of_groups(group, responses, sub * len(pts) + index, len(empty))
+    merged = merged[~split[group[merged]]]
+    single = _argmax_of_groups(cell, responses, index, len(empty) * 4)
+    single = single[split[group[single]]]
+
+    # 按照网格的遍历顺序输出
+    result = np.concatenate([merged, single])
+    key = np.concatenate([group[merged] * 4, cell[single]])
+    return result[np.argsort(key)]
 
 
 def fufp_extract(
@@ -59,6 +323,7 @@ def fufp_extract(
     """
     使用 FUFP 算法均匀地从图像出提取出若干个特征点
     最终结果不保证刚好为 count 个
+    此为逐个处理特征点的参考实现，实际使用 fufp_extract_indices
 
     参考：宋霄罡，张元培，梁莉,等.面向视觉SLAM的快速均匀特征点提取方法[J]. 导航定位与授时, 2022, 9(4): 41-50.
 
@@ -114,6 +379,52 @@ def fufp_extract(
     return result
 
 
+def tile_ranges(length: int, size: int, overlap: int) -> list[tuple[int, int, int, int]]:
+    """
+    将长度为 length 的区间切分为相互重叠的分块
+    :return: 每个分块的 (起点, 终点, 负责的起点, 负责的终点)，
+             负责的区间互不重叠，以相邻分块重叠部分的中点为界
+    """
+    if length <= size:
+        return [(0, length, 0, length)]
+    step = size - overlap
+    count = math.ceil((length - overlap) / step)
+    starts = [min(i * step, length - size) for i in range(count)]
+    stops = [start + size for start in starts]
+    bounds = [0] + [(stops[i] + starts[i + 1]) // 2 for i in range(count - 1)] + [length]
+    return [
+        (start, stop, bounds[i], bounds[i + 1])
+        for i, (start, stop) in enumerate(zip(starts, stops))
+    ]
+
+
+def jpeg_size(data: np.ndarray) -> tuple[int, int] | None:
+    """
+    从 JPEG 的文件头中读取图片尺寸，不需要解码
+    :param data: 图片数据
+    :return: (宽, 高)，不是 JPEG 或无法识别时返回 None
+    """
+    if bytes(data[:2]) != b"\xff\xd8":
+        return None
+    pos = 2
+    while pos + 9 <= len(data):
+        if data[pos] != 0xFF:
+            return None
+        marker = int(data[pos + 1])
+        # 填充字节与没有长度的标记
+        if marker == 0xFF:
+            pos += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            pos += 2
+            continue
+        if marker in _SOF_MARKERS:
+            height, width = struct.unpack(">HH", bytes(data[pos + 5 : pos + 9]))
+            return width, height
+        pos += 2 + (int(data[pos + 2]) << 8 | int(data[pos + 3]))
+    return None
+
+
 # TODO: 或许使用中值滤波、边缘检测等手段对图像进行预处理可以更好地提取特征点？
 def adjust_image_size(img: cv2.typing.MatLike, width: int = 1920, height: int = 1080):
     if img.shape[0] > height or img.shape[1] > width:
@@ -122,6 +433,22 @@ def adjust_image_size(img: cv2.typing.MatLike, width: int = 1920, height: int =
     return img
 
 
+def phash(img: cv2.typing.MatLike) -> int:
+    """
+    计算图片的感知哈希（pHash），用于查找重复与近似重复的图片
+
+    将图片缩小到 32x32 后做 DCT，取左上角 8x8 的低频系数，与其中位数比较得到 64 位哈希。
+    缩放、重新压缩后的图片与原图的汉明距离通常很小。
+    :param img: 灰度图
+    :return: 64 位整数
+    """
+    small = cv2.resize(img, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(small)[:8, :8].flatten()
+    # 直流分量只反映整体亮度，不参与中位数的计算
+    bits = low > np.median(low[1:])
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
 class QuadNode:
     def __init__(
         self, keys: list[cv2.KeyPoint], x: float, y: float, width: float, height: float
@@ -167,6 +494,7 @@ def quad_filter(
 ) -> list[cv2.KeyPoint]:
     """
     使用四叉树均匀地从图像出提取出若干个特征点
+    此为逐个处理特征点的参考实现，实际使用 quad_filter_indices
     :param keys: 候选特征点
     :param height: 图像高度
     :param width: 图像宽度
@@ -195,3 +523,105 @@ def quad_filter(
         nodes.extend(tmp)
 
     return [max(node.keys, key=lambda key: key.response) for node in nodes]
+
+
+def quad_filter_indices(
+    pts: np.ndarray, responses: np.ndarray, height: int, width: int, limit: int
+) -> np.ndarray:
+    """
+    quad_filter 的向量化实现，结果与之完全一致
+    每个节点用数组中的一个下标表示，特征点通过 label 记录所属节点
+
+    :param pts: 候选特征点坐标，形状为 (n, 2)
+    :param responses: 候选特征点响应值，形状为 (n,)
+    :param height: 图像高度
+    :param width: 图像宽度
+    :param limit: 需要提取的特征点个数
+    :return: 返回提取出的特征点下标
+    """
+    if len(pts) == 0:
+        return np.empty(0, dtype=np.intp)
+
+    pts = np.asarray(pts, dtype=np.float64)
+    responses = np.asarray(responses)
+    index = np.arange(len(pts))
+
+    # 节点的位置与大小
+    node_x = np.zeros(1)
+    node_y = np.zeros(1)
+    node_w = np.full(1, float(width))
+    node_h = np.full(1, float(height))
+    label = np.zeros(len(pts), dtype=np.intp)
+
+    def split(
+        keep: np.ndarray, parent: np.ndarray, quad: np.ndarray, quadrant: np.ndarray
+    ):
+        """
+        按顺序生成新的节点列表
+        :param keep: 保持不变的节点
+        :param parent: 新节点的父节点
+        :param quad: 新节点所在的象限，-1 表示与父节点相同
+        :param quadrant: 每个特征点在所属节点中的象限，-1 表示所属节点未被划分
+        """
+        nonlocal node_x, node_y, node_w, node_h, label
+        parent = np.concatenate([keep, parent])
+        quad = np.concatenate([np.full(len(keep), -1), quad])
+        half_w = node_w[parent] / 2
+        half_h = node_h[parent] / 2
+        is_child = quad >= 0
+        x = node_x[parent] + half_w
+        y = node_y[parent] + half_h
+        new_x = np.where(is_child & (quad % 2 == 1), x, node_x[parent])
+        new_y = np.where(is_child & (quad >= 2), y, node_y[parent])
+        new_w = np.where(is_child, half_w, node_w[parent])
+        new_h = np.where(is_child, half_h, node_h[parent])
+
+        table = np.full(len(node_x) * 5, -1, dtype=np.intp)
+        table[parent * 5 + quad + 1] = np.arange(len(parent))
+        moved = table[label * 5 + quadrant + 1]
+        label = np.where(moved >= 0, moved, table[label * 5])
+        node_x, node_y, node_w, node_h = new_x, new_y, new_w, new_h
+
+    def quadrants() -> np.ndarray:
+        dx = node_x[label] + node_w[label] / 2
+        dy = node_y[label] + node_h[label] / 2
+        return (pts[:, 0] >= dx) + (pts[:, 1] >= dy) * 2
+
+    # 根节点总是会被划分一次
+    quadrant = quadrants()
+    quad = np.flatnonzero(np.bincount(quadrant, minlength=4))
+    split(np.empty(0, dtype=np.intp), np.zeros(len(quad), dtype=np.intp), quad, quadrant)
+
+    # 点重合时无法继续划分，参考实现会陷入死循环，这里限制最大轮数
+    for _ in range(128):
+        n = len(node_x)
+        counts = np.bincount(label, minlength=n)
+        quadrant = quadrants()
+        nonempty = np.bincount(label * 4 + quadrant, minlength=n * 4).reshape(n, 4) > 0
+
+        # 按特征点数量降序排列后从尾部（数量最少的节点）开始处理
+        order = np.argsort(-counts, kind="stable")
+        processed = order[::-1]
+        can_split = counts[processed] > 1
+        grow = np.where(can_split, nonempty[processed].sum(axis=1), 1)
+        total = np.cumsum(grow) + (n - np.arange(1, n + 1))
+        reached = np.flatnonzero(total >= limit)
+        if len(reached) > 0:
+            k = reached[0] + 1
+            end = True
+        else:
+            k = n
+            end = not can_split.any()
+
+        slots = np.where(can_split[:k, None], nonempty[processed[:k]], False)
+        slots[~can_split[:k], 0] = True
+        row, col = np.nonzero(slots)
+        quad = np.where(can_split[row], col, -1)
+        divided = np.zeros(n, dtype=bool)
+        divided[processed[:k][can_split[:k]]] = True
+        quadrant = np.where(divided[label], quadrant, -1)
+        split(order[: n - k], processed[:k][row], quad, quadrant)
+        if end:
+            break
+
+    return _argmax_of_groups(label, responses, index, len(node_x))
@@ -1,12 +1,32 @@
+import contextlib
+import queue
+import threading
+from concurrent.futures import Future, wait
+import time
+import typing
 import cv2
 import numpy as np
 import typer
 
-from herod.database import Lmdb, get_image_hash
-from herod.feature import FeatureExtractor, Extractor, Filter
-from pymilvus import Collection
-from collections import defaultdict
-from datetime import datetime
+from herod.buffer import Buffer, map_file
+from herod.cache import ResultCache
+from herod.config import config
+from herod.database import (
+    DescriptorStore,
+    FileStat,
+    Lmdb,
+    descriptor_variant,
+    file_stat,
+    get_image_hash,
+)
+from herod.enums import Backend
+from herod.feature import FeatureExtractor, Extractor, Filter, phash
+from herod.metrics import INGEST_VECTORS, NULL_SPANS, Spans
+from herod.partition import PartitionedStore
+from herod.store import SearchHits, VectorStore, open_store
+
+# 单次向量搜索的查询向量数上限，Milvus 限制 nq 不超过 16384
+MAX_SEARCH_VECTORS = 16384
 
 
 # https://www.jianshu.com/p/4d2b45918958
@@ -24,6 +44,242 @@ def wilson_score(values: list[float], p_z: float = 2.326):
     return score
 
 
+def wilson_scores(
+    groups: np.ndarray, distances: np.ndarray, size: int, p_z: float = 2.326
+) -> np.ndarray:
+    """
+    wilson_score 的向量化版本，一次计算所有分组的分数
+    :param groups: 每个距离所属的分组，取值范围为 [0, size)
+    :param distances: 距离
+    :param size: 分组数量
+    :return: 每个分组的分数
+    """
+    values = 1 - distances.astype(np.float64)
+    total = np.bincount(groups, minlength=size).astype(np.float64)
+    mean = np.bincount(groups, values, minlength=size) / total
+    var = np.bincount(groups, values * values, minlength=size) / total - mean * mean
+    var = np.maximum(var, 0)
+
+    score = (
+        mean
+        + (np.square(p_z) / (2.0 * total))
+        - ((p_z / (2.0 * total)) * np.sqrt(4.0 * total * var + np.square(p_z)))
+    ) / (1 + np.square(p_z) / total)
+    return score
+
+
+class InsertBuffer:
+    """
+    批量插入缓冲区
+
+    将多张图片的 (image_id, descriptor) 收集到连续的 NumPy 缓冲区中，
+    行数达到 batch_size 或距离上次写入超过 flush_interval 秒时，由后台线程一次性写入 Milvus。
+    图片的 LMDB 记录只会在对应向量写入成功后提交。
+    每一批有一个 Future，向量与记录都提交后完成，写入失败时带有异常，由添加这一批图片的调用者处理。
+    """
+
+    def __init__(
+        self,
+        store: VectorStore,
+        mdb: Lmdb,
+        batch_size: int = 20000,
+        flush_interval: float = 5.0,
+        dim: int = 64,
+        on_write: typing.Callable[[], None] | None = None,
+    ):
+        self.store = store
+        self.mdb = mdb
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dim = dim
+        # 每批向量写入成功后的回调
+        self.on_write = on_write
+
+        self.lock = threading.Lock()
+        # 已加入缓冲区但尚未提交到 LMDB 的图片 -> 所在批次的记录与 Future
+        # 批次被取出等待写入后仍然保留，直到提交完成
+        self.pending: dict[int, tuple[dict, Future]] = {}
+        self._reset()
+
+        # 最多只有一个批次在等待写入，写入跟不上时 add 会阻塞
+        self.queue: queue.Queue = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def _reset(self):
+        self.ids = np.empty(self.batch_size, dtype=np.int64)
+        self.vectors = np.empty((self.batch_size, self.dim), dtype=np.float32)
+        self.size = 0
+        # 图片 ID -> 按添加顺序排列的 (文件名, 文件信息, 感知哈希)，内容相同的多个文件都会被记录
+        self.records: dict[int, list[tuple[str, FileStat | None, int | None]]] = {}
+        self.future: Future = Future()
+        self.created = time.monotonic()
+
+    def _take(self):
+        """取出当前缓冲区中的数据，调用者需持有锁"""
+        batch = (
+            self.ids[: self.size],
+            self.vectors[: self.size],
+            self.records,
+            self.future,
+        )
+        self._reset()
+        return batch
+
+    def contains(self, image_id: int) -> bool:
+        """图片是否已在缓冲区中等待写入"""
+        with self.lock:
+            return image_id in self.pending
+
+    def add(
+        self,
+        image_id: int,
+        filename: str,
+        des: np.ndarray,
+        stat: FileStat | None = None,
+        signature: int | None = None,
+    ) -> Future:
+        """
+        往缓冲区中添加一张图片的特征向量
+        :param image_id: 图片 ID
+        :param filename: 文件名
+        :param des: 特征向量，形状为 (n, dim)
+        :param stat: 文件的大小与修改时间
+        :param signature: 图片的感知哈希
+        :return: 图片所在批次写入完成的 Future
+        """
+        while True:
+            with self.lock:
+                if image_id in self.pending:
+                    # 图片已在等待写入的批次中，只追加记录，随该批次一起提交
+                    records, future = self.pending[image_id]
+                    if signature is None:
+                        signature = records[image_id][-1][2]
+                    records[image_id].append((filename, stat, signature))
+                    return future
+                if self.size == 0 or self.size + len(des) <= len(self.ids):
+                    # 单张图片的特征点数超过缓冲区大小时，直接扩容
+                    if len(des) > len(self.ids):
+                        self.ids = np.empty(len(des), dtype=np.int64)
+                        self.vectors = np.empty((len(des), self.dim), dtype=np.float32)
+                    self.ids[self.size : self.size + len(des)] = image_id
+                    self.vectors[self.size : self.size + len(des)] = des
+                    self.size += len(des)
+                    self.records[image_id] = [(filename, stat, signature)]
+                    self.pending[image_id] = (self.records, self.future)
+                    return self.future
+                batch = self._take()
+            self.queue.put(batch)
+
+    def record(
+        self, image_id: int, filename: str, stat: FileStat | None = None
+    ) -> Future:
+        """更新已索引图片的文件名，与下一批向量一起提交"""
+        return self.add(
+            image_id, filename, np.empty((0, self.dim), dtype=np.float32), stat
+        )
+
+    def _write(self, batch):
+        ids, vectors, records, future = batch
+        try:
+            if len(ids):
+                self.store.insert(ids, vectors)
+            # 持有锁提交，提交期间对这一批图片记录的更新不会丢失
+            with self.lock:
+                self.mdb.record_image_ids(
+                    (image_id, *record)
+                    for image_id, items in records.items()
+                    for record in items
+                )
+                for image_id in records:
+                    del self.pending[image_id]
+        except Exception as e:
+            with self.lock:
+                for image_id in records:
+                    self.pending.pop(image_id, None)
+            future.set_exception(e)
+            return
+        if len(ids) and self.on_write is not None:
+            self.on_write()
+        future.set_result(None)
+
+    def _worker(self):
+        while True:
+            try:
+                batch = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                with self.lock:
+                    expired = time.monotonic() - self.created >= self.flush_interval
+                    batch = self._take() if self.records and expired else None
+                if batch is not None:
+                    # 可能先于 add 已取出但尚未放入队列的批次写入，flush 会等待所有未提交的批次
+                    self._write(batch)
+                continue
+            if batch is None:
+                self.queue.task_done()
+                break
+            self._write(batch)
+            self.queue.task_done()
+
+    def flush(self):
+        """
+        将缓冲区中的数据写入 Milvus 并等待完成
+        :raise Exception: 缓冲区中剩余的这一批写入失败，之前各批的错误由各自的 Future 报告
+        """
+        with self.lock:
+            batch = self._take() if self.records else None
+            # 按时间取出的批次不经过队列，可能先于更早取出的批次写入，因此等待所有未提交的批次
+            outstanding = {future for _, future in self.pending.values()}
+        if batch is not None:
+            self.queue.put(batch)
+        wait(outstanding)
+        if batch is not None:
+            batch[3].result()
+
+    def close(self):
+        """写入剩余数据并停止后台线程"""
+        try:
+            self.flush()
+        finally:
+            self.queue.put(None)
+            self.thread.join()
+
+
+def rerank_candidates(top_k: int | None, rerank: int) -> int | None:
+    """几何重排时需要从向量搜索结果中取出的候选图片数量"""
+    return None if top_k is None else max(top_k, rerank)
+
+
+def use_prefilter(
+    prefilter: bool | None, partitions: typing.Sequence[str] | None
+) -> bool:
+    """
+    是否在向量搜索前使用感知哈希查找重复的图片，prefilter 为 None 时使用配置文件中的设置
+    感知哈希不区分分区，因此只搜索部分分区时不使用
+    """
+    if prefilter is None:
+        prefilter = config.signature.prefilter
+    return prefilter and partitions is None
+
+
+class QueryResult:
+    def __init__(
+        self,
+        result: list[tuple[str, int, float]] | None = None,
+        cached: bool = False,
+        error: Exception | None = None,
+    ):
+        """
+        批量搜索中一张图片的搜索结果
+        :param result: 按分数降序排列的 (文件名, 图片 ID, 分数)，出现错误时为 None
+        :param cached: 结果是否来自缓存
+        :param error: 读取或提取特征时出现的错误
+        """
+        self.result = result
+        self.cached = cached
+        self.error = error
+
+
 class Indexer:
     def __init__(
         self,
@@ -31,101 +287,653 @@ class Indexer:
         search: bool = False,
         extractor: Extractor = Extractor.SURF,
         filter: Filter = Filter.FUFP,
+        batch_size: int = 0,
+        flush_interval: float = 5.0,
+        cache: ResultCache | None = None,
+        descriptors: bool | None = None,
+        backend: Backend | None = None,
+        partition: str | None = None,
     ):
-        self.collection = Collection(name=collection)
+        """
+        :param collection: 集合名称
+        :param search: 是否加载索引用于搜索
+        :param extractor: 特征点提取算法
+        :param filter: 特征点均匀化算法
+        :param batch_size: 批量插入的向量行数，为 0 时每张图片单独插入
+        :param flush_interval: 批量插入时缓冲区的最长等待时间（秒）
+        :param cache: 搜索结果缓存，写入新图片后会使该集合的缓存失效
+        :param descriptors: 是否保存特征向量用于重建集合，默认使用配置文件中的设置
+        :param backend: 向量存储后端，默认使用配置文件中的后端
+        :param partition: 分区集合写入的分区，默认按日期选择分区
+        """
+        self.collection = collection
+        self.cache = cache
+        self.store = open_store(collection, backend, partition)
+        # 索引是否已经加载
+        self.loaded = False
         if search:
-            typer.echo(f"正在加载集合 {collection} 的索引")
-            self.collection.load()
+            self.load()
         self.extractor = FeatureExtractor(extractor, filter)
+        self.extractor_name = extractor
+        self.filter_name = filter
+        if descriptors is None:
+            descriptors = config.descriptors.enabled
+        self.descriptors = DescriptorStore(collection) if descriptors else None
+        # 导入时的特征点数量，几何重排时按此读取保存的特征向量
+        self.descriptor_limit = config.descriptors.limit
+        # 判定为重复图片的最大汉明距离
+        self.signature_distance = config.signature.distance
         self.mdb = Lmdb(collection)
+        self.buffer = (
+            InsertBuffer(
+                self.store,
+                self.mdb,
+                batch_size,
+                flush_interval,
+                dim=self.extractor.dim,
+                on_write=self.invalidate_cache,
+            )
+            if batch_size > 0
+            else None
+        )
+
+    def load(self):
+        """将集合的索引加载到内存中"""
+        typer.echo(f"正在加载集合 {self.collection} 的索引")
+        self.store.load()
+        self.loaded = True
+
+    def release(self):
+        """释放集合的索引占用的内存，之后搜索前需要重新加载"""
+        self.store.release()
+        self.loaded = False
+
+    def __enter__(self):
+        return self
 
-    def add_image(self, filename: str, limit: int = 500):
+    def __exit__(self, *args):
+        self.close()
+
+    def flush(self):
+        """等待缓冲区中的数据写入完成"""
+        if self.buffer is not None:
+            self.buffer.flush()
+
+    def close(self):
+        """写入缓冲区中剩余的数据"""
+        if self.buffer is not None:
+            self.buffer.close()
+            self.buffer = None
+        if self.descriptors is not None:
+            self.descriptors.close()
+
+    def invalidate_cache(self):
+        """使该集合的搜索结果缓存失效"""
+        if self.cache is not None:
+            self.cache.invalidate(self.collection)
+
+    def is_indexed(self, image_id: int) -> bool:
+        """图片是否已经被索引或正在等待写入"""
+        if self.buffer is not None and self.buffer.contains(image_id):
+            return True
+        return self.mdb.get_image_by_id(image_id) is not None
+
+    def record(
+        self,
+        image_id: int,
+        filename: str,
+        stat: FileStat | None = None,
+        buffered: bool = True,
+    ) -> Future | None:
+        """
+        更新已索引图片的文件名
+        :param buffered: 是否使用缓冲区，图片正在缓冲区中等待写入时总是使用
+        :return: 使用缓冲区时返回记录提交完成的 Future，否则已经提交，返回 None
+        """
+        if self.buffer is not None and (buffered or self.buffer.contains(image_id)):
+            return self.buffer.record(image_id, filename, stat)
+        self.mdb.record_image_id(image_id, filename, stat)
+
+    def insert(
+        self,
+        image_id: int,
+        filename: str,
+        des: np.ndarray,
+        stat: FileStat | None = None,
+        limit: int | None = None,
+        points: np.ndarray | None = None,
+        signature: int | None = None,
+        buffered: bool = True,
+    ) -> Future | None:
+        """
+        写入一张图片的特征向量及其 LMDB 记录
+        :param limit: 提取特征向量时的特征点数量，保存特征向量时作为键的一部分
+        :param points: 特征点坐标，与特征向量一起保存，用于几何重排
+        :param signature: 图片的感知哈希，用于搜索前查找重复的图片
+        :param buffered: 是否使用缓冲区，为 False 时立即写入，不等待攒批
+        :return: 使用缓冲区时返回这一批写入完成的 Future，否则已经写入，返回 None
+        """
+        INGEST_VECTORS.inc(len(des))
+        if self.descriptors is not None and limit is not None:
+            variant = descriptor_variant(self.extractor_name, self.filter_name, limit)
+            self.descriptors.put(variant, image_id, filename, des, points)
+        if self.buffer is not None and buffered:
+            return self.buffer.add(image_id, filename, des, stat, signature)
+        else:
+            self.store.insert(np.full(len(des), image_id, dtype=np.int64), des)
+            self.mdb.record_image_id(image_id, filename, stat, signature)
+            self.invalidate_cache()
+
+    def add_image(self, filename: str, limit: int = 500) -> Future | None:
         """
         往集合中增加一张图片
         :param filename: 文件名
         :param limit: 特征点数量
-        :return:
+        :return: 使用缓冲区时返回写入完成的 Future
         """
-        image_id = get_image_hash(filename)
-        if self.mdb.get_image_by_id(image_id) is None:
-            img = cv2.imread(filename, cv2.IMREAD_GRAYSCALE)
-            kps, des = self.extractor.detect_and_compute(img, limit)
-            # 可能会有空白图片，没有特征点
-            if not kps:
-                print(f"图片 {filename} 没有特征点")
-                return
-            data = [[image_id] * len(des), des]
-            self.collection.insert(data)
-        self.mdb.record_image_id(image_id, filename)
+        # 文件大小与修改时间都没有变化时，不再重新计算哈希
+        stat = file_stat(filename)
+        if self.mdb.get_image_by_file(filename, stat) is not None:
+            return None
+        # 哈希与解码使用同一份映射的文件内容，文件只读取一次
+        with map_file(filename) as data:
+            image_id = get_image_hash(data)
+            if self.is_indexed(image_id):
+                return self.record(image_id, filename, stat)
+            img = self.extractor.read(data)
+        kps, des = self.extractor.detect_and_compute(img, limit)
+        # 可能会有空白图片，没有特征点
+        if not kps:
+            print(f"图片 {filename} 没有特征点")
+            return None
+        return self.insert(
+            image_id,
+            filename,
+            des,
+            stat,
+            limit,
+            cv2.KeyPoint_convert(kps),
+            phash(img),
+        )
 
-    def add_image_raw(self, data: bytes, name: str, limit: int = 500):
+    def add_image_raw(
+        self,
+        data: Buffer,
+        name: str,
+        limit: int = 500,
+        spans: Spans = NULL_SPANS,
+        buffered: bool = True,
+    ) -> tuple[str, Future | None]:
         """
         往集合中增加一张图片
-        :param data: 图片数据
+        :param data: 图片数据，哈希与解码直接使用，不会被复制
         :param name: 文件名
         :param limit: 特征点数量
-        :return:
+        :param spans: 记录各阶段的耗时
+        :param buffered: 是否使用缓冲区，单张图片的请求立即写入，不等待攒批
+        :return: 处理结果（added / skipped / empty），以及使用缓冲区时写入完成的 Future
         """
-        image_id = get_image_hash(data)
-        if self.mdb.get_image_by_id(image_id) is None:
-            img = np.frombuffer(data, dtype=np.uint8)
-            img = cv2.imdecode(img, cv2.IMREAD_GRAYSCALE)
-            kps, des = self.extractor.detect_and_compute(img, limit)
+        with spans.span("hash"):
+            image_id = get_image_hash(data)
+        if not self.is_indexed(image_id):
+            img = self.decode(data, spans)
+            kps, des = self.extractor.detect_and_compute(img, limit, spans=spans)
             # 可能会有空白图片，没有特征点
             if not kps:
                 print(f"图片 {name} 没有特征点")
-                return
-            data = [[image_id] * len(des), des]
-            self.collection.insert(data)
-        self.mdb.record_image_id(image_id, name)
+                return "empty", None
+            with spans.span("insert"):
+                written = self.insert(
+                    image_id,
+                    name,
+                    des,
+                    limit=limit,
+                    points=cv2.KeyPoint_convert(kps),
+                    signature=phash(img),
+                    buffered=buffered,
+                )
+            return "added", written
+        else:
+            return "skipped", self.record(image_id, name, buffered=buffered)
+
+    def find_images(self, names: typing.Iterable[str]) -> list[int | None]:
+        """
+        查找要删除或查询的图片
+        :param names: 导入时的文件名，或十进制的图片 ID
+        :return: 图片 ID，图片不存在时为 None
+        """
+        result = []
+        for name in names:
+            image_id = self.mdb.get_image_by_name(name)
+            if (
+                image_id is None
+                and name.isdigit()
+                and int(name) < 1 << 40
+                and self.is_indexed(int(name))
+            ):
+                image_id = int(name)
+            result.append(image_id)
+        return result
+
+    def remove_images(self, image_ids: typing.Iterable[int]) -> list[int]:
+        """
+        删除图片的所有向量与 LMDB 记录，保存的特征向量也一并删除
+        :param image_ids: 图片 ID，可以一次删除多张图片
+        :return: 集合中存在并被删除的图片 ID
+        """
+        image_ids = sorted(set(image_ids))
+        if not image_ids:
+            return []
+        # 先写入缓冲区中的图片，避免删除后又被写入
+        self.flush()
+        # 先删除向量再删除记录，中断后记录仍然存在，可以重新删除
+        self.store.delete(np.array(image_ids, dtype=np.int64))
+        removed = self.mdb.remove_images(image_ids)
+        descriptors = self.descriptor_store()
+        if descriptors is not None:
+            descriptors.remove(image_ids)
+        self.invalidate_cache()
+        return removed
+
+    def compact(self) -> tuple[int, int]:
+        """
+        回收已删除图片占用的空间，期间可以继续搜索
+        :return: 压缩前后 LMDB 数据文件的大小（字节）
+        """
+        self.flush()
+        self.store.compact()
+        return self.mdb.compact()
+
+    def extract(
+        self,
+        image: str | Buffer | cv2.typing.MatLike,
+        limit: int,
+        spans: Spans = NULL_SPANS,
+    ) -> np.ndarray:
+        """
+        提取用于搜索的特征向量
+        :param image: 图片路径、图片数据或已解码的灰度图
+        :param limit: 特征点数量
+        :param spans: 记录解码与特征提取各阶段的耗时
+        :return: 特征向量
+        """
+        return self.extract_points(image, limit, spans)[1]
+
+    def decode(
+        self, image: str | Buffer | cv2.typing.MatLike, spans: Spans = NULL_SPANS
+    ) -> cv2.typing.MatLike:
+        """
+        将图片路径或图片数据解码为灰度图，已解码的图片原样返回
+        :raise ValueError: 无法解码图片
+        """
+        if isinstance(image, np.ndarray):
+            return image
+        with spans.span("decode"):
+            img = self.extractor.read(image)
+        if img is None:
+            raise ValueError("无法读取图片")
+        return img
+
+    def match_signature(
+        self,
+        img: cv2.typing.MatLike,
+        top_k: int | None = None,
+        spans: Spans = NULL_SPANS,
+    ) -> list[tuple[str, int, float]]:
+        """
+        使用感知哈希查找重复的图片
+        :param img: 灰度图
+        :param top_k: 返回结果数量，为 None 时返回全部结果
+        :param spans: 记录计算与查找哈希的耗时
+        :return: 按汉明距离升序排列的 (文件名, 图片 ID, 分数)，分数为 1 - 距离 / 64
+        """
+        with spans.span("signature"):
+            found = self.mdb.find_signatures(phash(img), self.signature_distance)[:top_k]
+            filenames = self.mdb.get_images_by_ids([image_id for image_id, _ in found])
+        return [
+            (filename.decode(), image_id, 1 - distance / 64)
+            for (image_id, distance), filename in zip(found, filenames)
+            if filename is not None
+        ]
+
+    def extract_points(
+        self,
+        image: str | Buffer | cv2.typing.MatLike,
+        limit: int,
+        spans: Spans = NULL_SPANS,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        提取特征点坐标与特征向量
+        :return: 形状为 (n, 2) 的特征点坐标与特征向量
+        """
+        img = self.decode(image, spans)
+        kps, des = self.extractor.detect_and_compute(img, limit, spans=spans)
+        return cv2.KeyPoint_convert(kps), des
+
+    def _search(
+        self,
+        vectors: np.ndarray,
+        search_list: int,
+        limit: int,
+        partitions: typing.Sequence[str] | None,
+    ) -> SearchHits:
+        if partitions is None:
+            return self.store.search(vectors, search_list, limit)
+        if not isinstance(self.store, PartitionedStore):
+            raise ValueError(f"集合 {self.collection} 没有分区")
+        return self.store.search(vectors, search_list, limit, partitions)
+
+    def search_descriptors(
+        self,
+        des: np.ndarray | None,
+        search_list: int,
+        limit: int,
+        partitions: typing.Sequence[str] | None = None,
+    ) -> SearchHits:
+        """
+        在集合中搜索特征向量
+        :param des: 特征向量
+        :param search_list: 搜索列表大小，越大越准确，但是速度越慢
+        :param limit: 每个向量的匹配数量
+        :param partitions: 搜索的分区，仅用于分区集合，默认为所有已加载的分区
+        :return: 搜索结果
+        """
+        if des is None or len(des) == 0:
+            return SearchHits.empty()
+        return self._search(des, search_list, limit, partitions)
+
+    def search_many(
+        self,
+        des_list: typing.Sequence[np.ndarray | None],
+        search_list: int,
+        limit: int,
+        max_vectors: int = MAX_SEARCH_VECTORS,
+        partitions: typing.Sequence[str] | None = None,
+    ) -> list[SearchHits]:
+        """
+        将多张图片的特征向量合并为少数几次搜索，再按图片拆分搜索结果
+        :param des_list: 每张图片的特征向量，None 表示没有特征点
+        :param search_list: 搜索列表大小，越大越准确，但是速度越慢
+        :param limit: 每个向量的匹配数量
+        :param max_vectors: 单次搜索的最大向量数
+        :param partitions: 搜索的分区，仅用于分区集合，默认为所有已加载的分区
+        :return: 与 des_list 一一对应的搜索结果
+        """
+        sizes = [0 if des is None else len(des) for des in des_list]
+        total = sum(sizes)
+        if total == 0:
+            return [SearchHits.empty() for _ in des_list]
+        data = np.concatenate([des for des in des_list if des is not None and len(des)])
+        results = SearchHits.concat(
+            [
+                self._search(data[i : i + max_vectors], search_list, limit, partitions)
+                for i in range(0, total, max_vectors)
+            ]
+        )
+        bounds = np.cumsum([0] + sizes)
+        return [results[lo:hi] for lo, hi in zip(bounds[:-1], bounds[1:])]
+
+    def aggregate(
+        self,
+        results: SearchHits,
+        top_k: int | None = None,
+        spans: Spans = NULL_SPANS,
+    ) -> list[tuple[str, int, float]]:
+        """
+        将各个向量的匹配结果按图片汇总并评分
+        :param results: 搜索结果
+        :param top_k: 返回结果数量，为 None 时返回全部结果
+        :param spans: 记录评分与查询 LMDB 的耗时
+        :return: 按分数降序排列的 (文件名, 图片 ID, 分数)
+        """
+        if len(results.images) == 0:
+            return []
+        with spans.span("aggregate"):
+            image_ids, groups = np.unique(results.images, return_inverse=True)
+            scores = wilson_scores(groups, results.distances, len(image_ids))
+
+            if top_k is not None and top_k < len(scores):
+                top = np.argpartition(-scores, top_k - 1)[:top_k]
+            else:
+                top = np.arange(len(scores))
+            top = top[np.argsort(-scores[top], kind="stable")]
+
+        image_ids = image_ids[top].tolist()
+        with spans.span("lmdb"):
+            filenames = self.mdb.get_images_by_ids(image_ids)
+        # 后端的删除可能还没有对搜索生效，跳过已经删除记录的图片
+        return [
+            (filename.decode(), image_id, float(score))
+            for filename, image_id, score in zip(filenames, image_ids, scores[top])
+            if filename is not None
+        ]
+
+    def descriptor_store(self) -> DescriptorStore | None:
+        """用于读取保存的特征向量的存储，集合没有保存特征向量时返回 None"""
+        if self.descriptors is not None:
+            return self.descriptors
+        if DescriptorStore.exists(self.collection):
+            return DescriptorStore(self.collection)
+        return None
+
+    def rerank(
+        self,
+        points: np.ndarray,
+        des: np.ndarray | None,
+        candidates: list[tuple[str, int, float]],
+        count: int,
+        top_k: int | None = None,
+        ratio: float = 0.75,
+        spans: Spans = NULL_SPANS,
+    ) -> list[tuple[str, int, float]]:
+        """
+        使用几何验证对搜索结果重新排序
+
+        对前 count 个候选图片，读取保存的特征点与特征向量，
+        经过比率测试筛选匹配后使用 RANSAC 估计单应性矩阵，以内点数作为新的分数。
+        没有保存特征点的候选图片内点数记为 0，内点数相同时保持原有顺序。
+        :param points: 被搜索图片的特征点坐标
+        :param des: 被搜索图片的特征向量
+        :param candidates: aggregate 返回的搜索结果
+        :param count: 参与重排的候选图片数量
+        :param top_k: 返回结果数量，为 None 时返回全部结果
+        :param ratio: 比率测试的阈值，最近邻与次近邻的距离之比小于该值时保留匹配
+        :param spans: 记录重排的耗时
+        :return: 按内点数降序排列的 (文件名, 图片 ID, 内点数)，之后是未参与重排的候选图片
+        """
+        store = self.descriptor_store()
+        head, tail = candidates[:count], candidates[count:]
+        if store is None or des is None or len(des) < 2:
+            return candidates[:top_k]
+        with spans.span("rerank"):
+            variant = descriptor_variant(
+                self.extractor_name, self.filter_name, self.descriptor_limit
+            )
+            stored = store.get_many(variant, [image_id for _, image_id, _ in head])
+            query = np.asarray(des, dtype=np.float32)
+            matcher = cv2.BFMatcher(cv2.NORM_L2)
+            scored = []
+            for (filename, image_id, _), item in zip(head, stored):
+                inliers = 0
+                if item is not None and len(item[1]) >= 2:
+                    train_points, train_des = item
+                    good = [
+                        pair[0]
+                        for pair in matcher.knnMatch(query, train_des, k=2)
+                        if len(pair) == 2 and pair[0].distance < ratio * pair[1].distance
+                    ]
+                    # 估计单应性矩阵至少需要 4 对匹配
+                    if len(good) >= 4:
+                        src = points[[m.queryIdx for m in good]]
+                        dst = train_points[[m.trainIdx for m in good]]
+                        _, mask = cv2.findHomography(src, dst, cv2.RANSAC, 5.0)
+                        if mask is not None:
+                            inliers = int(mask.sum())
+                scored.append((filename, image_id, float(inliers)))
+            scored.sort(key=lambda item: -item[2])
+        return (scored + tail)[:top_k]
 
     def search_image(
         self,
-        image: str | cv2.typing.MatLike,
+        image: str | Buffer | cv2.typing.MatLike,
         search_list: int = 16,
         search_limit: int = 100,
         limit: int = 100,
+        top_k: int | None = 20,
+        spans: Spans = NULL_SPANS,
+        rerank: int = 0,
+        partitions: typing.Sequence[str] | None = None,
+        prefilter: bool | None = None,
     ) -> tuple[float, list[tuple[str, int, float]]]:
         """
         在集合中搜索图片
-        :param image: 图片
+        :param image: 图片路径、图片数据或已解码的灰度图，前两者的结果会被缓存
         :param search_list: 搜索列表大小，越大越准确，但是速度越慢
         :param search_limit: 被搜索图片的采样点数量
-        :param limit: 返回结果数量
-        :return:
+        :param limit: 每个向量的匹配数量
+        :param top_k: 返回结果数量，为 None 时返回全部结果
+        :param spans: 记录各阶段的耗时
+        :param rerank: 使用几何验证重排的候选图片数量，为 0 时不重排，需要导入时保存了特征向量
+        :param partitions: 搜索的分区，仅用于分区集合，默认为所有已加载的分区
+        :param prefilter: 是否先用感知哈希查找重复的图片，找到时直接返回，默认使用配置文件中的设置
+        :return: 向量搜索的耗时（秒）与搜索结果
         """
         if isinstance(image, str):
-            img = cv2.imread(image, cv2.IMREAD_GRAYSCALE)
+            # 哈希与解码使用同一份映射的文件内容，文件只读取一次
+            with map_file(image) as data:
+                return self.search_image(
+                    data,
+                    search_list,
+                    search_limit,
+                    limit,
+                    top_k,
+                    spans,
+                    rerank,
+                    partitions,
+                    prefilter,
+                )
+        digest = None
+        partitions = tuple(partitions) if partitions else None
+        prefilter = use_prefilter(prefilter, partitions)
+        params = (search_list, search_limit, limit, top_k, rerank, partitions, prefilter)
+        if self.cache is not None and not isinstance(image, np.ndarray):
+            with spans.span("hash"):
+                digest = get_image_hash(image)
+            cached = self.cache.get(self.collection, digest, params)
+            if cached is not None:
+                return 0.0, cached
+            generation = self.cache.generation(self.collection)
+
+        img = self.decode(image, spans)
+        if prefilter and (data := self.match_signature(img, top_k, spans)):
+            if digest is not None:
+                self.cache.put(self.collection, digest, params, data, generation)
+            return 0.0, data
+
+        points, des = self.extract_points(img, search_limit, spans)
+
+        start = time.perf_counter()
+        results = self.search_descriptors(des, search_list, limit, partitions)
+        elapsed = time.perf_counter() - start
+        spans.add("ann", elapsed)
+
+        if rerank > 0:
+            candidates = self.aggregate(results, rerank_candidates(top_k, rerank), spans)
+            data = self.rerank(points, des, candidates, rerank, top_k, spans=spans)
         else:
-            img = image
-        _, des = self.extractor.detect_and_compute(img, search_limit)
-
-        now = datetime.now()
-        results = self.collection.search(
-            data=des,
-            anns_field="embedding",
-            param={"search_list": search_list},
-            limit=limit,
-            output_fields=["image"],
-        )
-        elapsed = (datetime.now() - now).total_seconds()
+            data = self.aggregate(results, top_k, spans)
+        if digest is not None:
+            self.cache.put(self.collection, digest, params, data, generation)
+        return elapsed, data
 
-        d = defaultdict(list)
+    def search_images(
+        self,
+        images: typing.Sequence[str | Buffer],
+        search_list: int = 16,
+        search_limit: int = 100,
+        limit: int = 100,
+        top_k: int | None = 20,
+        map: typing.Callable = map,
+        partitions: typing.Sequence[str] | None = None,
+        prefilter: bool | None = None,
+    ) -> tuple[float, list[QueryResult]]:
+        """
+        在集合中批量搜索多张图片
+        :param images: 图片路径或图片数据
+        :param search_list: 搜索列表大小，越大越准确，但是速度越慢
+        :param search_limit: 被搜索图片的采样点数量
+        :param limit: 每个向量的匹配数量
+        :param top_k: 返回结果数量，为 None 时返回全部结果
+        :param map: 用于并行提取特征的 map 函数，例如 ThreadPoolExecutor.map
+        :param partitions: 搜索的分区，仅用于分区集合，默认为所有已加载的分区
+        :param prefilter: 是否先用感知哈希查找重复的图片，默认使用配置文件中的设置
+        :return: 向量搜索的耗时（秒）与每张图片的搜索结果
+        """
+        partitions = tuple(partitions) if partitions else None
+        prefilter = use_prefilter(prefilter, partitions)
+        params = (search_list, search_limit, limit, top_k, 0, partitions, prefilter)
+        results = [QueryResult() for _ in images]
+        digests: list[int | None] = [None] * len(images)
+        pending = []
+        sources = list(images)
+        if self.cache is not None:
+            generation = self.cache.generation(self.collection)
 
-        for result in results:
-            for image in result:
-                d[image.entity.get("image")].append(image.distance)
+        def extract(image):
+            try:
+                img = self.decode(image)
+                if prefilter and (data := self.match_signature(img, top_k)):
+                    return QueryResult(data)
+                return self.extract(img, search_limit)
+            except Exception as e:
+                return e
 
-        d = [
-            (
-                self.mdb.get_image_by_id(mid).decode(),
-                wilson_score(distances),
-            )
-            for mid, distances in d.items()
+        with contextlib.ExitStack() as stack:
+            for i, image in enumerate(images):
+                if self.cache is not None:
+                    try:
+                        if isinstance(image, str):
+                            # 哈希与解码使用同一份映射的文件内容，文件只读取一次
+                            sources[i] = image = stack.enter_context(map_file(image))
+                        digests[i] = get_image_hash(image)
+                    except OSError as e:
+                        results[i].error = e
+                        continue
+                    cached = self.cache.get(self.collection, digests[i], params)
+                    if cached is not None:
+                        results[i] = QueryResult(cached, cached=True)
+                        continue
+                pending.append(i)
+            des_list = list(map(extract, [sources[i] for i in pending]))
+        done = []
+        for i, des in zip(pending, des_list):
+            if isinstance(des, Exception):
+                results[i].error = des
+            elif isinstance(des, QueryResult):
+                results[i] = des
+                done.append(i)
+        for i in done:
+            if digests[i] is not None:
+                self.cache.put(
+                    self.collection, digests[i], params, results[i].result, generation
+                )
+        searched = [
+            (i, des)
+            for i, des in zip(pending, des_list)
+            if not isinstance(des, (Exception, QueryResult))
         ]
-        d.sort(key=lambda x: x[1], reverse=True)
+        pending = [i for i, _ in searched]
+        des_list = [des for _, des in searched]
+
+        start = time.perf_counter()
+        hits = self.search_many(des_list, search_list, limit, partitions=partitions)
+        elapsed = time.perf_counter() - start
 
-        return elapsed, d
+        for i, data in zip(pending, map(lambda h: self.aggregate(h, top_k), hits)):
+            results[i].result = data
+            if digests[i] is not None:
+                self.cache.put(self.collection, digests[i], params, data, generation)
+        return elapsed, results
 
     # def __del__(self):
     #     self.collection.release()
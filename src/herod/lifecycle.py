@@ -0,0 +1,217 @@
+import asyncio
+import time
+import typing
+
+from loguru import logger
+
+from herod.indexer import Indexer
+
+
+class LoadPending(Exception):
+    """集合正在后台加载，请求没有等到加载完成"""
+
+    def __init__(self, collection: str):
+        super().__init__(f"集合 {collection} 正在加载，请稍后重试")
+        self.collection = collection
+
+
+class _Status:
+    def __init__(self):
+        self.task: asyncio.Task | None = None
+        self.error: str | None = None
+        # 加载后占用内存的估计值
+        self.memory = 0
+        # 成功加载的次数
+        self.loads = 0
+        self.last_used = time.monotonic()
+
+
+class CollectionManager:
+    """
+    集合索引的生命周期管理
+
+    启动时在后台加载配置的集合；搜索未加载的集合时在后台加载，请求最多等待 wait 秒，
+    超时后由调用者返回 503，加载继续进行，不会让请求承担整个加载的耗时。
+    已加载集合的内存估计值之和超过预算时，按最近使用的时间释放空闲的集合，
+    被释放的集合在下次搜索时重新加载。
+    """
+
+    def __init__(
+        self,
+        indexers: dict[str, Indexer],
+        run: typing.Callable[..., typing.Awaitable],
+        budget: int = 0,
+        wait: float = 1.0,
+        busy: typing.Callable[[str], bool] = lambda collection: False,
+    ):
+        """
+        :param indexers: 集合名称 -> Indexer，由服务器负责创建
+        :param run: 用于在线程池中执行阻塞函数的协程函数
+        :param budget: 已加载集合的内存预算（字节），为 0 时不限制
+        :param wait: 请求等待加载完成的最长时间（秒）
+        :param busy: 判断集合是否有正在处理的请求，有请求时不会被释放
+        """
+        self.indexers = indexers
+        self.run = run
+        self.budget = budget
+        self.wait = wait
+        self.busy = busy
+        self.status: dict[str, _Status] = {}
+        # 启动时预加载的集合，全部加载完成后服务器才算就绪
+        self.preload: set[str] = set()
+
+    def _status(self, collection: str) -> _Status:
+        return self.status.setdefault(collection, _Status())
+
+    def touch(self, collection: str):
+        """记录集合的使用时间"""
+        self._status(collection).last_used = time.monotonic()
+
+    def load(self, idx: Indexer) -> asyncio.Task:
+        """在后台加载集合的索引，已经在加载时返回同一个任务"""
+        status = self._status(idx.collection)
+        if status.task is None or status.task.done():
+            status.task = asyncio.ensure_future(self._load(idx, status))
+        return status.task
+
+    async def _load(self, idx: Indexer, status: _Status):
+        start = time.perf_counter()
+        try:
+            await self.run(idx.load)
+            status.memory = await self.run(idx.store.memory_size)
+        except Exception as e:
+            # 错误记录在状态中，由等待的请求抛出，没有请求等待时也不会产生未处理的异常
+            status.error = str(e)
+            logger.exception(f"加载集合 {idx.collection} 失败")
+            return
+        status.error = None
+        status.loads += 1
+        logger.info(
+            f"集合 {idx.collection} 加载完成，耗时 {time.perf_counter() - start:.1f} 秒，"
+            f"估计占用 {status.memory / (1 << 20):.1f} MiB"
+        )
+        await self.evict(keep=idx.collection)
+
+    async def refresh(self, idx: Indexer):
+        """分区集合加载或释放部分分区后，重新估计集合的内存占用"""
+        self.touch(idx.collection)
+        self._status(idx.collection).memory = await self.run(idx.store.memory_size)
+        await self.evict(keep=idx.collection)
+
+    async def ensure_loaded(self, idx: Indexer):
+        """
+        确保集合的索引已经加载，最多等待 wait 秒
+        :raise LoadPending: 等待超时，加载在后台继续进行
+        :raise RuntimeError: 加载失败，下次请求时会重新加载
+        """
+        self.touch(idx.collection)
+        if idx.loaded:
+            return
+        task = self.load(idx)
+        try:
+            # 请求被取消或超时时不取消加载
+            await asyncio.wait_for(asyncio.shield(task), self.wait)
+        except asyncio.TimeoutError:
+            raise LoadPending(idx.collection)
+        if not idx.loaded:
+            error = self._status(idx.collection).error
+            raise RuntimeError(f"加载集合 {idx.collection} 失败：{error}")
+
+    def start_preload(
+        self,
+        collections: list[str],
+        create: typing.Callable[[str], typing.Awaitable[Indexer]],
+    ) -> asyncio.Task:
+        """
+        在后台依次创建并加载集合，避免同时加载多个集合时内存占用过高
+        :param collections: 预加载的集合
+        :param create: 创建集合 Indexer 的协程函数
+        """
+        self.preload.update(collections)
+
+        async def preload():
+            for collection in collections:
+                try:
+                    idx = await create(collection)
+                except Exception as e:
+                    self._status(collection).error = str(e)
+                    logger.exception(f"预加载集合 {collection} 失败")
+                    continue
+                await self.load(idx)
+
+        return asyncio.ensure_future(preload())
+
+    async def evict(self, keep: str | None = None):
+        """
+        已加载集合的内存超过预算时，按最近使用的时间释放空闲的集合
+        :param keep: 不释放的集合，通常是刚刚加载的集合
+        """
+        if self.budget <= 0:
+            return
+        loaded = [
+            collection for collection, idx in self.indexers.items() if idx.loaded
+        ]
+        total = sum(self._status(collection).memory for collection in loaded)
+        for collection in sorted(loaded, key=lambda c: self._status(c).last_used):
+            if total <= self.budget:
+                break
+            if collection == keep or self.busy(collection):
+                continue
+            total -= self._status(collection).memory
+            await self.release(collection)
+        if total > self.budget:
+            logger.warning(
+                f"已加载集合的内存 {total / (1 << 20):.1f} MiB 超过预算，"
+                "其余集合正在使用中，无法释放"
+            )
+
+    async def release(self, collection: str):
+        """释放集合的索引，集合的 Indexer 仍然保留，可以继续写入"""
+        idx = self.indexers.get(collection)
+        if idx is None or not idx.loaded:
+            return
+        logger.info(f"释放集合 {collection} 的索引")
+        await self.run(idx.release)
+        self._status(collection).memory = 0
+
+    async def unload(self, collection: str) -> Indexer:
+        """移除集合的 Indexer，由调用者负责关闭"""
+        idx = self.indexers.pop(collection)
+        status = self.status.pop(collection, None)
+        if status is not None and status.task is not None:
+            status.task.cancel()
+        return idx
+
+    @property
+    def ready(self) -> bool:
+        """预加载的集合是否都已加载完成"""
+        return all(self._status(collection).loads > 0 for collection in self.preload)
+
+    def health(self) -> dict:
+        """所有集合的加载状态"""
+        now = time.monotonic()
+        collections = {}
+        for collection in sorted(self.preload | set(self.indexers)):
+            idx = self.indexers.get(collection)
+            status = self._status(collection)
+            if status.task is not None and not status.task.done():
+                state = "loading"
+            elif idx is not None and idx.loaded:
+                state = "ready"
+            elif status.error is not None:
+                state = "error"
+            else:
+                state = "released"
+            collections[collection] = {
+                "state": state,
+                "memory": status.memory if state == "ready" else 0,
+                "idle": now - status.last_used,
+                "error": status.error,
+                "preload": collection in self.preload,
+            }
+        return {
+            "ready": self.ready,
+            "memory": sum(item["memory"] for item in collections.values()),
+            "budget": self.budget,
+            "collections": collections,
+        }
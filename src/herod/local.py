@@ -0,0 +1,791 @@
+import contextlib
+import fcntl
+import json
+import os
+import shutil
+import threading
+import time
+import typing
+from pathlib import Path
+
+import numpy as np
+
+from herod import quantize
+from herod.config import config, xdg_data_home
+from herod.enums import Precision
+from herod.store import SearchHits, VectorStore
+
+# 距离计算与 k-means 时每次处理的向量数
+CHUNK_ROWS = 1 << 16
+
+
+def store_dir() -> Path:
+    if config.local.path:
+        return Path(config.local.path)
+    return Path(xdg_data_home()) / "herod" / "vectors"
+
+
+def write_json(path: Path, data: dict):
+    """原子地写入 JSON 文件"""
+    tmp = path.with_suffix(".tmp")
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def file_version(path: Path) -> tuple[int, int]:
+    """
+    文件的 inode 与修改时间，用于判断文件是否被其他进程替换
+    write_json 总是以替换文件的方式写入，两者都不变时内容也不变
+    """
+    st = os.stat(path)
+    return st.st_ino, st.st_mtime_ns
+
+
+@contextlib.contextmanager
+def file_lock(path: Path) -> typing.Iterator[None]:
+    """对 path 加进程间的排他锁（flock），退出时释放，锁文件不存在时自动创建"""
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+def _sq_norms(vectors: np.ndarray) -> np.ndarray:
+    return np.einsum("ij,ij->i", vectors, vectors)
+
+
+def _assign(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """返回每个向量最近的聚类中心"""
+    norms = _sq_norms(centroids)
+    labels = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), CHUNK_ROWS):
+        chunk = np.asarray(vectors[start : start + CHUNK_ROWS], dtype=np.float32)
+        distances = norms[None, :] - 2 * chunk @ centroids.T
+        labels[start : start + len(chunk)] = distances.argmin(axis=1)
+    return labels
+
+
+def kmeans(data: np.ndarray, k: int, iterations: int = 20, seed: int = 0) -> np.ndarray:
+    """
+    使用 Lloyd 算法计算聚类中心
+    :param data: 样本，形状为 (n, dim)
+    :param k: 聚类数量
+    :param iterations: 迭代次数
+    :return: 聚类中心，形状为 (k, dim)
+    """
+    rng = np.random.default_rng(seed)
+    centroids = data[rng.choice(len(data), k, replace=False)].copy()
+    for _ in range(iterations):
+        labels = _assign(data, centroids)
+        counts = np.bincount(labels, minlength=k)
+        order = np.argsort(labels, kind="stable")
+        nonempty = np.flatnonzero(counts)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[nonempty]
+        sums = np.add.reduceat(data[order], starts, axis=0)
+        centroids[nonempty] = sums / counts[nonempty, None]
+        # 空的聚类重新随机选取中心
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            centroids[empty] = data[rng.choice(len(data), len(empty), replace=False)]
+    return centroids
+
+
+class _TopK:
+    """维护每个查询向量距离最小的 k 个结果"""
+
+    def __init__(self, count: int, k: int):
+        self.k = k
+        self.distances = np.full((count, k), np.inf, dtype=np.float32)
+        self.images = np.full((count, k), -1, dtype=np.int64)
+
+    def push(
+        self,
+        rows: np.ndarray,
+        distances: np.ndarray,
+        images: np.ndarray,
+        removed: np.ndarray | None = None,
+    ):
+        """
+        :param rows: 查询向量的下标，不能重复
+        :param distances: 查询向量与候选向量的距离，形状为 (len(rows), m)
+        :param images: 候选向量所属的图片 ID，形状为 (m,)
+        :param removed: 候选向量是否已被删除，形状为 (m,)，已删除的向量不会出现在结果中
+        """
+        if removed is not None and removed.any():
+            distances = np.where(removed, np.inf, distances)
+        if distances.shape[1] > self.k:
+            part = np.argpartition(distances, self.k - 1, axis=1)[:, : self.k]
+            distances = np.take_along_axis(distances, part, axis=1)
+            images = images[part]
+        else:
+            images = np.broadcast_to(images, distances.shape)
+        distances = np.concatenate([self.distances[rows], distances], axis=1)
+        images = np.concatenate([self.images[rows], images], axis=1)
+        part = np.argpartition(distances, self.k - 1, axis=1)[:, : self.k]
+        self.distances[rows] = np.take_along_axis(distances, part, axis=1)
+        self.images[rows] = np.take_along_axis(images, part, axis=1)
+
+    def hits(self) -> SearchHits:
+        order = np.argsort(self.distances, axis=1)
+        distances = np.take_along_axis(self.distances, order, axis=1)
+        images = np.take_along_axis(self.images, order, axis=1)
+        valid = np.isfinite(distances)
+        offsets = np.concatenate([[0], np.cumsum(valid.sum(axis=1))])
+        return SearchHits(images[valid], distances[valid], offsets)
+
+
+def _distances(
+    queries: np.ndarray, query_norms: np.ndarray, vectors: np.ndarray, norms: np.ndarray
+) -> np.ndarray:
+    """计算 L2 距离的平方"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    distances = query_norms[:, None] - 2 * queries @ vectors.T + norms[None, :]
+    return np.maximum(distances, 0, out=distances)
+
+
+def _dead_rows(deleted: np.ndarray, images: np.ndarray, start: int) -> np.ndarray:
+    """
+    连续的一段向量中哪些已被删除
+    :param deleted: 已删除的图片，每行为 (图片 ID, 删除时集合的行数)，按图片 ID 升序排列
+    :param images: 向量所属的图片 ID
+    :param start: 第一个向量在集合中的行号
+    """
+    if len(deleted) == 0:
+        return np.zeros(len(images), dtype=bool)
+    found = np.minimum(np.searchsorted(deleted[:, 0], images), len(deleted) - 1)
+    rows = np.arange(start, start + len(images))
+    return (deleted[found, 0] == images) & (rows < deleted[found, 1])
+
+
+def _index_deleted(deleted: np.ndarray, indexed: int) -> np.ndarray:
+    """
+    需要从索引覆盖的前 indexed 行中排除的图片 ID
+
+    建立索引时已删除的向量不会加入索引，因此索引中的图片只有在建立索引之后才被删除，
+    删除时集合的行数不小于 indexed；删除后重新写入的向量在索引中时，删除时的行数小于 indexed。
+    """
+    return deleted[deleted[:, 1] >= indexed, 0]
+
+
+def _remaining_deleted(current: np.ndarray, compacted: np.ndarray, removed: int) -> np.ndarray:
+    """
+    压缩后仍然需要保留的删除记录
+    :param current: 压缩结束时的删除记录
+    :param compacted: 压缩开始时的删除记录，这些向量已从段文件中删除
+    :param removed: 压缩删除的向量数，压缩期间的删除记录的行数都不小于压缩开始时的行数
+    """
+    found = np.minimum(np.searchsorted(compacted[:, 0], current[:, 0]), len(compacted) - 1)
+    done = (compacted[found] == current).all(axis=1)
+    remaining = current[~done]
+    remaining[:, 1] -= removed
+    return remaining
+
+
+def _same_segments(segments: list[dict], names: list[str]) -> bool:
+    """段文件是否仍然以 names 开头，只有追加的写入时成立，压缩后段会被替换"""
+    return [segment["name"] for segment in segments[: len(names)]] == names
+
+
+class IvfIndex:
+    """
+    倒排文件索引
+
+    向量按所属的聚类排序后保存，offsets[i]:offsets[i + 1] 为第 i 个聚类的向量，
+    所有文件都以内存映射的方式打开。
+    """
+
+    def __init__(self, path: Path, decode=np.asarray):
+        """
+        :param decode: 将存储格式的向量还原为 float32 向量的函数
+        """
+        self.decode = decode
+        self.centroids = np.load(path / "centroids.npy")
+        self.centroid_norms = _sq_norms(self.centroids)
+        self.offsets = np.load(path / "offsets.npy")
+        self.images = np.load(path / "images.npy", mmap_mode="r")
+        self.vectors = np.load(path / "vectors.npy", mmap_mode="r")
+        self.norms = np.load(path / "norms.npy", mmap_mode="r")
+
+    @staticmethod
+    def build(
+        path: Path,
+        store: "LocalStore",
+        rows: int,
+        deleted: np.ndarray,
+        nlist: int | None = None,
+    ):
+        """
+        使用集合中前 rows 个向量建立索引，已删除的向量不加入索引
+        :param path: 索引目录
+        :param store: 集合
+        :param rows: 向量数量
+        :param deleted: 已删除的图片，格式与 LocalStore.deleted 相同
+        :param nlist: 聚类数量，默认为 4 * sqrt(未删除的向量数)
+        """
+        # 找出未删除的行，只有这些行参与聚类并写入索引
+        live = []
+        start = 0
+        for images, _ in store.iter_chunks(rows):
+            dead = _dead_rows(deleted, np.asarray(images), start)
+            live.append(np.flatnonzero(~dead) + start)
+            start += len(images)
+        live = np.concatenate(live)
+        count = len(live)
+        if count == 0:
+            raise ValueError("集合中没有未删除的向量")
+
+        nlist = min(nlist or max(int(4 * np.sqrt(count)), 1), count)
+        rng = np.random.default_rng(0)
+        sample = np.sort(rng.choice(live, min(count, nlist * 64), replace=False))
+        centroids = kmeans(store.decode(store.read_rows(sample)[1]), nlist)
+
+        # 计算所有向量所属的聚类
+        labels = np.concatenate(
+            [
+                _assign(store.decode(vectors), centroids)
+                for _, vectors in store.iter_chunks(rows)
+            ]
+        )[live]
+        order = live[np.argsort(labels, kind="stable")]
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=nlist))])
+
+        path.mkdir(parents=True)
+        np.save(path / "centroids.npy", centroids)
+        np.save(path / "offsets.npy", offsets)
+        images = np.lib.format.open_memmap(
+            path / "images.npy", mode="w+", dtype=np.int64, shape=(count,)
+        )
+        vectors = np.lib.format.open_memmap(
+            path / "vectors.npy",
+            mode="w+",
+            dtype=store.dtype,
+            shape=(count, store.width),
+        )
+        norms = np.lib.format.open_memmap(
+            path / "norms.npy", mode="w+", dtype=np.float32, shape=(count,)
+        )
+        for start in range(0, count, CHUNK_ROWS):
+            chunk_images, chunk_vectors = store.read_rows(order[start : start + CHUNK_ROWS])
+            end = start + len(chunk_images)
+            images[start:end] = chunk_images
+            vectors[start:end] = chunk_vectors
+            norms[start:end] = _sq_norms(store.decode(chunk_vectors))
+        for array in (images, vectors, norms):
+            array.flush()
+
+    def search(
+        self,
+        queries: np.ndarray,
+        query_norms: np.ndarray,
+        nprobe: int,
+        top: _TopK,
+        deleted: np.ndarray,
+    ):
+        """
+        :param deleted: 需要排除的图片 ID，按升序排列
+        """
+        nprobe = min(nprobe, len(self.centroids))
+        distances = self.centroid_norms[None, :] - 2 * queries @ self.centroids.T
+        probe = np.argpartition(distances, nprobe - 1, axis=1)[:, :nprobe]
+
+        # 按聚类分组处理，每个聚类的向量只需要读取一次
+        lists = probe.ravel()
+        rows = np.repeat(np.arange(len(queries)), nprobe)
+        order = np.argsort(lists, kind="stable")
+        lists, rows = lists[order], rows[order]
+        bounds = np.flatnonzero(np.diff(lists)) + 1
+        for group in np.split(np.arange(len(lists)), bounds):
+            cluster = lists[group[0]]
+            lo, hi = self.offsets[cluster], self.offsets[cluster + 1]
+            if lo == hi:
+                continue
+            query_rows = rows[group]
+            block = _distances(
+                queries[query_rows],
+                query_norms[query_rows],
+                self.decode(self.vectors[lo:hi]),
+                self.norms[lo:hi],
+            )
+            images = np.asarray(self.images[lo:hi])
+            removed = np.isin(images, deleted) if len(deleted) else None
+            top.push(query_rows, block, images, removed)
+
+    def compact(self, path: Path, deleted: np.ndarray) -> int:
+        """
+        将删除了部分图片的索引写入 path，聚类中心不变，每个聚类中保持原有的顺序
+        :param deleted: 删除的图片 ID
+        :return: 新索引中的向量数
+        """
+        keep = ~np.isin(self.images, deleted)
+        labels = np.repeat(np.arange(len(self.centroids)), np.diff(self.offsets))
+        counts = np.bincount(labels[keep], minlength=len(self.centroids))
+        rows = int(counts.sum())
+
+        path.mkdir(parents=True)
+        np.save(path / "centroids.npy", self.centroids)
+        np.save(path / "offsets.npy", np.concatenate([[0], np.cumsum(counts)]))
+        arrays = [
+            (
+                source,
+                np.lib.format.open_memmap(
+                    path / name, mode="w+", dtype=source.dtype, shape=(rows, *source.shape[1:])
+                ),
+            )
+            for name, source in (
+                ("images.npy", self.images),
+                ("vectors.npy", self.vectors),
+                ("norms.npy", self.norms),
+            )
+        ]
+        end = 0
+        for start in range(0, len(keep), CHUNK_ROWS):
+            mask = keep[start : start + CHUNK_ROWS]
+            count = int(mask.sum())
+            for source, target in arrays:
+                target[end : end + count] = source[start : start + CHUNK_ROWS][mask]
+            end += count
+        for _, target in arrays:
+            target.flush()
+        return rows
+
+
+class LocalStore(VectorStore):
+    """
+    无需外部服务的嵌入式向量存储
+
+    向量以追加的方式写入段文件（images 与 vectors 两个原始数组文件），
+    段的行数记录在 meta.json 中，超出记录的内容会在下次写入时被截断。
+    多个进程可以同时写入同一个集合：写入时对集合目录中的 lock 文件加 flock，
+    并在锁中重新读取 meta.json；搜索前 meta.json 被其他进程替换时也会重新读取。
+    建立索引后，索引覆盖的向量使用 IVF 搜索，之后新增的向量使用暴力搜索。
+    向量可以使用 float16、int8 或二值化的形式保存，计算距离时还原为 float32。
+    删除图片时只将图片 ID 与当时集合的行数记录在 meta.json 引用的 deleted 文件中，
+    搜索时跳过这些行之前属于该图片的向量，压缩时才从段文件与索引中删除；
+    删除后重新写入的图片追加新的向量，不受之前删除的影响。
+    """
+
+    default_index_type = "IVF_FLAT"
+    index_types = ("IVF_FLAT", "FLAT")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.path = store_dir() / name
+        if not (self.path / "meta.json").exists():
+            raise ValueError(f"集合 {name} 不存在")
+        self.lock = threading.RLock()
+        # 当前线程持有进程间写入锁的层数
+        self._lock_depth = 0
+        self.index: IvfIndex | None = None
+        self._maps: dict[str, tuple[int, np.ndarray, np.ndarray]] = {}
+        # 已删除但尚未压缩的图片，每行为 (图片 ID, 删除时集合的行数)，按图片 ID 升序排列
+        self.deleted = np.empty((0, 2), dtype=np.int64)
+        self.meta: dict = {}
+        self._version: tuple[int, int] | None = None
+        self._reload()
+        self.dim = self.meta["dim"]
+        # 旧版本的集合只有 float32 与 float16 两种存储类型
+        self.precision = Precision(self.meta.get("precision", self.meta["dtype"]))
+        self.dtype = quantize.storage_dtype(self.precision)
+        self.width = quantize.storage_width(self.precision, self.dim)
+
+    @classmethod
+    def create(
+        cls,
+        name: str,
+        description: str = "",
+        dim: int = 64,
+        precision: Precision = Precision.FLOAT32,
+    ):
+        precision = Precision(precision)
+        # 检查维度是否适用于该精度
+        quantize.storage_width(precision, dim)
+        path = store_dir() / name
+        path.mkdir(parents=True)
+        meta = {
+            "description": description,
+            "dim": dim,
+            "dtype": quantize.storage_dtype(precision).name,
+            "precision": precision.value,
+            # int8 量化的缩放系数，在第一次插入时确定
+            "scale": None,
+            "segments": [],
+            "index": None,
+        }
+        write_json(path / "meta.json", meta)
+
+    @classmethod
+    def exists(cls, name: str) -> bool:
+        return (store_dir() / name / "meta.json").exists()
+
+    @classmethod
+    def drop(cls, name: str):
+        shutil.rmtree(store_dir() / name, ignore_errors=True)
+
+    def _reload(self):
+        """meta.json 被其他进程替换后重新读取，同时更新删除的图片、段的映射与已加载的索引"""
+        with self.lock:
+            while True:
+                version = file_version(self.path / "meta.json")
+                if version == self._version:
+                    return
+                with open(self.path / "meta.json") as f:
+                    meta = json.load(f)
+                deleted = meta.get("deleted")
+                try:
+                    if deleted is None:
+                        self.deleted = np.empty((0, 2), dtype=np.int64)
+                    elif deleted != self.meta.get("deleted"):
+                        self.deleted = np.load(self.path / deleted)
+                        if self.deleted.ndim == 1:
+                            # 旧版本只记录图片 ID，图片的所有向量都已删除
+                            rows = sum(segment["rows"] for segment in meta["segments"])
+                            self.deleted = np.stack(
+                                [self.deleted, np.full_like(self.deleted, rows)], axis=1
+                            )
+                except FileNotFoundError:
+                    # 读取后 meta.json 又被替换，旧的 deleted 文件已被删除
+                    continue
+                break
+            index_changed = meta["index"] != self.meta.get("index")
+            self.meta = meta
+            self._version = version
+            names = {segment["name"] for segment in meta["segments"]}
+            for name in list(self._maps):
+                if name not in names:
+                    del self._maps[name]
+            if self.index is not None and index_changed:
+                self.index = None
+                self.load()
+
+    def _save(self):
+        """写入 meta.json，调用者需持有写入锁"""
+        write_json(self.path / "meta.json", self.meta)
+        self._version = file_version(self.path / "meta.json")
+
+    @contextlib.contextmanager
+    def _exclusive(self) -> typing.Iterator[None]:
+        """
+        修改段文件与 meta.json 时持有的锁，可以重入
+        进程内使用 self.lock，进程之间对集合目录中的 lock 文件加 flock，
+        获得锁后重新读取 meta.json，在其他进程写入后的状态上修改
+        """
+        with self.lock:
+            if self._lock_depth > 0:
+                self._lock_depth += 1
+                try:
+                    yield
+                finally:
+                    self._lock_depth -= 1
+                return
+            with file_lock(self.path / "lock"):
+                self._reload()
+                self._lock_depth = 1
+                try:
+                    yield
+                finally:
+                    self._lock_depth = 0
+
+    @property
+    def rows(self) -> int:
+        return sum(segment["rows"] for segment in self.meta["segments"])
+
+    @property
+    def scale(self) -> float:
+        return self.meta.get("scale") or 127.0
+
+    def decode(self, stored: np.ndarray) -> np.ndarray:
+        """将段文件中的向量还原为 float32 向量"""
+        return quantize.decode(stored, self.precision, self.dim, self.scale)
+
+    def _segment_files(self, name: str) -> tuple[Path, Path]:
+        return self.path / f"{name}.images", self.path / f"{name}.vectors"
+
+    def _segment_name(self) -> str:
+        """
+        新段的名称，压缩后段的数量会减少，因此使用单独的计数
+        计数立即写入 meta.json，其他进程不会使用相同的名称
+        """
+        with self._exclusive():
+            number = self.meta.get("next_segment", len(self.meta["segments"]))
+            self.meta["next_segment"] = number + 1
+            self._save()
+        return f"{number:06d}"
+
+    def _set_deleted(self, deleted: np.ndarray):
+        """
+        更新已删除的图片并写入 meta.json，调用者需持有写入锁
+
+        deleted 文件每次使用新的名称，写入 meta.json 后才生效，中断时不会与段文件不一致
+        """
+        old = self.meta.get("deleted")
+        name = None
+        if len(deleted):
+            name = f"deleted-{time.time_ns()}.npy"
+            with open(self.path / name, "wb") as f:
+                np.save(f, deleted)
+                f.flush()
+                os.fsync(f.fileno())
+        self.meta["deleted"] = name
+        self._save()
+        self.deleted = deleted
+        if old is not None:
+            (self.path / old).unlink(missing_ok=True)
+
+    def delete(self, image_ids: np.ndarray):
+        with self._exclusive():
+            image_ids = np.unique(np.asarray(image_ids, dtype=np.int64))
+            # 同一张图片再次删除时，删除时的行数更新为当前的行数
+            kept = self.deleted[~np.isin(self.deleted[:, 0], image_ids)]
+            added = np.stack([image_ids, np.full_like(image_ids, self.rows)], axis=1)
+            deleted = np.concatenate([kept, added])
+            self._set_deleted(deleted[np.argsort(deleted[:, 0], kind="stable")])
+
+    def insert(self, image_ids: np.ndarray, vectors: np.ndarray):
+        image_ids = np.broadcast_to(np.asarray(image_ids, dtype=np.int64), len(vectors))
+        with self._exclusive():
+            if self.precision == Precision.INT8 and self.meta.get("scale") is None:
+                self.meta["scale"] = quantize.int8_scale(vectors)
+            vectors = quantize.encode(vectors, self.precision, self.scale)
+            self._append(self.meta["segments"], image_ids, vectors)
+            self._save()
+
+    def _append(self, segments: list[dict], image_ids: np.ndarray, vectors: np.ndarray):
+        """
+        将已编码的向量追加到最后一段，最后一段已满时新建一段，由调用者写入 meta.json
+        追加到 meta.json 中的段时调用者需持有写入锁，其他进程不会同时写入同一段
+        :param segments: meta.json 中的段，或压缩时新建的段
+        """
+        if not segments or segments[-1]["rows"] >= config.local.segment_rows:
+            segments.append({"name": self._segment_name(), "rows": 0})
+        segment = segments[-1]
+        images_file, vectors_file = self._segment_files(segment["name"])
+        # 截断上次写入失败时残留的数据
+        for file, size in (
+            (images_file, segment["rows"] * 8),
+            (vectors_file, segment["rows"] * self.width * self.dtype.itemsize),
+        ):
+            if file.exists() and file.stat().st_size != size:
+                os.truncate(file, size)
+        for file, data in ((images_file, image_ids), (vectors_file, vectors)):
+            with open(file, "ab") as f:
+                f.write(np.ascontiguousarray(data).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+        segment["rows"] += len(vectors)
+
+    def _segments(self) -> list[tuple[int, np.ndarray, np.ndarray]]:
+        """返回所有段的 (起始行, 图片 ID, 向量)"""
+        result = []
+        start = 0
+        with self.lock:
+            for segment in self.meta["segments"]:
+                name, rows = segment["name"], segment["rows"]
+                if rows == 0:
+                    continue
+                cached = self._maps.get(name)
+                if cached is None or cached[0] != rows:
+                    images_file, vectors_file = self._segment_files(name)
+                    images = np.memmap(images_file, dtype=np.int64, mode="r", shape=(rows,))
+                    vectors = np.memmap(
+                        vectors_file, dtype=self.dtype, mode="r", shape=(rows, self.width)
+                    )
+                    cached = self._maps[name] = (rows, images, vectors)
+                result.append((start, cached[1], cached[2]))
+                start += rows
+        return result
+
+    def iter_chunks(
+        self,
+        rows: int,
+        start: int = 0,
+        segments: list[tuple[int, np.ndarray, np.ndarray]] | None = None,
+    ):
+        """
+        按顺序遍历 [start, rows) 行的 (图片 ID, 向量)
+        :param segments: 之前由 _segments 取得的段，默认使用当前的段
+        """
+        if segments is None:
+            segments = self._segments()
+        for offset, images, vectors in segments:
+            lo = max(start, offset) - offset
+            hi = min(rows, offset + len(images)) - offset
+            for chunk in range(lo, hi, CHUNK_ROWS):
+                end = min(chunk + CHUNK_ROWS, hi)
+                yield images[chunk:end], vectors[chunk:end]
+
+    def read_rows(self, rows: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """读取指定行的 (图片 ID, 向量)"""
+        images = np.empty(len(rows), dtype=np.int64)
+        vectors = np.empty((len(rows), self.width), dtype=self.dtype)
+        for offset, segment_images, segment_vectors in self._segments():
+            mask = (rows >= offset) & (rows < offset + len(segment_images))
+            local = rows[mask] - offset
+            images[mask] = segment_images[local]
+            vectors[mask] = segment_vectors[local]
+        return images, vectors
+
+    def search(self, vectors: np.ndarray, search_list: int, limit: int) -> SearchHits:
+        if self.index is None and self.meta["index"] is not None:
+            self.load()
+        if len(vectors) == 0:
+            return SearchHits.empty()
+        # 查询向量经过与存储相同的转换，二值化时距离即为汉明距离
+        queries = self.decode(quantize.encode(vectors, self.precision, self.scale))
+        query_norms = _sq_norms(queries)
+
+        # 在同一个锁中取得索引、段与删除的图片，压缩替换文件时不会读到不一致的状态
+        with self.lock:
+            self._reload()
+            index = self.index
+            indexed = self.meta["index"]["rows"] if index is not None else 0
+            rows = self.rows
+            segments = self._segments()
+            deleted = self.deleted
+        top = _TopK(len(queries), limit)
+        if index is not None:
+            index.search(
+                queries, query_norms, search_list, top, _index_deleted(deleted, indexed)
+            )
+        # 索引之外的向量使用暴力搜索
+        start = indexed
+        for images, chunk in self.iter_chunks(rows, indexed, segments):
+            images = np.asarray(images)
+            chunk = self.decode(chunk)
+            block = _distances(queries, query_norms, chunk, _sq_norms(chunk))
+            removed = _dead_rows(deleted, images, start)
+            top.push(np.arange(len(queries)), block, images, removed)
+            start += len(images)
+        return top.hits()
+
+    def load(self):
+        with self.lock:
+            self._reload()
+            index = self.meta["index"]
+            if index is not None and index["type"] != "FLAT":
+                self.index = IvfIndex(self.path / index["path"], self.decode)
+
+    def release(self):
+        with self.lock:
+            self.index = None
+            self._maps.clear()
+
+    def memory_size(self) -> int:
+        # 段文件与索引以内存映射的方式读取，按向量与图片 ID 的大小估计
+        return self.rows * (self.dtype.itemsize * self.width + 8)
+
+    def create_index(self, index_type: str | None = None, nlist: int | None = None):
+        """
+        :param nlist: IVF 索引的聚类数量，默认为 4 * sqrt(向量数)
+        """
+        index_type = index_type or self.default_index_type
+        if index_type not in self.index_types:
+            raise ValueError(
+                f"不支持的索引类型 {index_type}，可选：{', '.join(self.index_types)}"
+            )
+        with self.lock:
+            self._reload()
+            rows = self.rows
+            names = [segment["name"] for segment in self.meta["segments"]]
+            deleted = self.deleted
+        if rows == 0:
+            raise ValueError("集合中没有向量")
+        name = f"index-{time.time_ns()}"
+        if index_type == "IVF_FLAT":
+            IvfIndex.build(self.path / name, self, rows, deleted, nlist)
+        with self._exclusive():
+            if not _same_segments(self.meta["segments"], names):
+                shutil.rmtree(self.path / name, ignore_errors=True)
+                raise RuntimeError("建立索引期间集合被压缩，请重新建立索引")
+            old = self.meta["index"]
+            self.meta["index"] = {"type": index_type, "path": name, "rows": rows}
+            self._save()
+            self.index = None
+        self.load()
+        if old is not None and old["path"] != name:
+            shutil.rmtree(self.path / old["path"], ignore_errors=True)
+
+    def drop_index(self):
+        with self._exclusive():
+            old = self.meta["index"]
+            self.meta["index"] = None
+            self._save()
+            self.index = None
+        if old is not None:
+            shutil.rmtree(self.path / old["path"], ignore_errors=True)
+
+    def compact(self):
+        """
+        从段文件与索引中删除已删除图片的向量
+
+        压缩后的段与索引写入新的文件，期间可以继续搜索与写入；最后在锁中追加压缩期间写入的向量，
+        再替换 meta.json。IVF 索引沿用原有的聚类中心，不需要重新建立。
+        同一时间只有一个进程或线程进行压缩，其他的压缩请求直接返回。
+        """
+        with open(self.path / "compact.lock", "a") as guard:
+            try:
+                fcntl.flock(guard, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            self._compact()
+
+    def _compact(self):
+        with self._exclusive():
+            if len(self.deleted) == 0:
+                return
+            deleted = self.deleted
+            rows = self.rows
+            index = self.meta["index"]
+            names = [segment["name"] for segment in self.meta["segments"]]
+            segments = self._segments()
+        new_segments: list[dict] = []
+        new_index = index
+        try:
+            # 索引覆盖的前 index["rows"] 行中保留的向量数
+            indexed = 0
+            position = 0
+            for images, vectors in self.iter_chunks(rows, 0, segments):
+                images = np.asarray(images)
+                keep = ~_dead_rows(deleted, images, position)
+                if index is not None:
+                    indexed += int(keep[: max(index["rows"] - position, 0)].sum())
+                position += len(images)
+                if keep.any():
+                    self._append(new_segments, images[keep], np.asarray(vectors)[keep])
+            removed = rows - sum(segment["rows"] for segment in new_segments)
+            if index is not None:
+                new_index = {**index, "rows": indexed}
+                if index["type"] != "FLAT":
+                    new_index["path"] = f"index-{time.time_ns()}"
+                    IvfIndex(self.path / index["path"]).compact(
+                        self.path / new_index["path"], _index_deleted(deleted, index["rows"])
+                    )
+            with self._exclusive():
+                if self.meta["index"] != index:
+                    raise RuntimeError("压缩期间集合的索引发生了变化，请重新压缩")
+                if not _same_segments(self.meta["segments"], names):
+                    raise RuntimeError("压缩期间集合的段文件发生了变化，请重新压缩")
+                for images, vectors in self.iter_chunks(self.rows, rows):
+                    self._append(new_segments, np.asarray(images), np.asarray(vectors))
+                old_segments = self.meta["segments"]
+                self.meta["segments"] = new_segments
+                self.meta["index"] = new_index
+                # 压缩期间新增或更新的删除记录仍然保留，行数减去压缩删除的向量数
+                self._set_deleted(_remaining_deleted(self.deleted, deleted, removed))
+                self._maps.clear()
+                if self.index is not None:
+                    self.index = None
+                    self.load()
+        except BaseException:
+            self._remove_files(new_segments, new_index, index)
+            raise
+        self._remove_files(old_segments, index, new_index)
+
+    def _remove_files(self, segments: list[dict], index: dict | None, keep: dict | None):
+        """删除段文件与不再使用的索引，正在进行的搜索仍然可以读取已映射的文件"""
+        for segment in segments:
+            for file in self._segment_files(segment["name"]):
+                file.unlink(missing_ok=True)
+        if index is not None and (keep is None or index["path"] != keep["path"]):
+            shutil.rmtree(self.path / index["path"], ignore_errors=True)
@@ -0,0 +1,218 @@
+import abc
+import bisect
+import contextlib
+import threading
+import time
+import typing
+
+# 延迟直方图的默认分桶（秒）
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+class Spans:
+    """
+    记录一次请求中各个阶段的耗时
+
+    使用单调时钟计时，同名的阶段会累加。
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self.timings: dict[str, float] = {}
+
+    @contextlib.contextmanager
+    def span(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name: str, seconds: float):
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    def milliseconds(self) -> dict[str, float]:
+        return {name: seconds * 1000 for name, seconds in self.timings.items()}
+
+
+class _NullSpans(Spans):
+    """不记录任何内容的 Spans，关闭计时时使用，开销只有一次方法调用"""
+
+    enabled = False
+    _context = contextlib.nullcontext()
+
+    def span(self, name: str):
+        return self._context
+
+    def add(self, name: str, seconds: float):
+        pass
+
+
+NULL_SPANS = _NullSpans()
+
+
+def _format_labels(
+    names: tuple[str, ...], values: tuple[str, ...], extra: str = ""
+) -> str:
+    items = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        items.append(extra)
+    return "{" + ",".join(items) + "}" if items else ""
+
+
+class Metric(abc.ABC):
+    type: str
+
+    def __init__(self, name: str, help: str, labels: typing.Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+
+    def _key(self, labels: dict[str, str]) -> tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.labels)
+
+    @abc.abstractmethod
+    def samples(self) -> typing.Iterator[str]:
+        """以 Prometheus 文本格式逐行返回各组标签的值"""
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: typing.Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self.values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = list(self.values.items())
+        for key, value in values:
+            yield f"{self.name}{_format_labels(self.labels, key)} {value}"
+
+
+class Gauge(Metric):
+    """
+    在采集时调用 collect 获取当前值的指标，collect 返回 {标签值: 值}
+
+    也可以通过 type 导出其他模块中已有的计数器。
+    """
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        collect: typing.Callable[[], dict[tuple[str, ...], float]],
+        labels: typing.Sequence[str] = (),
+        type: str = "gauge",
+    ):
+        super().__init__(name, help, labels)
+        self.collect = collect
+        self.type = type
+
+    def samples(self):
+        for key, value in self.collect().items():
+            yield f"{self.name}{_format_labels(self.labels, key)} {value}"
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: typing.Sequence[str] = (),
+        buckets: typing.Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        # 标签值 -> (每个分桶的计数, 总和, 总数)
+        self.values: dict[tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        with self.lock:
+            values = [
+                (key, list(counts), total, count)
+                for key, (counts, total, count) in self.values.items()
+            ]
+        for key, counts, total, count in values:
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                labels = _format_labels(self.labels, key, f'le="{le}"')
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labels, key)} {total}"
+            yield f"{self.name}_count{_format_labels(self.labels, key)} {count}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        """以 Prometheus 文本格式输出所有指标"""
+        return "\n".join(metric.render() for metric in self.metrics.values()) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(
+    Histogram("herod_stage_seconds", "搜索与导入各阶段的耗时", ["stage"])
+)
+REQUEST_SECONDS = REGISTRY.register(
+    Histogram("herod_request_seconds", "请求的总耗时", ["endpoint"])
+)
+INGEST_IMAGES = REGISTRY.register(
+    Counter("herod_ingest_images_total", "导入的图片数", ["status"])
+)
+INGEST_VECTORS = REGISTRY.register(
+    Counter("herod_ingest_vectors_total", "写入的特征向量数")
+)
+
+
+def observe_spans(spans: Spans):
+    """将一次请求的各阶段耗时记录到直方图中"""
+    for name, seconds in spans.timings.items():
+        STAGE_SECONDS.observe(seconds, stage=name)
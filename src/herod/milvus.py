@@ -0,0 +1,171 @@
+import threading
+import numpy as np
+from pymilvus import (
+    connections,
+    utility,
+    FieldSchema,
+    DataType,
+    CollectionSchema,
+    Collection,
+)
+from herod import quantize
+from herod.config import config
+from herod.enums import Precision
+from herod.store import SearchHits, VectorStore
+
+# 单次删除的图片数，避免删除表达式过长
+DELETE_BATCH = 1000
+
+_connect_lock = threading.Lock()
+_connected = False
+
+
+def connect():
+    """在第一次使用时连接 Milvus"""
+    global _connected
+    with _connect_lock:
+        if not _connected:
+            connections.connect(host=config.milvus.host, port=config.milvus.port)
+            _connected = True
+
+
+class MilvusStore(VectorStore):
+    """
+    Milvus 向量存储
+
+    Milvus 2.3 只支持 float32 与二值向量，二值化的集合使用汉明距离搜索。
+    """
+
+    default_index_type = "DISKANN"
+    # 二值向量不支持 DISKANN
+    default_binary_index_type = "BIN_IVF_FLAT"
+
+    def __init__(self, name: str):
+        connect()
+        self.collection = Collection(name=name)
+        field = next(
+            field
+            for field in self.collection.schema.fields
+            if field.name == "embedding"
+        )
+        self.dim = field.params["dim"]
+        if field.dtype == DataType.BINARY_VECTOR:
+            self.precision = Precision.BINARY
+            self.default_index_type = self.default_binary_index_type
+        else:
+            self.precision = Precision.FLOAT32
+
+    @classmethod
+    def create(
+        cls,
+        name: str,
+        description: str = "",
+        dim: int = 64,
+        precision: Precision = Precision.FLOAT32,
+    ):
+        match precision:
+            case Precision.FLOAT32:
+                dtype = DataType.FLOAT_VECTOR
+            case Precision.BINARY:
+                quantize.storage_width(precision, dim)
+                dtype = DataType.BINARY_VECTOR
+            case _:
+                raise ValueError(f"Milvus 不支持 {precision.value} 向量，请使用 local 后端")
+        connect()
+        fields = [
+            FieldSchema(name="id", dtype=DataType.INT64, is_primary=True, auto_id=True),
+            FieldSchema(name="image", dtype=DataType.INT64, description="图片 ID"),
+            FieldSchema(
+                name="embedding",
+                dtype=dtype,
+                dim=dim,
+                description="图片特征向量",
+            ),
+        ]
+        schema = CollectionSchema(fields=fields, description=description)
+        Collection(name=name, schema=schema)
+
+    @classmethod
+    def exists(cls, name: str) -> bool:
+        connect()
+        return utility.has_collection(name)
+
+    @classmethod
+    def drop(cls, name: str):
+        connect()
+        utility.drop_collection(name)
+
+    def _encode(self, vectors: np.ndarray):
+        if self.precision == Precision.BINARY:
+            # pymilvus 要求每个二值向量为一个 bytes
+            return [row.tobytes() for row in quantize.binarize(vectors)]
+        return vectors
+
+    def insert(self, image_ids: np.ndarray, vectors: np.ndarray):
+        self.collection.insert([np.asarray(image_ids).tolist(), self._encode(vectors)])
+
+    def flush(self):
+        self.collection.flush()
+
+    def delete(self, image_ids: np.ndarray):
+        image_ids = np.unique(np.asarray(image_ids, dtype=np.int64)).tolist()
+        for i in range(0, len(image_ids), DELETE_BATCH):
+            self.collection.delete(f"image in {image_ids[i : i + DELETE_BATCH]}")
+
+    def compact(self):
+        # Milvus 在后台合并段并清除已删除的向量，期间集合保持可用
+        self.collection.compact()
+        self.collection.wait_for_compaction_completed()
+
+    def search(self, vectors: np.ndarray, search_list: int, limit: int) -> SearchHits:
+        results = self.collection.search(
+            data=self._encode(vectors),
+            anns_field="embedding",
+            # search_list 用于 DISKANN，nprobe 用于 IVF 系列索引
+            param={"search_list": search_list, "nprobe": search_list},
+            limit=limit,
+            output_fields=["image"],
+        )
+        images = np.fromiter(
+            (hit.entity.get("image") for hits in results for hit in hits),
+            dtype=np.int64,
+        )
+        distances = np.fromiter(
+            (distance for hits in results for distance in hits.distances),
+            dtype=np.float32,
+        )
+        if self.precision == Precision.BINARY:
+            distances = quantize.hamming_to_l2(distances, self.dim)
+        offsets = np.cumsum([0] + [len(hits) for hits in results], dtype=np.int64)
+        return SearchHits(images, distances, offsets)
+
+    def load(self):
+        self.collection.load()
+
+    def release(self):
+        self.collection.release()
+
+    def memory_size(self) -> int:
+        if self.precision == Precision.BINARY:
+            width = self.dim // 8
+        else:
+            width = self.dim * 4
+        # 不同索引类型的实际占用不同，这里按原始向量与图片 ID 的大小估计
+        return self.collection.num_entities * (width + 8)
+
+    def create_index(self, index_type: str | None = None):
+        if self.precision == Precision.BINARY:
+            index_params = {
+                "metric_type": "HAMMING",
+                "index_type": index_type or self.default_index_type,
+                "params": {"nlist": 1024},
+            }
+        else:
+            index_params = {
+                "metric_type": "L2",
+                "index_type": index_type or self.default_index_type,
+            }
+        self.collection.create_index(field_name="embedding", index_params=index_params)
+
+    def drop_index(self):
+        self.collection.drop_index()
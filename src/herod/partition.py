@@ -0,0 +1,297 @@
+import json
+import re
+import threading
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from herod.config import config, xdg_data_home
+from herod.enums import Backend, PartitionKey, Precision
+from herod.local import file_lock, file_version, write_json
+from herod.store import SearchHits, VectorStore, store_class
+
+# 按日期分区时的分区名格式，每个月一个分区
+DATE_FORMAT = "%Y%m"
+
+# 在多个分区中并行搜索
+_EXECUTOR = ThreadPoolExecutor(thread_name_prefix="herod-partition")
+
+
+def partition_dir() -> Path:
+    return Path(xdg_data_home()) / "herod" / "partitions"
+
+
+def partition_name(value: str) -> str:
+    """将日期、来源等分区键转换为合法的分区名，只保留字母、数字与下划线"""
+    name = re.sub(r"[^0-9A-Za-z_]", "_", value)
+    if not name:
+        raise ValueError("分区名不能为空")
+    return name
+
+
+def shard_name(collection: str, partition: str) -> str:
+    """分区在向量存储后端中对应的集合名称"""
+    return f"{collection}__{partition}"
+
+
+class PartitionedStore(VectorStore):
+    """
+    分区集合
+
+    每个分区是后端中一个独立的集合，索引按分区分别建立，也可以单独加载与释放。
+    写入时按日期或指定的来源选择分区，搜索时在多个分区中并行搜索，
+    再按距离合并每个查询向量的结果。
+    分区信息保存在 $XDG_DATA_HOME/herod/partitions/{collection}.json 中，
+    其他进程新建的分区在文件被替换后重新读取时生效。
+    """
+
+    def __init__(
+        self, name: str, backend: Backend | None = None, partition: str | None = None
+    ):
+        """
+        :param name: 集合名称
+        :param backend: 向量存储后端，默认使用创建集合时的后端
+        :param partition: 写入的分区，为 None 时按日期分区的集合使用当前日期
+        """
+        self.name = name
+        self.path = partition_dir() / f"{name}.json"
+        if not self.path.exists():
+            raise ValueError(f"集合 {name} 不存在")
+        self.lock = threading.RLock()
+        self.meta: dict = {}
+        self._version: tuple[int, int] | None = None
+        self.shards: dict[str, VectorStore] = {}
+        # 已加载用于搜索的分区，为 None 时表示尚未加载
+        self.active: set[str] | None = None
+        self._reload()
+        self.key = PartitionKey(self.meta["key"])
+        self.backend = Backend(backend or self.meta["backend"])
+        self.cls = store_class(self.backend)
+        self.dim = self.meta["dim"]
+        self.precision = Precision(self.meta["precision"])
+        self.default_index_type = self.cls.default_index_type
+        self.partition = partition_name(partition) if partition else None
+
+    @classmethod
+    def create(
+        cls,
+        name: str,
+        description: str = "",
+        dim: int = 64,
+        precision: Precision = Precision.FLOAT32,
+        key: PartitionKey = PartitionKey.DATE,
+        backend: Backend | None = None,
+    ):
+        """
+        :param key: 分区键，date 按导入的月份分区，source 按导入时指定的来源分区
+        :param backend: 向量存储后端，默认使用配置文件中的后端
+        """
+        path = partition_dir()
+        path.mkdir(parents=True, exist_ok=True)
+        meta = {
+            "description": description,
+            "dim": dim,
+            "precision": Precision(precision).value,
+            "key": PartitionKey(key).value,
+            "backend": Backend(backend or config.backend).value,
+            "partitions": [],
+        }
+        write_json(path / f"{name}.json", meta)
+
+    @classmethod
+    def exists(cls, name: str) -> bool:
+        return (partition_dir() / f"{name}.json").exists()
+
+    @classmethod
+    def drop(cls, name: str):
+        store = cls(name)
+        for partition in store.partitions:
+            store.cls.drop(shard_name(name, partition))
+        store.path.unlink()
+        store.path.with_suffix(".lock").unlink(missing_ok=True)
+
+    def _reload(self):
+        """
+        分区信息被其他进程替换后重新读取
+        已经加载了分区用于搜索时，其他进程新建的分区也会被加载
+        """
+        with self.lock:
+            version = file_version(self.path)
+            if version == self._version:
+                return
+            with open(self.path) as f:
+                meta = json.load(f)
+            known = set(self.meta.get("partitions", []))
+            added = [p for p in meta["partitions"] if p not in known]
+            self.meta = meta
+            self._version = version
+            if self.active is not None:
+                for partition in added:
+                    self.shard(partition).load()
+                    self.active.add(partition)
+
+    @property
+    def partitions(self) -> list[str]:
+        with self.lock:
+            self._reload()
+            return list(self.meta["partitions"])
+
+    def shard(self, partition: str) -> VectorStore:
+        """打开一个已存在的分区"""
+        with self.lock:
+            if partition not in self.meta["partitions"]:
+                self._reload()
+            if partition not in self.meta["partitions"]:
+                raise ValueError(f"集合 {self.name} 中不存在分区 {partition}")
+            if partition not in self.shards:
+                self.shards[partition] = self.cls(shard_name(self.name, partition))
+            return self.shards[partition]
+
+    def _write_partition(self, partition: str | None) -> str:
+        partition = partition or self.partition
+        if partition is not None:
+            return partition_name(partition)
+        if self.key == PartitionKey.DATE:
+            return time.strftime(DATE_FORMAT)
+        raise ValueError(f"集合 {self.name} 按来源分区，写入时需要指定分区")
+
+    def _create_shard(self, partition: str) -> VectorStore:
+        """在第一次写入时建立分区，在进程间的锁中重新读取分区信息，不会重复建立"""
+        with self.lock:
+            if partition in self.meta["partitions"]:
+                return self.shard(partition)
+            with file_lock(self.path.with_suffix(".lock")):
+                self._reload()
+                if partition in self.meta["partitions"]:
+                    return self.shard(partition)
+                name = shard_name(self.name, partition)
+                self.cls.create(name, self.meta["description"], self.dim, self.precision)
+                shard = self.shards[partition] = self.cls(name)
+                # Milvus 的集合需要建立索引后才能加载，新分区的索引随写入的段逐步建立
+                # 在写入分区信息前建立，其他进程读取到新分区时可以直接加载
+                if self.backend == Backend.MILVUS:
+                    shard.create_index()
+                self.meta["partitions"].append(partition)
+                write_json(self.path, self.meta)
+                self._version = file_version(self.path)
+            if self.active is not None:
+                shard.load()
+                self.active.add(partition)
+            return shard
+
+    def insert(
+        self, image_ids: np.ndarray, vectors: np.ndarray, partition: str | None = None
+    ):
+        """
+        :param partition: 写入的分区，默认使用打开集合时指定的分区或当前日期
+        """
+        self._create_shard(self._write_partition(partition)).insert(image_ids, vectors)
+
+    def flush(self):
+        with self.lock:
+            shards = list(self.shards.values())
+        for shard in shards:
+            shard.flush()
+
+    def delete(self, image_ids: np.ndarray):
+        """图片可能位于任意分区，因此在所有分区中删除"""
+        for partition in self.partitions:
+            self.shard(partition).delete(image_ids)
+
+    def compact(self, partitions: typing.Iterable[str] | None = None):
+        """
+        依次压缩每个分区
+        :param partitions: 压缩的分区，默认为全部分区
+        """
+        for partition in self.partitions if partitions is None else partitions:
+            self.shard(partition).compact()
+
+    def _targets(self, partitions: typing.Iterable[str] | None) -> list[str]:
+        if partitions is None:
+            with self.lock:
+                self._reload()
+                active = self.active
+            return sorted(active) if active is not None else self.partitions
+        partitions = [partition_name(partition) for partition in partitions]
+        # 搜索已释放的分区时重新加载
+        with self.lock:
+            self._reload()
+            missing = (
+                [p for p in partitions if p not in self.active]
+                if self.active is not None
+                else []
+            )
+        if missing:
+            self.load(missing)
+        return partitions
+
+    def search(
+        self,
+        vectors: np.ndarray,
+        search_list: int,
+        limit: int,
+        partitions: typing.Iterable[str] | None = None,
+    ) -> SearchHits:
+        """
+        :param partitions: 搜索的分区，默认为所有已加载的分区，未加载任何分区时搜索全部分区
+        """
+        shards = [self.shard(partition) for partition in self._targets(partitions)]
+        if not shards or len(vectors) == 0:
+            return SearchHits.empty(len(vectors))
+        if len(shards) == 1:
+            return shards[0].search(vectors, search_list, limit)
+        futures = [
+            _EXECUTOR.submit(shard.search, vectors, search_list, limit)
+            for shard in shards
+        ]
+        return SearchHits.merge([future.result() for future in futures], limit)
+
+    def load(self, partitions: typing.Iterable[str] | None = None):
+        """
+        :param partitions: 加载的分区，默认为全部分区
+        """
+        partitions = self.partitions if partitions is None else list(partitions)
+        for partition in partitions:
+            self.shard(partition).load()
+        with self.lock:
+            self.active = (self.active or set()) | set(partitions)
+
+    def release(self, partitions: typing.Iterable[str] | None = None):
+        """
+        :param partitions: 释放的分区，默认为全部分区
+        """
+        partitions = self.partitions if partitions is None else list(partitions)
+        for partition in partitions:
+            self.shard(partition).release()
+        with self.lock:
+            if self.active is not None:
+                self.active -= set(partitions)
+
+    def memory_size(self) -> int:
+        """已加载分区的内存占用之和"""
+        with self.lock:
+            active = self.active
+        partitions = self.partitions if active is None else sorted(active)
+        return sum(self.shard(partition).memory_size() for partition in partitions)
+
+    def create_index(
+        self,
+        index_type: str | None = None,
+        partitions: typing.Iterable[str] | None = None,
+    ):
+        """
+        依次为每个分区建立索引，内存占用只与单个分区的大小有关
+        :param partitions: 建立索引的分区，默认为全部分区
+        """
+        for partition in self.partitions if partitions is None else partitions:
+            self.shard(partition).create_index(index_type)
+
+    def drop_index(self, partitions: typing.Iterable[str] | None = None):
+        """
+        :param partitions: 删除索引的分区，默认为全部分区
+        """
+        for partition in self.partitions if partitions is None else partitions:
+            self.shard(partition).drop_index()
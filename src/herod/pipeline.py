@@ -0,0 +1,246 @@
+import collections
+import contextlib
+import multiprocessing
+import queue
+import threading
+import time
+import typing
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from herod.buffer import map_file
+from herod.database import FileStat, IndexedImages, file_stat, get_image_hash
+from herod.feature import FeatureExtractor, Extractor, Filter, phash
+from herod.indexer import Indexer
+
+# 每个工作进程中的特征提取器
+_extractor: FeatureExtractor | None = None
+# 每个工作进程中只读的已索引图片
+_indexed: IndexedImages | None = None
+
+# 读取线程每次在 LMDB 中批量查找的文件数
+STAT_BATCH = 256
+
+
+def _chunks(items: typing.Iterable, size: int) -> typing.Iterator[list]:
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _init_worker(extractor: Extractor, filter: Filter, lmdb_path: str):
+    global _extractor, _indexed
+    # 多进程并行时关闭 OpenCV 内部的线程池，避免线程数超过核心数
+    cv2.setNumThreads(1)
+    _extractor = FeatureExtractor(extractor, filter, tile_workers=1)
+    _indexed = IndexedImages(lmdb_path)
+
+
+def extract_file(
+    filename: str, limit: int
+) -> tuple[int, bool, tuple[np.ndarray, np.ndarray, int] | None]:
+    """
+    在工作进程中计算图片 ID 并提取特征向量，哈希与解码使用同一份映射的文件内容，文件只读取一次
+    已索引的图片在解码前跳过
+    :param filename: 文件名
+    :param limit: 特征点数量
+    :return: 图片 ID、图片是否已被索引，以及特征点坐标、特征向量与感知哈希，
+             已被索引或没有特征点时最后一项为 None
+    """
+    with map_file(filename) as data:
+        image_id = get_image_hash(data)
+        if _indexed.contains(image_id):
+            return image_id, True, None
+        img = _extractor.read(data)
+    if img is None:
+        raise ValueError("无法读取图片")
+    kps, des = _extractor.detect_and_compute(img, limit)
+    if not kps:
+        return image_id, False, None
+    return image_id, False, (cv2.KeyPoint_convert(kps), des, phash(img))
+
+
+class IngestResult:
+    def __init__(self, filename: str, status: str, error: Exception | None = None):
+        """
+        :param filename: 文件名
+        :param status: 处理结果，added / skipped / unchanged / empty / error
+        :param error: 出现错误时的异常
+        """
+        self.filename = filename
+        self.status = status
+        self.error = error
+
+
+class IngestPipeline:
+    """
+    分阶段的图片导入流水线
+
+    1. 读取线程：遍历文件，跳过未修改的文件
+    2. 进程池：计算哈希并跳过已索引的图片，解码、缩放、检测特征点并计算特征向量
+    3. 写入线程（调用者所在线程）：跳过正在等待写入的重复图片，唯一的 Milvus 与 LMDB 写入者
+
+    各阶段之间使用有界队列连接，下游处理不过来时上游会被阻塞。
+    写入缓冲区的图片在所在批次提交后才返回结果，写入失败时报告给这一批中的图片。
+    """
+
+    def __init__(
+        self,
+        indexer: Indexer,
+        extractor: Extractor = Extractor.SURF,
+        filter: Filter = Filter.FUFP,
+        limit: int = 500,
+        workers: int | None = None,
+        queue_size: int | None = None,
+    ):
+        """
+        :param indexer: 用于写入的 Indexer
+        :param extractor: 特征点提取算法
+        :param filter: 特征点均匀化算法
+        :param limit: 特征点数量
+        :param workers: 特征提取进程数，默认为 CPU 核心数
+        :param queue_size: 等待写入的最大图片数，默认为进程数的 4 倍
+        """
+        self.indexer = indexer
+        self.extractor = extractor
+        self.filter = filter
+        self.limit = limit
+        self.workers = workers or multiprocessing.cpu_count()
+        self.queue_size = queue_size or self.workers * 4
+
+    def run(self, files: typing.Iterable[Path]) -> typing.Iterator[IngestResult]:
+        """
+        导入一组图片，按处理完成的顺序逐个返回结果
+        :param files: 图片路径
+        """
+        pending: queue.Queue = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+
+        # 使用 spawn 启动工作进程，避免 fork 时继承 gRPC 连接与 OpenCV 线程池
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(self.extractor, self.filter, self.indexer.mdb.env.path()),
+        ) as executor:
+
+            def feed():
+                try:
+                    for chunk in _chunks(files, STAT_BATCH):
+                        if stop.is_set():
+                            break
+                        stats = []
+                        for file in chunk:
+                            filename = str(file)
+                            try:
+                                stats.append((filename, file_stat(filename)))
+                            except Exception as e:
+                                pending.put(IngestResult(filename, "error", e))
+                        # 在同一个事务中跳过未修改的文件
+                        found = self.indexer.mdb.get_images_by_files(stats)
+                        for (filename, stat), image_id in zip(stats, found):
+                            if stop.is_set():
+                                break
+                            if image_id is not None:
+                                pending.put(IngestResult(filename, "unchanged"))
+                                continue
+                            future = executor.submit(extract_file, filename, self.limit)
+                            pending.put((filename, stat, future))
+                finally:
+                    pending.put(None)
+
+            feeder = threading.Thread(target=feed, daemon=True)
+            feeder.start()
+            # 等待所在批次提交的结果
+            written: collections.deque[tuple[IngestResult, Future]]
+            written = collections.deque()
+            try:
+                while (item := pending.get()) is not None:
+                    if isinstance(item, IngestResult):
+                        yield item
+                        continue
+                    result, future = self._write(*item)
+                    if future is None:
+                        yield result
+                    else:
+                        written.append((result, future))
+                    while written and written[0][1].done():
+                        yield self._committed(*written.popleft())
+                with contextlib.suppress(Exception):
+                    # 写入失败由每张图片的结果报告
+                    self.indexer.flush()
+                while written:
+                    yield self._committed(*written.popleft())
+            finally:
+                stop.set()
+                # 清空队列，让读取线程能够退出
+                while feeder.is_alive():
+                    try:
+                        item = pending.get(timeout=0.1)
+                    except queue.Empty:
+                        continue
+                    if isinstance(item, tuple):
+                        item[2].cancel()
+                feeder.join()
+
+    def _write(
+        self,
+        filename: str,
+        stat: FileStat,
+        task: Future,
+    ) -> tuple[IngestResult, Future | None]:
+        """写入一张图片，返回处理结果与写入完成的 Future"""
+        try:
+            image_id, indexed, extracted = task.result()
+            # 工作进程检查之后，内容相同的另一个文件可能已经写入或正在等待写入
+            if indexed or self.indexer.is_indexed(image_id):
+                written = self.indexer.record(image_id, filename, stat)
+                return IngestResult(filename, "skipped"), written
+            if extracted is None:
+                return IngestResult(filename, "empty"), None
+            points, des, signature = extracted
+            written = self.indexer.insert(
+                image_id, filename, des, stat, self.limit, points, signature
+            )
+            return IngestResult(filename, "added"), written
+        except Exception as e:
+            return IngestResult(filename, "error", e), None
+
+    @staticmethod
+    def _committed(result: IngestResult, written: Future) -> IngestResult:
+        """所在批次提交后的结果，写入失败时改为错误"""
+        error = written.exception()
+        if error is not None:
+            return IngestResult(result.filename, "error", error)
+        return result
+
+
+class IngestStats:
+    def __init__(self):
+        self.start = time.monotonic()
+        self.count: dict[str, int] = {}
+
+    def update(self, result: IngestResult):
+        self.count[result.status] = self.count.get(result.status, 0) + 1
+
+    @property
+    def total(self) -> int:
+        return sum(self.count.values())
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.start
+
+    @property
+    def rate(self) -> float:
+        """每秒处理的图片数"""
+        return self.total / max(self.elapsed, 1e-9)
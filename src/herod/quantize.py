@@ -0,0 +1,91 @@
+import numpy as np
+from herod.enums import Precision
+
+
+def storage_dtype(precision: Precision) -> np.dtype:
+    """向量在存储中的数据类型"""
+    match precision:
+        case Precision.FLOAT32:
+            return np.dtype(np.float32)
+        case Precision.FLOAT16:
+            return np.dtype(np.float16)
+        case Precision.INT8:
+            return np.dtype(np.int8)
+        case Precision.BINARY:
+            return np.dtype(np.uint8)
+    raise ValueError(f"不支持的精度 {precision}")
+
+
+def storage_width(precision: Precision, dim: int) -> int:
+    """每个向量在存储中占用的元素数，二值化的向量每 8 维压缩为一个字节"""
+    if precision == Precision.BINARY:
+        if dim % 8 != 0:
+            raise ValueError("二值化向量的维度必须是 8 的倍数")
+        return dim // 8
+    return dim
+
+
+def vector_bytes(precision: Precision, dim: int) -> int:
+    """每个向量占用的字节数"""
+    return storage_width(precision, dim) * storage_dtype(precision).itemsize
+
+
+def int8_scale(vectors: np.ndarray) -> float:
+    """根据样本选取 int8 量化的缩放系数，使绝对值最大的分量映射到 127"""
+    peak = float(np.abs(vectors).max()) if len(vectors) else 0.0
+    return 127.0 / peak if peak > 0 else 127.0
+
+
+def binarize(vectors: np.ndarray) -> np.ndarray:
+    """
+    将向量二值化并按位压缩
+
+    每一维与该向量所有分量的均值比较，大于均值时为 1，
+    因此同时适用于有正负值的 SURF 与非负的 SIFT 特征向量。
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    bits = vectors > vectors.mean(axis=1, keepdims=True)
+    return np.packbits(bits, axis=1)
+
+
+def encode(vectors: np.ndarray, precision: Precision, scale: float = 127.0) -> np.ndarray:
+    """
+    将 float32 特征向量转换为存储格式
+    :param vectors: 特征向量，形状为 (n, dim)
+    :param precision: 存储精度
+    :param scale: int8 量化的缩放系数
+    """
+    match precision:
+        case Precision.FLOAT32 | Precision.FLOAT16:
+            return np.ascontiguousarray(vectors, dtype=storage_dtype(precision))
+        case Precision.INT8:
+            quantized = np.rint(np.asarray(vectors, dtype=np.float32) * scale)
+            return np.clip(quantized, -127, 127).astype(np.int8)
+        case Precision.BINARY:
+            return binarize(vectors)
+    raise ValueError(f"不支持的精度 {precision}")
+
+
+def decode(
+    stored: np.ndarray, precision: Precision, dim: int, scale: float = 127.0
+) -> np.ndarray:
+    """
+    将存储格式的向量还原为用于计算距离的 float32 向量
+
+    二值化的向量还原为各分量为 ±1/sqrt(dim) 的单位向量，
+    此时两个向量 L2 距离的平方等于 4 * 汉明距离 / dim。
+    """
+    match precision:
+        case Precision.FLOAT32 | Precision.FLOAT16:
+            return np.asarray(stored, dtype=np.float32)
+        case Precision.INT8:
+            return np.asarray(stored, dtype=np.float32) / np.float32(scale)
+        case Precision.BINARY:
+            bits = np.unpackbits(np.asarray(stored), axis=1, count=dim)
+            return (bits.astype(np.float32) * 2 - 1) / np.float32(np.sqrt(dim))
+    raise ValueError(f"不支持的精度 {precision}")
+
+
+def hamming_to_l2(distances: np.ndarray, dim: int) -> np.ndarray:
+    """将汉明距离换算为二值化单位向量之间 L2 距离的平方，与其他精度的距离保持一致"""
+    return np.asarray(distances, dtype=np.float32) * np.float32(4.0 / dim)
@@ -1,31 +1,393 @@
+import asyncio
+import contextlib
+import functools
+import io
+import json
+import tarfile
+import time
+import typing
 import uvicorn
 import numpy as np
 import cv2
+from concurrent.futures import ThreadPoolExecutor
 from loguru import logger
-from fastapi import FastAPI, File, UploadFile
-from herod import indexer
+from pydantic import BaseModel
+from fastapi import FastAPI, File, HTTPException, Query, Request, UploadFile
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from herod import indexer, metrics
+from herod.batcher import SearchBatcher
+from herod.buffer import Buffer, BufferPool, read_into
+from herod.cache import ResultCache
+from herod.config import config
+from herod.database import get_image_hash
 from herod.feature import Extractor, Filter
-
-api = FastAPI(docs_url=None, redoc_url=None)
+from herod.lifecycle import CollectionManager, LoadPending
+from herod.partition import PartitionedStore, partition_name
 
 INDEXER = {}
 
 
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 在后台预加载集合，不阻塞服务器启动
+    preload = {item.name: item for item in config.server.preload}
+    MANAGER.start_preload(
+        list(preload),
+        lambda collection: get_indexer(
+            collection,
+            extractor=preload[collection].extractor,
+            filter=preload[collection].filter,
+        ),
+    )
+    yield
+    # 关闭时写入批量插入缓冲区中剩余的数据
+    for idx in INDEXER.values():
+        await run_io(idx.close)
+
+
+class UploadLimit:
+    """
+    限制 multipart 上传请求体的大小
+
+    Content-Length 超过限制时直接返回 413；分块传输时边接收边计数，超过限制后立即中止，
+    不会先把整个请求体接收并写入临时文件。
+    """
+
+    def __init__(self, app, max_size: int):
+        self.app = app
+        self.max_size = max_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or self.max_size <= 0:
+            return await self.app(scope, receive, send)
+        headers = dict(scope["headers"])
+        if not headers.get(b"content-type", b"").startswith(b"multipart/"):
+            return await self.app(scope, receive, send)
+        detail = f"请求体超过 {self.max_size} 字节"
+        length = headers.get(b"content-length")
+        if length is not None and length.isdigit() and int(length) > self.max_size:
+            response = JSONResponse({"detail": detail}, status_code=413)
+            return await response(scope, receive, send)
+        received = 0
+
+        async def limited():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_size:
+                    raise HTTPException(status_code=413, detail=detail)
+            return message
+
+        await self.app(scope, limited, send)
+
+
+api = FastAPI(docs_url=None, redoc_url=None, lifespan=lifespan)
+api.add_middleware(UploadLimit, max_size=config.server.max_upload_size)
+
+# 搜索结果缓存，由所有集合共享
+CACHE = (
+    ResultCache(config.server.cache_bytes, config.server.cache_ttl)
+    if config.server.cache_bytes > 0
+    else None
+)
+
+# CPU 密集任务（解码、特征提取、结果汇总）
+CPU_EXECUTOR = ThreadPoolExecutor(
+    max_workers=config.server.workers, thread_name_prefix="herod-cpu"
+)
+# 阻塞的 IO 任务（Milvus、LMDB）
+IO_EXECUTOR = ThreadPoolExecutor(
+    max_workers=config.server.io_workers, thread_name_prefix="herod-io"
+)
+# 读取上传图片的缓冲区，每个 CPU 线程最多同时处理两张图片
+BUFFERS = BufferPool(config.server.workers * 2, config.server.upload_buffer_size)
+
+
+async def run_cpu(func, *args, **kwargs):
+    """在 CPU 线程池中执行函数"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        CPU_EXECUTOR, functools.partial(func, *args, **kwargs)
+    )
+
+
+async def run_io(func, *args, **kwargs):
+    """在 IO 线程池中执行函数"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        IO_EXECUTOR, functools.partial(func, *args, **kwargs)
+    )
+
+
+class CollectionLimiter:
+    """限制单个集合的并发请求数，排队的请求过多时直接拒绝"""
+
+    def __init__(self, concurrency: int, queue_size: int):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.queue_size = queue_size
+        self.waiting = 0
+        self.active = 0
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        if self.semaphore.locked() and self.waiting >= self.queue_size:
+            raise HTTPException(status_code=503, detail="服务器繁忙，请稍后重试")
+        self.waiting += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self.semaphore.release()
+
+
+LIMITER: dict[str, CollectionLimiter] = {}
+# 批量导入、删除与压缩的并发限制
+BULK_LIMITER: dict[str, CollectionLimiter] = {}
+LOADING: dict[str, asyncio.Lock] = {}
+BATCHER: dict[str, SearchBatcher] = {}
+
+
+def busy(collection: str) -> bool:
+    """集合是否有正在处理或排队的请求"""
+    limiter = LIMITER.get(collection)
+    return limiter is not None and (limiter.active > 0 or limiter.waiting > 0)
+
+
+# 集合索引的加载与释放
+MANAGER = CollectionManager(
+    INDEXER,
+    run_io,
+    config.server.memory_budget,
+    config.server.load_wait,
+    busy,
+)
+
+
+def throttle(collection: str):
+    if collection not in LIMITER:
+        LIMITER[collection] = CollectionLimiter(
+            config.server.concurrency, config.server.queue_size
+        )
+    return LIMITER[collection].acquire()
+
+
+def throttle_bulk(collection: str):
+    """批量请求耗时较长，使用单独的并发限制，不会占满搜索的并发数"""
+    if collection not in BULK_LIMITER:
+        BULK_LIMITER[collection] = CollectionLimiter(
+            config.server.bulk_concurrency, config.server.bulk_queue_size
+        )
+    return BULK_LIMITER[collection].acquire()
+
+
+async def new_indexer(collection: str, **kwargs) -> indexer.Indexer:
+    """在 IO 线程池中创建 Indexer，写入的图片在缓冲区中攒批后再插入"""
+    return await run_io(
+        indexer.Indexer,
+        collection,
+        cache=CACHE,
+        batch_size=config.server.insert_batch_size,
+        flush_interval=config.server.flush_interval,
+        **kwargs,
+    )
+
+
+async def get_indexer(
+    collection: str,
+    search: bool = False,
+    extractor: Extractor | None = None,
+    filter: Filter | None = None,
+):
+    """
+    获取集合的 Indexer，不存在时创建
+    :param search: 是否用于搜索，索引未加载时在后台加载，等待超时后返回 503
+    :param extractor: 特征点提取算法，为 None 时使用已加载的设置或默认值
+    :param filter: 特征点均匀化算法，为 None 时使用已加载的设置或默认值
+    """
+    if collection not in INDEXER:
+        lock = LOADING.setdefault(collection, asyncio.Lock())
+        async with lock:
+            if collection not in INDEXER:
+                INDEXER[collection] = await new_indexer(
+                    collection,
+                    extractor=extractor or Extractor.SURF,
+                    filter=filter or Filter.FUFP,
+                )
+    idx = INDEXER[collection]
+    if (extractor is not None and extractor != idx.extractor_name) or (
+        filter is not None and filter != idx.filter_name
+    ):
+        loaded = f"{Extractor(idx.extractor_name).value}/{Filter(idx.filter_name).value}"
+        raise HTTPException(
+            status_code=409, detail=f"集合 {collection} 已使用 {loaded} 加载"
+        )
+    MANAGER.touch(collection)
+    if search:
+        try:
+            await MANAGER.ensure_loaded(idx)
+        except LoadPending as e:
+            raise HTTPException(
+                status_code=503, detail=str(e), headers={"Retry-After": "5"}
+            )
+        except RuntimeError as e:
+            raise HTTPException(status_code=503, detail=str(e))
+    return idx
+
+
+def get_batcher(collection: str, idx: indexer.Indexer) -> SearchBatcher:
+    if collection not in BATCHER:
+        BATCHER[collection] = SearchBatcher(
+            idx.search_descriptors,
+            run_io,
+            config.server.batch_window_ms / 1000,
+            config.server.batch_max_vectors,
+        )
+    return BATCHER[collection]
+
+
+def decode_image(
+    idx: indexer.Indexer, buf: Buffer, spans: metrics.Spans = metrics.NULL_SPANS
+) -> cv2.typing.MatLike:
+    try:
+        return idx.decode(buf, spans)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="无法解码图片")
+
+
+@contextlib.asynccontextmanager
+async def read_upload(file: UploadFile) -> typing.AsyncIterator[Buffer]:
+    """
+    将上传的文件读入可重复使用的缓冲区，哈希与解码直接使用缓冲区中的数据，
+    退出时缓冲区放回池中
+    """
+    if file.size is None:
+        yield await file.read()
+        return
+    with BUFFERS.buffer(file.size) as view:
+        await file.seek(0)
+        await run_io(read_into, file.file, view)
+        yield view
+
+
+def new_spans(timings: bool = False) -> metrics.Spans:
+    """需要记录指标或返回各阶段耗时时才计时"""
+    if config.server.metrics or timings:
+        return metrics.Spans()
+    return metrics.NULL_SPANS
+
+
+def finish_spans(spans: metrics.Spans, endpoint: str, start: float):
+    if config.server.metrics:
+        metrics.observe_spans(spans)
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint)
+
+
+@contextlib.asynccontextmanager
+async def queued(collection: str, spans: metrics.Spans):
+    """等待集合的并发限制，并记录排队的耗时"""
+    start = time.perf_counter()
+    async with throttle(collection):
+        spans.add("queue", time.perf_counter() - start)
+        yield
+
+
+def check_partitions(
+    idx: indexer.Indexer, partitions: list[str] | None
+) -> tuple[str, ...] | None:
+    """检查要搜索的分区是否存在"""
+    if not partitions:
+        return None
+    if not isinstance(idx.store, PartitionedStore):
+        raise HTTPException(status_code=400, detail=f"集合 {idx.collection} 没有分区")
+    partitions = tuple(partition_name(partition) for partition in partitions)
+    missing = set(partitions) - set(idx.store.partitions)
+    if missing:
+        raise HTTPException(
+            status_code=400, detail=f"分区 {', '.join(sorted(missing))} 不存在"
+        )
+    return partitions
+
+
 @api.post("/load_collection")
 async def load_collection(
     collection: str,
     search: bool,
     extractor: Extractor = Extractor.SURF,
     filter: Filter = Filter.FUFP,
+    partition: str | None = None,
 ):
-    INDEXER[collection] = indexer.Indexer(
-        collection, extractor=extractor, filter=filter, search=search
+    """
+    :param search: 是否加载索引用于搜索，会等待加载完成
+    :param partition: 分区集合写入的分区，默认按日期选择分区
+    """
+    idx = await new_indexer(
+        collection, extractor=extractor, filter=filter, partition=partition
     )
+    old = await MANAGER.unload(collection) if collection in INDEXER else None
+    INDEXER[collection] = idx
+    BATCHER.pop(collection, None)
+    if old is not None:
+        await run_io(old.close)
+    if search:
+        await MANAGER.load(idx)
+        if not idx.loaded:
+            raise HTTPException(status_code=500, detail=MANAGER.status[collection].error)
 
 
 @api.post("/unload_collection")
 async def unload_collection(collection: str):
-    del INDEXER[collection]
+    idx = await MANAGER.unload(collection)
+    BATCHER.pop(collection, None)
+    await run_io(idx.close)
+
+
+@api.post("/release_collection")
+async def release_collection(collection: str):
+    """释放集合的索引占用的内存，之后的搜索会在后台重新加载"""
+    if collection not in INDEXER:
+        raise HTTPException(status_code=404, detail=f"集合 {collection} 未加载")
+    await MANAGER.release(collection)
+
+
+@api.get("/health")
+async def health():
+    """
+    服务器与各个集合的加载状态
+    预加载的集合全部加载完成前返回 503，可以用作就绪检查
+    """
+    result = MANAGER.health()
+    return JSONResponse(result, status_code=200 if result["ready"] else 503)
+
+
+@api.post("/load_partitions")
+async def load_partitions(collection: str, partitions: list[str] = Query(...)):
+    """加载分区集合中的部分分区，之后的搜索默认只包含已加载的分区"""
+    idx = await get_indexer(collection)
+    partitions = check_partitions(idx, partitions)
+    await run_io(idx.store.load, partitions)
+    idx.loaded = True
+    await MANAGER.refresh(idx)
+    # 默认搜索的分区发生了变化
+    if CACHE is not None:
+        CACHE.invalidate(collection)
+
+
+@api.post("/release_partitions")
+async def release_partitions(collection: str, partitions: list[str] = Query(...)):
+    """释放分区集合中部分分区占用的内存"""
+    idx = await get_indexer(collection)
+    partitions = check_partitions(idx, partitions)
+    await run_io(idx.store.release, partitions)
+    await MANAGER.refresh(idx)
+    if CACHE is not None:
+        CACHE.invalidate(collection)
 
 
 @api.post("/add_image")
@@ -34,11 +396,282 @@ async def add_image(
     name: str,
     file: UploadFile = File(...),
     limit: int = 500,
+    timings: bool = False,
+    extractor: Extractor | None = None,
+    filter: Filter | None = None,
 ):
-    if collection not in INDEXER:
-        INDEXER[collection] = indexer.Indexer(collection)
-    buf = await file.read()
-    INDEXER[collection].add_image_raw(buf, name, limit)
+    start = time.perf_counter()
+    spans = new_spans(timings)
+    async with read_upload(file) as buf, queued(collection, spans):
+        idx = await get_indexer(collection, extractor=extractor, filter=filter)
+        # 单张图片立即写入，不等待缓冲区攒批；图片已在缓冲区中时仍然随所在批次提交
+        status, written = await run_cpu(
+            idx.add_image_raw, buf, name, limit, spans, False
+        )
+    if written is not None:
+        # 图片所在的批次提交后才返回结果，写入失败时报告给这张图片
+        try:
+            await asyncio.wrap_future(written)
+        except Exception as e:
+            metrics.INGEST_IMAGES.inc(status="error")
+            raise HTTPException(status_code=500, detail=f"写入失败：{e}")
+    metrics.INGEST_IMAGES.inc(status=status)
+    finish_spans(spans, "add_image", start)
+    if timings:
+        return {"status": status, "timings": spans.milliseconds()}
+    return {"status": status}
+
+
+class _BodyReader(io.RawIOBase):
+    """将异步的请求体包装为同步读取的文件对象，在线程池中使用"""
+
+    def __init__(self, chunks, loop: asyncio.AbstractEventLoop):
+        self.chunks = chunks.__aiter__()
+        self.loop = loop
+        self.buffer = b""
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while not self.buffer:
+            future = asyncio.run_coroutine_threadsafe(self._next(), self.loop)
+            chunk = future.result()
+            if chunk is None:
+                return 0
+            self.buffer = chunk
+        size = min(len(b), len(self.buffer))
+        b[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
+
+    async def _next(self) -> bytes | None:
+        try:
+            return await self.chunks.__anext__()
+        except StopAsyncIteration:
+            return None
+
+
+class _DuplexResponse(StreamingResponse):
+    """
+    边读取请求体边返回的流式响应
+
+    StreamingResponse 会同时调用 receive 监听客户端断开，与读取请求体相互竞争，
+    因此这里只发送响应。
+    """
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await self.stream_response(send)
+        finally:
+            # 客户端断开时也需要执行，用于释放请求占用的资源
+            if self.background is not None:
+                await self.background()
+
+
+def _read_tar(
+    reader: io.RawIOBase, loop: asyncio.AbstractEventLoop, items: asyncio.Queue
+):
+    """
+    在线程中逐个读取 tar 流中的文件，放入队列，队列满时阻塞
+
+    文件读入池中的缓冲区，由处理完成的一方放回；超过上传大小限制的文件不读取，缓冲区为 None
+    """
+
+    def put(item):
+        asyncio.run_coroutine_threadsafe(items.put(item), loop).result()
+
+    max_size = config.server.max_upload_size
+    try:
+        with tarfile.open(fileobj=io.BufferedReader(reader), mode="r|*") as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                if 0 < max_size < member.size:
+                    # 流式读取时，下一次迭代会直接跳过文件的内容
+                    put((member.name, None, member.size))
+                    continue
+                buf = BUFFERS.acquire(member.size)
+                try:
+                    read_into(tar.extractfile(member), memoryview(buf)[: member.size])
+                except BaseException:
+                    BUFFERS.release(buf)
+                    raise
+                put((member.name, buf, member.size))
+    except Exception as e:
+        put(e)
+    finally:
+        put(None)
+
+
+@api.post("/add_images")
+async def add_images(
+    request: Request,
+    collection: str,
+    limit: int = 500,
+    prefix: str = "",
+    extractor: Extractor | None = None,
+    filter: Filter | None = None,
+):
+    """
+    批量添加图片
+
+    请求体为 tar 流，每个文件为一张图片，文件名为 prefix + 文件在 tar 中的路径。
+    多张图片并行解码与提取特征，写入的向量攒批后再插入。
+    以 NDJSON 格式逐行返回每张图片的处理结果，最后一行为汇总。
+    """
+    # 并发限制在响应结束后才释放，排队的请求过多时在开始读取请求体之前返回 503
+    stack = contextlib.AsyncExitStack()
+    await stack.enter_async_context(throttle_bulk(collection))
+    try:
+        idx = await get_indexer(collection, extractor=extractor, filter=filter)
+    except BaseException:
+        await stack.aclose()
+        raise
+    loop = asyncio.get_running_loop()
+    parallel = config.server.workers * 2
+    items: asyncio.Queue = asyncio.Queue(maxsize=parallel)
+    results: asyncio.Queue = asyncio.Queue()
+    semaphore = asyncio.Semaphore(parallel)
+
+    async def process(name: str, buf: bytearray, size: int):
+        written = None
+        try:
+            data = memoryview(buf)[:size]
+            status, written = await run_cpu(idx.add_image_raw, data, name, limit)
+            result = {"name": name, "status": status}
+        except Exception as e:
+            result = {"name": name, "status": "error", "error": str(e)}
+        finally:
+            BUFFERS.release(buf)
+            semaphore.release()
+        if written is not None:
+            # 等待所在批次提交时不占用并行处理的名额
+            try:
+                await asyncio.wrap_future(written)
+            except Exception as e:
+                result = {"name": name, "status": "error", "error": f"写入失败：{e}"}
+        metrics.INGEST_IMAGES.inc(status=result["status"])
+        await results.put(result)
+
+    async def produce():
+        start = time.perf_counter()
+        reader = asyncio.ensure_future(
+            run_io(_read_tar, _BodyReader(request.stream(), loop), loop, items)
+        )
+        tasks = []
+        error = None
+        reading = True
+        try:
+            while (item := await items.get()) is not None:
+                if isinstance(item, Exception):
+                    error = f"读取 tar 流失败：{item}"
+                    continue
+                name, buf, size = item
+                if buf is None:
+                    metrics.INGEST_IMAGES.inc(status="error")
+                    await results.put(
+                        {
+                            "name": prefix + name,
+                            "status": "error",
+                            "error": f"图片大小 {size} 字节超过上传限制",
+                        }
+                    )
+                    continue
+                await semaphore.acquire()
+                tasks.append(asyncio.ensure_future(process(prefix + name, buf, size)))
+            reading = False
+            await reader
+            # 所有图片都加入缓冲区后立即写入最后一批，不必等待缓冲区的时间间隔
+            for _ in range(parallel):
+                await semaphore.acquire()
+            with contextlib.suppress(Exception):
+                # 写入失败由每张图片的结果报告
+                await run_io(idx.flush)
+            await asyncio.gather(*tasks)
+        except asyncio.CancelledError:
+            # 客户端断开：丢弃尚未处理的文件直到读取线程结束，并等待正在处理的图片完成
+            while reading and (item := await items.get()) is not None:
+                if isinstance(item, tuple) and item[1] is not None:
+                    BUFFERS.release(item[1])
+            await asyncio.gather(reader, *tasks, return_exceptions=True)
+            raise
+        elapsed = time.perf_counter() - start
+        await results.put({"summary": True, "error": error, "elapsed": elapsed})
+        await results.put(None)
+
+    async def stop(producer: asyncio.Future):
+        """取消仍在读取与处理图片的任务，等待其结束后才释放并发限制"""
+        producer.cancel()
+        await asyncio.gather(producer, return_exceptions=True)
+
+    async def generate():
+        producer = asyncio.ensure_future(produce())
+        # 先于并发限制执行，客户端断开时批量处理不会在释放名额后继续进行
+        stack.push_async_callback(stop, producer)
+        count: dict[str, int] = {}
+        while (result := await results.get()) is not None:
+            if result.get("summary"):
+                result = {
+                    "summary": count,
+                    "error": result["error"],
+                    "elapsed": result["elapsed"],
+                }
+            else:
+                count[result["status"]] = count.get(result["status"], 0) + 1
+            yield json.dumps(result, ensure_ascii=False) + "\n"
+        await producer
+
+    return _DuplexResponse(
+        generate(),
+        media_type="application/x-ndjson",
+        background=BackgroundTask(stack.aclose),
+    )
+
+
+class RemoveRequest(BaseModel):
+    # 导入时的文件名，或十进制的图片 ID
+    images: list[str] = []
+    # 图片 ID
+    ids: list[int] = []
+
+
+@api.post("/remove_images")
+async def remove_images(collection: str, request: RemoveRequest):
+    """
+    批量删除图片的所有向量与记录，删除后不再出现在搜索结果中，集合的搜索结果缓存失效
+
+    请求体为 JSON：{"images": [文件名或图片 ID, ...], "ids": [图片 ID, ...]}
+    :return: 被删除的图片 ID 与不存在的图片
+    """
+    # 图片 ID 为 5 字节的哈希
+    if any(not 0 <= image_id < 1 << 40 for image_id in request.ids):
+        raise HTTPException(status_code=400, detail="图片 ID 超出范围")
+    async with throttle_bulk(collection):
+        idx = await get_indexer(collection)
+        found = await run_io(idx.find_images, request.images)
+        missing = [
+            name for name, image_id in zip(request.images, found) if image_id is None
+        ]
+        ids = [image_id for image_id in found if image_id is not None] + request.ids
+        removed = await run_io(idx.remove_images, ids)
+    return {"removed": removed, "missing": missing}
+
+
+@api.post("/compact")
+async def compact(collection: str):
+    """
+    回收已删除图片占用的空间，在 IO 线程中进行，期间可以继续搜索
+    :return: 压缩前后 LMDB 数据文件的大小（字节）
+    """
+    async with throttle_bulk(collection):
+        idx = await get_indexer(collection)
+        start = time.perf_counter()
+        try:
+            before, after = await run_io(idx.compact)
+        except RuntimeError as e:
+            raise HTTPException(status_code=409, detail=str(e))
+    return {"lmdb": [before, after], "elapsed": time.perf_counter() - start}
 
 
 @api.post("/search_image")
@@ -48,17 +681,302 @@ async def search_image(
     search_list: int = 16,
     search_limit: int = 100,
     limit: int = 50,
+    top_k: int = 20,
+    timings: bool = False,
+    rerank: int = 0,
+    partitions: list[str] | None = Query(None),
+    prefilter: bool | None = None,
 ):
-    if collection not in INDEXER:
-        INDEXER[collection] = indexer.Indexer(collection, search=True)
-    buf = await file.read()
-    img = np.frombuffer(buf, dtype=np.uint8)
-    img = cv2.imdecode(img, cv2.IMREAD_GRAYSCALE)
-    logger.info(f"shape: {img.shape}")
-    elapsed, data = INDEXER[collection].search_image(
-        img, search_list, search_limit, limit
-    )[:20]
-    return {"elapsed": elapsed, "result": data[:20]}
+    """
+    :param timings: 是否在结果中返回各阶段的耗时（毫秒）
+    :param rerank: 使用几何验证重排的候选图片数量，为 0 时不重排
+    :param partitions: 搜索的分区，仅用于分区集合，默认为所有已加载的分区
+    :param prefilter: 是否先用感知哈希查找重复的图片，默认使用配置文件中的设置
+    """
+    start = time.perf_counter()
+    spans = new_spans(timings)
+    partitions = tuple(partitions) if partitions else None
+    prefilter = indexer.use_prefilter(prefilter, partitions)
+    # 相同的图片与搜索参数直接返回缓存的结果
+    params = (search_list, search_limit, limit, top_k, rerank, partitions, prefilter)
+    async with read_upload(file) as buf:
+        if CACHE is not None:
+            with spans.span("hash"):
+                digest = await run_cpu(get_image_hash, buf)
+            cached = CACHE.get(collection, digest, params)
+            if cached is not None:
+                finish_spans(spans, "search_image", start)
+                response = {"elapsed": 0.0, "result": cached, "cached": True}
+                if timings:
+                    response["timings"] = spans.milliseconds()
+                return response
+            generation = CACHE.generation(collection)
+        async with queued(collection, spans):
+            idx = await get_indexer(collection, search=True)
+            img = await run_cpu(decode_image, idx, buf, spans)
+            logger.info(f"shape: {img.shape}")
+            partitions = check_partitions(idx, partitions)
+            elapsed = 0.0
+            # 找到重复的图片时不再进行特征向量搜索
+            data = None
+            if prefilter:
+                data = await run_cpu(idx.match_signature, img, top_k, spans) or None
+            if data is None:
+                points, des = await run_cpu(idx.extract_points, img, search_limit, spans)
+                now = time.perf_counter()
+                results = await get_batcher(collection, idx).search(
+                    des, search_list, limit, partitions
+                )
+                elapsed = time.perf_counter() - now
+                # 包含合并搜索时的等待时间
+                spans.add("ann", elapsed)
+                if rerank > 0:
+                    candidates = await run_cpu(
+                        idx.aggregate, results, indexer.rerank_candidates(top_k, rerank), spans
+                    )
+                    data = await run_cpu(
+                        idx.rerank, points, des, candidates, rerank, top_k, spans=spans
+                    )
+                else:
+                    data = await run_cpu(idx.aggregate, results, top_k, spans)
+    if CACHE is not None:
+        CACHE.put(collection, digest, params, data, generation)
+    finish_spans(spans, "search_image", start)
+    response = {"elapsed": elapsed, "result": data, "cached": False}
+    if timings:
+        response["timings"] = spans.milliseconds()
+    return response
+
+
+def extract_image(
+    idx: indexer.Indexer,
+    buf: bytes,
+    limit: int,
+    spans: metrics.Spans,
+    prefilter: bool = False,
+    top_k: int | None = None,
+) -> np.ndarray | list[tuple[str, int, float]]:
+    """
+    解码图片并提取特征向量
+    :return: 特征向量，prefilter 为 True 且找到重复的图片时返回搜索结果
+    """
+    img = decode_image(idx, buf, spans)
+    if prefilter and (data := idx.match_signature(img, top_k, spans)):
+        return data
+    return idx.extract(img, limit, spans)
+
+
+@api.post("/search_images")
+async def search_images(
+    collection: str,
+    files: list[UploadFile] = File(...),
+    search_list: int = 16,
+    search_limit: int = 100,
+    limit: int = 50,
+    top_k: int = 20,
+    timings: bool = False,
+    partitions: list[str] | None = Query(None),
+    prefilter: bool | None = None,
+):
+    """
+    批量搜索多张图片
+
+    并行提取所有图片的特征向量后合并为少数几次向量搜索，再按图片返回结果，
+    单张图片出错时不影响其他图片。
+    :param timings: 是否在结果中返回各阶段的耗时总和（毫秒）
+    :param partitions: 搜索的分区，仅用于分区集合，默认为所有已加载的分区
+    :param prefilter: 是否先用感知哈希查找重复的图片，默认使用配置文件中的设置
+    """
+    start = time.perf_counter()
+    spans = new_spans(timings)
+    results = [{"name": file.filename} for file in files]
+    partitions = tuple(partitions) if partitions else None
+    prefilter = indexer.use_prefilter(prefilter, partitions)
+    params = (search_list, search_limit, limit, top_k, 0, partitions, prefilter)
+    # 所有图片的缓冲区在特征提取完成后才放回池中
+    async with contextlib.AsyncExitStack() as stack:
+        bufs = [await stack.enter_async_context(read_upload(file)) for file in files]
+        digests = [None] * len(bufs)
+        if CACHE is not None:
+            generation = CACHE.generation(collection)
+            with spans.span("hash"):
+                digests = await asyncio.gather(*(run_cpu(get_image_hash, buf) for buf in bufs))
+        pending = []
+        for i, digest in enumerate(digests):
+            cached = CACHE.get(collection, digest, params) if digest is not None else None
+            if cached is not None:
+                results[i].update(result=cached, cached=True)
+            else:
+                pending.append(i)
+
+        elapsed = 0.0
+        if pending:
+            async with queued(collection, spans):
+                idx = await get_indexer(collection, search=True)
+                partitions = check_partitions(idx, partitions)
+                # 每张图片单独计时，结束后再累加，避免多个线程同时写入
+                image_spans = [new_spans(timings) for _ in pending]
+                extracted = await asyncio.gather(
+                    *(
+                        run_cpu(
+                            extract_image,
+                            idx,
+                            bufs[i],
+                            search_limit,
+                            image_spans[n],
+                            prefilter,
+                            top_k,
+                        )
+                        for n, i in enumerate(pending)
+                    ),
+                    return_exceptions=True,
+                )
+                for item in image_spans:
+                    for name, seconds in item.timings.items():
+                        spans.add(name, seconds)
+                queries = []
+                matched = []
+                for i, des in zip(pending, extracted):
+                    if isinstance(des, HTTPException):
+                        results[i]["error"] = des.detail
+                    elif isinstance(des, Exception):
+                        results[i]["error"] = str(des)
+                    elif isinstance(des, list):
+                        matched.append((i, des))
+                    else:
+                        queries.append((i, des))
+
+                now = time.perf_counter()
+                hits = await run_io(
+                    idx.search_many,
+                    [des for _, des in queries],
+                    search_list,
+                    limit,
+                    partitions=partitions,
+                )
+                elapsed = time.perf_counter() - now
+                spans.add("ann", elapsed)
+                with spans.span("aggregate"):
+                    data = await asyncio.gather(
+                        *(run_cpu(idx.aggregate, item, top_k) for item in hits)
+                    )
+            searched = [(i, item) for (i, _), item in zip(queries, data)]
+            for i, item in matched + searched:
+                results[i].update(result=item, cached=False)
+                if digests[i] is not None:
+                    CACHE.put(collection, digests[i], params, item, generation)
+
+    finish_spans(spans, "search_images", start)
+    response = {"elapsed": elapsed, "results": results}
+    if timings:
+        response["timings"] = spans.milliseconds()
+    return response
+
+
+@api.get("/stats")
+async def stats():
+    return {
+        "batch": {
+            collection: batcher.stats.summary()
+            for collection, batcher in BATCHER.items()
+        },
+        "cache": CACHE.stats() if CACHE is not None else None,
+    }
+
+
+def _collect_limiter(attr: str):
+    return lambda: {
+        (collection,): getattr(limiter, attr) for collection, limiter in LIMITER.items()
+    }
+
+
+def _collect_batcher():
+    return {
+        (collection,): sum(batch.size for batch in batcher.pending.values())
+        for collection, batcher in BATCHER.items()
+    }
+
+
+def _collect_buffer():
+    return {
+        (collection,): idx.buffer.size
+        for collection, idx in INDEXER.items()
+        if idx.buffer is not None
+    }
+
+
+def _collect_upload_buffers():
+    return {(): BUFFERS.size}
+
+
+def _collect_memory():
+    return {
+        (collection,): MANAGER.status[collection].memory
+        for collection, idx in INDEXER.items()
+        if idx.loaded and collection in MANAGER.status
+    }
+
+
+def _collect_cache(attr: str):
+    return lambda: {(): getattr(CACHE, attr)} if CACHE is not None else {}
+
+
+for metric in (
+    metrics.Gauge(
+        "herod_requests_waiting",
+        "等待并发限制的请求数",
+        _collect_limiter("waiting"),
+        ["collection"],
+    ),
+    metrics.Gauge(
+        "herod_requests_active",
+        "正在处理的请求数",
+        _collect_limiter("active"),
+        ["collection"],
+    ),
+    metrics.Gauge(
+        "herod_batcher_pending_vectors",
+        "等待合并搜索的向量数",
+        _collect_batcher,
+        ["collection"],
+    ),
+    metrics.Gauge(
+        "herod_insert_buffer_rows",
+        "批量插入缓冲区中等待写入的向量数",
+        _collect_buffer,
+        ["collection"],
+    ),
+    metrics.Gauge(
+        "herod_upload_buffer_bytes",
+        "池中可重复使用的上传缓冲区占用的内存",
+        _collect_upload_buffers,
+    ),
+    metrics.Gauge(
+        "herod_collection_memory_bytes",
+        "已加载集合的内存占用估计值",
+        _collect_memory,
+        ["collection"],
+    ),
+    metrics.Gauge(
+        "herod_cache_hits_total", "搜索结果缓存命中次数", _collect_cache("hits"), type="counter"
+    ),
+    metrics.Gauge(
+        "herod_cache_misses_total",
+        "搜索结果缓存未命中次数",
+        _collect_cache("misses"),
+        type="counter",
+    ),
+    metrics.Gauge("herod_cache_bytes", "搜索结果缓存占用的内存", _collect_cache("size")),
+):
+    metrics.REGISTRY.register(metric)
+
+
+@api.get("/metrics")
+async def get_metrics():
+    """Prometheus 格式的指标"""
+    return PlainTextResponse(
+        metrics.REGISTRY.render(), media_type="text/plain; version=0.0.4"
+    )
 
 
 def start_server(host: str, port: int):
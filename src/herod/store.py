@@ -0,0 +1,214 @@
+import abc
+import numpy as np
+from herod.config import config
+from herod.enums import Backend, Precision
+
+
+class SearchHits:
+    """
+    向量搜索结果
+
+    第 i 个查询向量的匹配为 images[offsets[i]:offsets[i + 1]]，按距离升序排列
+    """
+
+    def __init__(self, images: np.ndarray, distances: np.ndarray, offsets: np.ndarray):
+        """
+        :param images: 匹配到的向量所属的图片 ID
+        :param distances: 匹配到的向量的 L2 距离
+        :param offsets: 每个查询向量的匹配在数组中的起始位置，长度为查询向量数 + 1
+        """
+        self.images = images
+        self.distances = distances
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: slice) -> "SearchHits":
+        """按查询向量切片"""
+        start, stop, step = index.indices(len(self))
+        if step != 1:
+            raise ValueError("不支持带步长的切片")
+        stop = max(start, stop)
+        lo, hi = self.offsets[start], self.offsets[stop]
+        return SearchHits(
+            self.images[lo:hi],
+            self.distances[lo:hi],
+            self.offsets[start : stop + 1] - lo,
+        )
+
+    @classmethod
+    def concat(cls, parts: list["SearchHits"]) -> "SearchHits":
+        """按顺序拼接多次搜索的结果"""
+        if len(parts) == 1:
+            return parts[0]
+        sizes = [len(part.images) for part in parts]
+        bases = np.cumsum([0] + sizes[:-1])
+        offsets = [np.zeros(1, dtype=np.int64)]
+        offsets += [part.offsets[1:] + base for part, base in zip(parts, bases)]
+        return cls(
+            np.concatenate([part.images for part in parts]),
+            np.concatenate([part.distances for part in parts]),
+            np.concatenate(offsets),
+        )
+
+    @classmethod
+    def merge(cls, parts: list["SearchHits"], limit: int) -> "SearchHits":
+        """
+        合并对同一组查询向量的多次搜索结果，每个查询向量保留距离最小的 limit 个匹配
+        :param parts: 每个分区的搜索结果，查询向量的数量与顺序相同
+        :param limit: 每个查询向量的匹配数量
+        """
+        if len(parts) == 1:
+            return parts[0]
+        count = len(parts[0])
+        queries = np.concatenate(
+            [np.repeat(np.arange(count), np.diff(part.offsets)) for part in parts]
+        )
+        images = np.concatenate([part.images for part in parts])
+        distances = np.concatenate([part.distances for part in parts])
+        order = np.lexsort((distances, queries))
+        queries = queries[order]
+        counts = np.bincount(queries, minlength=count)
+        rank = np.arange(len(queries)) - np.repeat(np.cumsum(counts) - counts, counts)
+        keep = order[rank < limit]
+        offsets = np.concatenate([[0], np.cumsum(np.minimum(counts, limit))])
+        return cls(images[keep], distances[keep], offsets.astype(np.int64))
+
+    @classmethod
+    def empty(cls, count: int = 0) -> "SearchHits":
+        return cls(
+            np.empty(0, dtype=np.int64),
+            np.empty(0, dtype=np.float32),
+            np.zeros(count + 1, dtype=np.int64),
+        )
+
+
+class VectorStore(abc.ABC):
+    """向量存储后端，每个集合保存 (图片 ID, 特征向量)"""
+
+    # 默认的索引类型
+    default_index_type: str
+    # 向量的存储精度，插入与搜索时传入 float32 向量，由后端负责转换
+    precision: Precision
+
+    @classmethod
+    @abc.abstractmethod
+    def create(
+        cls,
+        name: str,
+        description: str = "",
+        dim: int = 64,
+        precision: Precision = Precision.FLOAT32,
+    ):
+        """
+        建立一个集合
+        :param precision: 向量的存储精度
+        """
+
+    @classmethod
+    @abc.abstractmethod
+    def exists(cls, name: str) -> bool:
+        """集合是否存在"""
+
+    @classmethod
+    @abc.abstractmethod
+    def drop(cls, name: str):
+        """删除一个集合"""
+
+    @abc.abstractmethod
+    def insert(self, image_ids: np.ndarray, vectors: np.ndarray):
+        """
+        插入向量
+        :param image_ids: 每个向量所属的图片 ID
+        :param vectors: 特征向量，形状为 (n, dim)
+        """
+
+    def flush(self):
+        """确保已插入的向量持久化并对搜索可见"""
+
+    @abc.abstractmethod
+    def delete(self, image_ids: np.ndarray):
+        """
+        删除图片的所有向量，删除后不再出现在搜索结果中
+        :param image_ids: 图片 ID
+        """
+
+    @abc.abstractmethod
+    def compact(self):
+        """回收已删除向量占用的空间，压缩期间可以继续搜索与写入"""
+
+    @abc.abstractmethod
+    def search(self, vectors: np.ndarray, search_list: int, limit: int) -> SearchHits:
+        """
+        搜索向量
+        :param vectors: 查询向量
+        :param search_list: 搜索列表大小，越大越准确，但是速度越慢
+        :param limit: 每个向量的匹配数量
+        """
+
+    @abc.abstractmethod
+    def load(self):
+        """将索引加载到内存中"""
+
+    @abc.abstractmethod
+    def release(self):
+        """释放索引占用的内存"""
+
+    @abc.abstractmethod
+    def memory_size(self) -> int:
+        """加载后占用内存的估计值（字节），用于服务器的内存预算"""
+
+    @abc.abstractmethod
+    def create_index(self, index_type: str | None = None):
+        """建立索引，index_type 为 None 时使用后端的默认索引类型"""
+
+    @abc.abstractmethod
+    def drop_index(self):
+        """删除索引"""
+
+
+def store_class(backend: Backend | None = None) -> type[VectorStore]:
+    """返回向量存储后端的实现，默认使用配置文件中的后端"""
+    match backend or config.backend:
+        case Backend.MILVUS:
+            from herod.milvus import MilvusStore
+
+            return MilvusStore
+        case Backend.LOCAL:
+            from herod.local import LocalStore
+
+            return LocalStore
+
+
+def open_store(
+    name: str, backend: Backend | None = None, partition: str | None = None
+) -> VectorStore:
+    """
+    打开一个集合的向量存储
+    :param partition: 分区集合写入的分区，默认按日期选择分区
+    """
+    from herod.partition import PartitionedStore
+
+    if PartitionedStore.exists(name):
+        return PartitionedStore(name, backend, partition)
+    if partition is not None:
+        raise ValueError(f"集合 {name} 没有分区")
+    return store_class(backend)(name)
+
+
+def collection_exists(name: str, backend: Backend | None = None) -> bool:
+    """集合是否存在，包括分区集合"""
+    from herod.partition import PartitionedStore
+
+    return PartitionedStore.exists(name) or store_class(backend).exists(name)
+
+
+def drop_collection(name: str, backend: Backend | None = None):
+    """删除一个集合，分区集合会删除所有分区"""
+    from herod.partition import PartitionedStore
+
+    if PartitionedStore.exists(name):
+        PartitionedStore.drop(name)
+    else:
+        store_class(backend).drop(name)
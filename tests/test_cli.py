@@ -0,0 +1,41 @@
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import herod
+
+# 子进程中导入 herod.cli 的时间上限（秒），不包括解释器启动的时间
+IMPORT_BUDGET = 2.0
+# 只在执行具体命令时才导入的模块
+HEAVY_MODULES = ("cv2", "numpy", "pymilvus", "fastapi")
+
+
+def test_import_time():
+    env = {
+        **os.environ,
+        "PYTHONPATH": str(Path(herod.__file__).parent.parent),
+    }
+    code = (
+        "import json, sys, time\n"
+        "start = time.perf_counter()\n"
+        "import herod.cli\n"
+        "elapsed = time.perf_counter() - start\n"
+        f"heavy = [m for m in {HEAVY_MODULES!r} if m in sys.modules]\n"
+        "print(json.dumps({'elapsed': elapsed, 'heavy': heavy}))\n"
+    )
+    # 第一次运行用于生成字节码缓存，取后几次中最快的一次
+    elapsed = []
+    for _ in range(3):
+        result = subprocess.run(
+            [sys.executable, "-c", code],
+            env=env,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        output = json.loads(result.stdout)
+        assert output["heavy"] == [], f"导入了 {', '.join(output['heavy'])}"
+        elapsed.append(output["elapsed"])
+    assert min(elapsed[1:]) < IMPORT_BUDGET
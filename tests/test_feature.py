@@ -0,0 +1,85 @@
+import cv2
+import numpy as np
+import pytest
+
+from herod.feature import (
+    fufp_extract,
+    fufp_extract_indices,
+    keypoint_arrays,
+    quad_filter,
+    quad_filter_indices,
+)
+
+SIZES = [(480, 640), (1080, 1920), (333, 517)]
+
+
+def random_keypoints(
+    seed: int, count: int, height: int, width: int, levels: int | None = None
+) -> list[cv2.KeyPoint]:
+    """
+    生成随机的特征点
+    :param levels: 响应值只取这么多个不同的值，用于制造响应值相同的特征点
+    """
+    rng = np.random.default_rng(seed)
+    xs = rng.uniform(0, width, count)
+    ys = rng.uniform(0, height, count)
+    if levels is None:
+        responses = rng.uniform(0, 1, count)
+    else:
+        responses = rng.integers(0, levels, count) / levels
+    return [
+        cv2.KeyPoint(float(x), float(y), 8, -1, float(r))
+        for x, y, r in zip(xs, ys, responses)
+    ]
+
+
+def reference_indices(keys: list[cv2.KeyPoint], selected: list[cv2.KeyPoint]):
+    """将参考实现返回的特征点转换为下标"""
+    index = {id(key): i for i, key in enumerate(keys)}
+    return [index[id(key)] for key in selected]
+
+
+@pytest.mark.parametrize("height,width", SIZES)
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("count,limit", [(2000, 500), (300, 100), (50, 500)])
+@pytest.mark.parametrize("levels", [None, 3])
+def test_fufp_extract_indices(height, width, seed, count, limit, levels):
+    keys = random_keypoints(seed, count, height, width, levels)
+    pts, responses = keypoint_arrays(keys)
+    expected = reference_indices(keys, fufp_extract(keys, height, width, limit))
+    result = fufp_extract_indices(pts, responses, height, width, limit)
+    assert result.tolist() == expected
+
+
+@pytest.mark.parametrize("height,width", SIZES)
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("count,limit", [(2000, 500), (300, 100), (50, 500)])
+@pytest.mark.parametrize("levels", [None, 3])
+def test_quad_filter_indices(height, width, seed, count, limit, levels):
+    keys = random_keypoints(seed, count, height, width, levels)
+    pts, responses = keypoint_arrays(keys)
+    expected = reference_indices(keys, quad_filter(keys, height, width, limit))
+    result = quad_filter_indices(pts, responses, height, width, limit)
+    assert result.tolist() == expected
+
+
+def test_equal_responses():
+    # 所有特征点的响应值相同时，每个网格与节点都选取遍历顺序中的第一个特征点
+    keys = [
+        cv2.KeyPoint(float(x), float(y), 8, -1, 1.0)
+        for x in range(5, 640, 40)
+        for y in range(5, 480, 40)
+    ]
+    pts, responses = keypoint_arrays(keys)
+    assert fufp_extract_indices(pts, responses, 480, 640, 50).tolist() == (
+        reference_indices(keys, fufp_extract(keys, 480, 640, 50))
+    )
+    assert quad_filter_indices(pts, responses, 480, 640, 50).tolist() == (
+        reference_indices(keys, quad_filter(keys, 480, 640, 50))
+    )
+
+
+def test_empty():
+    pts, responses = keypoint_arrays([])
+    assert len(fufp_extract_indices(pts, responses, 480, 640, 500)) == 0
+    assert len(quad_filter_indices(pts, responses, 480, 640, 500)) == 0
@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+
+from herod.indexer import wilson_score, wilson_scores
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("count,size", [(1000, 20), (50, 50), (200, 1)])
+def test_wilson_scores(seed, count, size):
+    rng = np.random.default_rng(seed)
+    # 与 aggregate 相同，分组为 np.unique 返回的连续下标
+    images, groups = np.unique(rng.integers(0, size, count), return_inverse=True)
+    distances = rng.uniform(0, 1, count).astype(np.float32)
+    scores = wilson_scores(groups, distances, len(images))
+    for group in range(len(images)):
+        expected = wilson_score(distances[groups == group].tolist())
+        assert scores[group] == pytest.approx(expected, rel=1e-9, abs=1e-12)
+
+
+def test_wilson_scores_equal_distances():
+    # 方差为 0 时，向量化版本的浮点误差不能使方差小于 0
+    groups = np.array([0, 0, 0, 1])
+    distances = np.array([0.3, 0.3, 0.3, 0.7], dtype=np.float32)
+    scores = wilson_scores(groups, distances, 2)
+    for group in (0, 1):
+        expected = wilson_score(distances[groups == group].tolist())
+        assert scores[group] == pytest.approx(expected, rel=1e-9, abs=1e-12)